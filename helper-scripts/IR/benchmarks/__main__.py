@@ -0,0 +1,158 @@
+"""Times the ir.py collectors on synthetic books.
+
+Run it from helper-scripts/IR, e.g. `python -m benchmarks --splits 10000 100000 1000000`. Books are generated once into
+--data-dir and reused while their size and seed don't change. Every run is appended to the results file together with the
+current commit, so regressions show up by comparing its entries.
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+
+from contextlib import redirect_stdout
+from datetime import datetime
+from piecash import open_book
+
+import ir
+from checkpoints import open_checkpoints
+from quotes import retrieve_usdbrl_quotes
+from benchmarks.synthetic_book import build_book
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def current_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+
+    return result.stdout.strip() or None
+
+
+def synthetic_book_paths(data_dir, split_count, seed):
+    name = 'synthetic-{}-seed{}'.format(split_count, seed)
+    return os.path.join(data_dir, name + '.gnucash'), os.path.join(data_dir, name + '-usdbrl.csv')
+
+
+def ensure_book(data_dir, split_count, seed):
+    gnucash_db_path, quotes_csv_path = synthetic_book_paths(data_dir, split_count, seed)
+    if not os.path.exists(gnucash_db_path) or not os.path.exists(quotes_csv_path):
+        print('generating a book with {} splits'.format(split_count), file=sys.stderr)
+        os.makedirs(data_dir, exist_ok=True)
+        build_book(gnucash_db_path, quotes_csv_path, split_count, seed=seed)
+
+    return gnucash_db_path, quotes_csv_path
+
+
+def measure(function, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started)
+
+    return result, {'min': min(timings), 'median': statistics.median(timings), 'runs': timings}
+
+
+def full_report(book, years, quotes_by_date, quotes_csv_path, checkpoints):
+    reports = ir.collect_reports(book, years, quotes_by_date, quotes_csv_path, checkpoints, 1)
+    with redirect_stdout(io.StringIO()):
+        for year in years:
+            ir.print_report(year, reports[year], False)
+
+
+def benchmark_book(gnucash_db_path, quotes_csv_path, years, repeat):
+    timings = {}
+
+    def run(name, function):
+        print('  {}'.format(name), file=sys.stderr)
+        result, timings[name] = measure(function, repeat)
+        return result
+
+    quotes_by_date = run('retrieve_usdbrl_quotes', lambda: retrieve_usdbrl_quotes(quotes_csv_path))
+
+    with open_book(gnucash_db_path, readonly=True, do_backup=False, open_if_lock=True) as book:
+        bens_direitos = run('collect_bens_direitos_brasil', lambda: ir.collect_bens_direitos_brasil(book, years))
+        stocks = run('collect_bens_direitos_stocks', lambda: ir.collect_bens_direitos_stocks(book, quotes_by_date, years))
+        run('collect_crypto', lambda: ir.collect_crypto(book, years))
+
+        last_year = years[-1]
+        all_sales = bens_direitos[last_year][1] + stocks[last_year][1]
+        run('extract_sales_info', lambda: ir.extract_sales_info(all_sales))
+
+        bid_quotes_by_month_by_year = {year: ir.get_us_dividend_usdbrl_quotes(quotes_by_date, year) for year in years}
+        run('collect_brokerage_account_balance', lambda: ir.collect_brokerage_account_balance(book, years, quotes_by_date))
+        run('collect_proventos', lambda: ir.collect_proventos(book, years))
+        run('collect_proventos_fiis', lambda: ir.collect_proventos_fiis(book, years))
+        run('collect_us_dividends', lambda: ir.collect_us_dividends(book, years, bid_quotes_by_month_by_year))
+        run('collect_bonificacoes', lambda: ir.collect_bonificacoes(book, years))
+
+        # a fresh in-memory checkpoints database per run replays everything, the shared one measures reusing positions
+        run('full_report', lambda: full_report(book, years, quotes_by_date, quotes_csv_path, open_checkpoints(':memory:')))
+        checkpoints = open_checkpoints(':memory:')
+        full_report(book, years, quotes_by_date, quotes_csv_path, checkpoints)
+        run('full_report_checkpointed', lambda: full_report(book, years, quotes_by_date, quotes_csv_path, checkpoints))
+
+    return {'sales': len(all_sales), 'timings': timings}
+
+
+def append_results(results_path, run):
+    runs = []
+    if os.path.exists(results_path):
+        with open(results_path) as results_file:
+            runs = json.load(results_file)
+
+    runs.append(run)
+    with open(results_path, 'w') as results_file:
+        json.dump(runs, results_file, indent=2)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Times the ir.py collectors on synthetic books')
+    parser.add_argument('--splits', type=int, nargs='+', default=[10000, 100000], help='sizes of the books to benchmark')
+    parser.add_argument('--years', type=ir.parse_years, default=ir.parse_years('2024'), help='year or range of years reported, the books cover 2015-2024')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--data-dir', default=DATA_DIR, help='where the synthetic books are kept')
+    parser.add_argument('--output', help='json file the results are appended to, defaults to results.json in --data-dir')
+
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    years = arguments.years
+
+    run = {
+        'commit': current_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'years': [years[0], years[-1]],
+        'repeat': arguments.repeat,
+        'books': {}
+    }
+
+    for split_count in arguments.splits:
+        gnucash_db_path, quotes_csv_path = ensure_book(arguments.data_dir, split_count, arguments.seed)
+        print('benchmarking {}'.format(gnucash_db_path), file=sys.stderr)
+        run['books'][str(split_count)] = benchmark_book(gnucash_db_path, quotes_csv_path, years, arguments.repeat)
+
+    for split_count, book_results in run['books'].items():
+        print('{} splits'.format(split_count))
+        for name, timing in book_results['timings'].items():
+            print('  {:<36} {:>10.3f}s'.format(name, timing['min']))
+
+    results_path = arguments.output or os.path.join(arguments.data_dir, 'results.json')
+    append_results(results_path, run)
+    print('results appended to {}'.format(results_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import csv
+import json
+import random
+import sqlite3
+
+from decimal import Decimal
+from datetime import date, datetime, timedelta
+from piecash import create_book, Account, Commodity
+
+# share of the events of each kind, the rest are purchases and sales
+INCOME_SHARE = 0.08
+STOCK_SPLIT_SHARE = 0.01
+BONIFICACAO_SHARE = 0.005
+WIRE_SHARE = 0.005
+PURCHASE_SHARE = 0.6
+
+
+def new_guid(rng):
+    # guids come from the seeded generator too, so the same seed always gives the same book
+    return '{:032x}'.format(rng.getrandbits(128))
+
+
+def business_days(first_day, last_day):
+    day = first_day
+    while day <= last_day:
+        if day.weekday() < 5:
+            yield day
+        day += timedelta(days=1)
+
+
+def write_quotes(quotes_csv_path, first_day, last_day, rng):
+    # same layout as the PTAX history in usdbrl.csv, with a random walk for the rate and a few missing days as holidays
+    quote_days = []
+    bid = Decimal('4.0000')
+    with open(quotes_csv_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file, delimiter=';')
+        writer.writerow(['data', 'cod', 'tipo', 'moeda', 'compra', 'venda', 'a', 'b'])
+        for day in business_days(first_day, last_day):
+            if rng.random() < 0.03:
+                continue
+
+            bid = max(Decimal('1.5'), bid + Decimal(rng.randint(-300, 300)).scaleb(-4))
+            ask = bid + Decimal('0.0006')
+            writer.writerow([day.strftime('%d%m%Y'), '220', 'A', 'USD', str(bid).replace('.', ','), str(ask).replace('.', ','), '1,0000', '1,0000'])
+            quote_days.append(day)
+
+    return quote_days
+
+
+def create_accounts(book, tickers, rng):
+    brl = book.default_currency
+    usd = book.currencies(mnemonic='USD')
+
+    def account(name, type, parent, commodity, description=None, placeholder=False):
+        return Account(name=name, type=type, parent=parent, commodity=commodity, description=description, placeholder=placeholder)
+
+    ativos = account('Ativos', 'ASSET', book.root_account, brl, placeholder=True)
+    investimentos = account('Investimentos', 'ASSET', ativos, brl, placeholder=True)
+    acoes = account('Ações', 'ASSET', investimentos, brl, placeholder=True)
+    fiis = account('FIIs', 'ASSET', investimentos, brl, placeholder=True)
+    exterior = account('Ações no exterior', 'ASSET', investimentos, usd, placeholder=True)
+    crypto = account('Crypto', 'ASSET', investimentos, brl, placeholder=True)
+    account('Conta no Inter', 'BANK', ativos, brl)
+    account('Conta no Charles Schwab', 'BANK', ativos, usd)
+
+    receitas = account('Receitas', 'INCOME', book.root_account, brl, placeholder=True)
+    dividendos = account('Dividendos', 'INCOME', receitas, brl, placeholder=True)
+    jcp = account('JCP', 'INCOME', receitas, brl, placeholder=True)
+    receita_fiis = account('Receita de FIIs', 'INCOME', receitas, brl, placeholder=True)
+    us_dividends = account('US Dividends', 'INCOME', receitas, usd, placeholder=True)
+    account('Bonificações', 'INCOME', receitas, brl)
+
+    despesas = account('Despesas', 'EXPENSE', book.root_account, brl, placeholder=True)
+    account('IOF de remessas internacionais', 'EXPENSE', despesas, brl)
+    account('B3', 'EXPENSE', despesas, brl)
+
+    # one ticker of each market in turn, with income accounts named after it like in the real book
+    for index in range(tickers):
+        market = index % 4
+        if market == 0:
+            name = 'BRST{:03d}'.format(index)
+            # bdrs are left out, their sales are not supported by the replay
+            metadata = {'type': rng.choice(['acao', 'acao', 'etf']), 'cnpj': '00.000.{:03d}/0001-00'.format(index), 'long_name': 'Empresa {}'.format(name)}
+            commodity = Commodity(mnemonic=name, fullname=name, fraction=1, namespace='BVMF', book=book)
+            account(name, 'STOCK', acoes, commodity, json.dumps(metadata))
+            account(name, 'INCOME', dividendos, brl)
+            account(name, 'INCOME', jcp, brl)
+        elif market == 1:
+            name = 'FIIS{:03d}'.format(index)
+            metadata = {'type': 'fii', 'cnpj': '11.111.{:03d}/0001-00'.format(index), 'long_name': 'Fundo {}'.format(name)}
+            commodity = Commodity(mnemonic=name, fullname=name, fraction=1, namespace='BVMF', book=book)
+            account(name, 'STOCK', fiis, commodity, json.dumps(metadata))
+            account(name, 'INCOME', receita_fiis, brl, json.dumps({'fonte_pagadora': metadata['cnpj'], 'long_name': metadata['long_name']}))
+        elif market == 2:
+            name = 'USST{:03d}'.format(index)
+            metadata = {'type': rng.choice(['us stock', 'us stock', 'us etf', 'reit']), 'long_name': 'Company {}'.format(name)}
+            commodity = Commodity(mnemonic=name, fullname=name, fraction=1, namespace='NYSE', book=book)
+            account(name, 'STOCK', exterior, commodity, json.dumps(metadata))
+            account(name, 'INCOME', us_dividends, usd)
+        else:
+            name = 'COIN{:03d}'.format(index)
+            metadata = {'type': rng.choice(['btc', 'crypto']), 'long_name': 'Coin {}'.format(name)}
+            commodity = Commodity(mnemonic=name, fullname=name, fraction=100000000, namespace='CRYPTO', book=book)
+            account(name, 'STOCK', crypto, commodity, json.dumps(metadata))
+
+
+class Ticker:
+
+    def __init__(self, guid, market, income_guids, price):
+        self.guid = guid
+        self.market = market
+        self.income_guids = income_guids
+        self.price = price
+        self.quantity = 0
+
+
+def load_tickers(book, rng):
+    income_parents = {'Ações': ['Dividendos', 'JCP'], 'FIIs': ['Receita de FIIs'], 'Ações no exterior': ['US Dividends'], 'Crypto': []}
+    markets = {'Ações': 'br', 'FIIs': 'br', 'Ações no exterior': 'us', 'Crypto': 'crypto'}
+
+    tickers = []
+    for parent_name, income_names in income_parents.items():
+        for stock_account in book.accounts(name=parent_name).children:
+            income_guids = [book.accounts(name=income_name).children(name=stock_account.name).guid for income_name in income_names]
+            tickers.append(Ticker(stock_account.guid, markets[parent_name], income_guids, Decimal(rng.randint(1000, 20000)).scaleb(-2)))
+
+    return tickers
+
+
+def generate_splits(tickers, trading_days, events, guids, rng):
+    # events are spread evenly over the trading days, so positions never go negative and every split has a quote
+    transactions = []
+    splits = []
+
+    def add_transaction(day, currency_guid, description, legs):
+        transaction_guid = new_guid(rng)
+        entered = datetime.combine(day, datetime.min.time()) + timedelta(hours=12, seconds=len(transactions) % 40000)
+        transactions.append((transaction_guid, currency_guid, '', day.strftime('%Y-%m-%d 10:59:00'), entered.strftime('%Y-%m-%d %H:%M:%S'), description))
+        for account_guid, value_num, quantity_num, quantity_denom, action in legs:
+            splits.append((new_guid(rng), transaction_guid, account_guid, '', action, 'n', None, value_num, 100, quantity_num, quantity_denom, None))
+
+    for event in range(events):
+        day = trading_days[event * len(trading_days) // events]
+        ticker = rng.choice(tickers)
+        ticker.price = max(Decimal('0.5'), ticker.price * Decimal(rng.randint(950, 1050)) / 1000).quantize(Decimal('0.01'))
+
+        is_us = ticker.market == 'us'
+        currency_guid = guids['USD'] if is_us else guids['BRL']
+        cash_guid = guids['Conta no Charles Schwab'] if is_us else guids['Conta no Inter']
+        quantity_denom = 100000000 if ticker.market == 'crypto' else 1
+
+        kind = rng.random()
+        if kind < INCOME_SHARE and ticker.income_guids:
+            value = rng.randint(100, 50000)
+            income_guid = rng.choice(ticker.income_guids)
+            add_transaction(day, currency_guid, 'Provento', [(income_guid, -value, -value, 100, ''), (cash_guid, value, value, 100, '')])
+            continue
+
+        kind -= INCOME_SHARE
+        if kind < STOCK_SPLIT_SHARE and ticker.quantity > 0:
+            add_transaction(day, currency_guid, 'Desdobramento', [(ticker.guid, 0, ticker.quantity, quantity_denom, 'Split')])
+            ticker.quantity *= 2
+            continue
+
+        kind -= STOCK_SPLIT_SHARE
+        if kind < BONIFICACAO_SHARE:
+            value = rng.randint(100, 5000)
+            add_transaction(day, guids['BRL'], 'Bonificação', [(guids['Bonificações'], -value, -value, 100, ''), (guids['Conta no Inter'], value, value, 100, '')])
+            continue
+
+        kind -= BONIFICACAO_SHARE
+        if kind < WIRE_SHARE:
+            usd_value = rng.randint(10000, 1000000)
+            brl_value = usd_value * 5
+            add_transaction(day, guids['BRL'], 'Wire funds received', [(guids['Conta no Charles Schwab'], brl_value, usd_value, 100, ''), (guids['Conta no Inter'], -brl_value, -brl_value, 100, '')])
+            continue
+
+        if rng.random() < PURCHASE_SHARE or ticker.quantity == 0:
+            quantity = rng.randint(1, 100) * (rng.randint(1, 1000000) if ticker.market == 'crypto' else 1)
+            value = int(ticker.price * 100 * quantity / quantity_denom) or 1
+            add_transaction(day, currency_guid, 'Compra', [(ticker.guid, value, quantity, quantity_denom, ''), (cash_guid, -value, -value, 100, '')])
+            ticker.quantity += quantity
+        else:
+            quantity = ticker.quantity if rng.random() < 0.2 else rng.randint(1, ticker.quantity)
+            value = int(ticker.price * 100 * quantity / quantity_denom) or 1
+            add_transaction(day, currency_guid, 'Venda', [(ticker.guid, -value, -quantity, quantity_denom, ''), (cash_guid, value, value, 100, '')])
+            ticker.quantity -= quantity
+
+    return transactions, splits
+
+
+def build_book(gnucash_db_path, quotes_csv_path, split_count, first_year=2015, last_year=2024, seed=1):
+    """Creates a sqlite GnuCash book with about split_count splits between first_year and last_year, with the account tree and
+    metadata ir.py expects, and a PTAX quotes file covering it."""
+    rng = random.Random(seed)
+    first_day = date(first_year, 1, 1)
+    last_day = date(last_year, 12, 31)
+
+    # dividends of January are converted with the quote of the first half of the previous December
+    quote_days = write_quotes(quotes_csv_path, first_day - timedelta(days=40), last_day, rng)
+    trading_days = [day for day in quote_days if day >= first_day]
+
+    book = create_book(gnucash_db_path, currency='BRL', overwrite=True)
+    create_accounts(book, max(8, min(500, split_count // 200)), rng)
+    book.save()
+
+    tickers = load_tickers(book, rng)
+    guids = {name: book.accounts(name=name).guid for name in ['Conta no Inter', 'Conta no Charles Schwab', 'Bonificações']}
+    guids['BRL'] = book.default_currency.guid
+    guids['USD'] = book.currencies(mnemonic='USD').guid
+    book.close()
+
+    # piecash would take hours to create a million splits, so they go straight into the tables
+    transactions, splits = generate_splits(tickers, trading_days, split_count // 2, guids, rng)
+    connection = sqlite3.connect(gnucash_db_path)
+    with connection:
+        connection.executemany('INSERT INTO transactions (guid, currency_guid, num, post_date, enter_date, description) VALUES (?, ?, ?, ?, ?, ?)', transactions)
+        connection.executemany('INSERT INTO splits (guid, tx_guid, account_guid, memo, action, reconcile_state, reconcile_date, value_num, value_denom, quantity_num, quantity_denom, lot_guid) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', splits)
+    connection.close()
@@ -0,0 +1,129 @@
+import os
+import json
+import sqlite3
+
+from decimal import Decimal
+from datetime import date, timedelta
+
+# bump it whenever the replay in ir.py changes, so positions computed by older versions are not reused
+CHECKPOINT_VERSION = 1
+
+POSITION_DECIMAL_FIELDS = ['quantity', 'price_avg', 'value_purchases', 'quantity_purchases', 'brl_price_avg', 'brl_value_purchases']
+
+
+def checkpoints_path(gnucash_db_path):
+    return gnucash_db_path + '.ir-checkpoints'
+
+
+def open_checkpoints(path):
+    connection = sqlite3.connect(path)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            account_guid TEXT NOT NULL,
+            context TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL,
+            position TEXT NOT NULL,
+            PRIMARY KEY (account_guid, context, year)
+        )""")
+
+    return connection
+
+
+def checkpoint_context(quotes_csv_path=None):
+    # positions of US stocks carry BRL averages, so they are only valid for the quotes file they were computed with
+    if quotes_csv_path is None:
+        return 'v{}'.format(CHECKPOINT_VERSION)
+
+    stat = os.stat(quotes_csv_path)
+    return 'v{}:usdbrl:{}:{}'.format(CHECKPOINT_VERSION, stat.st_size, stat.st_mtime_ns)
+
+
+def encode_position(position):
+    encoded = {field: str(position[field]) for field in POSITION_DECIMAL_FIELDS}
+
+    last_transaction_date = position['last_transaction_date']
+    encoded['last_transaction_date'] = last_transaction_date.isoformat() if last_transaction_date is not None else None
+
+    return json.dumps(encoded)
+
+
+def decode_position(encoded):
+    raw = json.loads(encoded)
+    position = {field: Decimal(raw[field]) for field in POSITION_DECIMAL_FIELDS}
+
+    last_transaction_date = raw['last_transaction_date']
+    position['last_transaction_date'] = date.fromisoformat(last_transaction_date) if last_transaction_date is not None else None
+
+    return position
+
+
+def fingerprint_at(fingerprints_by_year, year):
+    # years without splits keep the fingerprint of the last year that had any
+    found = ''
+    for fingerprint_year in sorted(fingerprints_by_year):
+        if fingerprint_year > year:
+            break
+
+        found = fingerprints_by_year[fingerprint_year]
+
+    return found
+
+
+class YearEndPositions:
+    """Year-end positions of a group of accounts replayed together.
+
+    fingerprints maps each account guid to the cumulative digest of its splits at the end of every year before
+    minimum_date that had splits. A stored position is only used while the digest it was saved with still matches, so
+    editing, adding or removing an older split invalidates it and every position after it.
+    """
+
+    def __init__(self, connection, context, fingerprints, minimum_date):
+        self.connection = connection
+        self.context = context
+        self.fingerprints = fingerprints
+        self.minimum_date = minimum_date
+
+        self.stored = {}
+        rows = connection.execute('SELECT account_guid, year, fingerprint, position FROM checkpoints WHERE context = ? AND year < ?', (context, minimum_date.year))
+        for account_guid, year, fingerprint, position in rows:
+            self.stored.setdefault(account_guid, {})[year] = (fingerprint, position)
+
+        self.checkpoints = {}
+
+    def checkpoint(self, account):
+        if account.guid in self.checkpoints:
+            return self.checkpoints[account.guid]
+
+        found = None
+        fingerprints_by_year = self.fingerprints.get(account.guid, {})
+        stored = self.stored.get(account.guid, {})
+        for year in sorted(stored, reverse=True):
+            fingerprint, position = stored[year]
+            if fingerprint == fingerprint_at(fingerprints_by_year, year):
+                found = (date(year, 12, 31), decode_position(position))
+                break
+
+        self.checkpoints[account.guid] = found
+        return found
+
+    def resume_date(self, accounts):
+        # the earliest date after which every account can resume, or None if some account has to be replayed from the start
+        dates = []
+        for account in accounts:
+            checkpoint = self.checkpoint(account)
+            if checkpoint is not None:
+                dates.append(checkpoint[0])
+            elif self.fingerprints.get(account.guid):
+                return None
+
+        return min(dates) if dates else self.minimum_date - timedelta(days=1)
+
+    def year_end_handler(self, account):
+        fingerprints_by_year = self.fingerprints.get(account.guid, {})
+
+        def save(year, position):
+            self.connection.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)',
+                (account.guid, self.context, year, fingerprint_at(fingerprints_by_year, year), encode_position(position)))
+
+        return save
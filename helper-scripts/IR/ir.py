@@ -1,12 +1,27 @@
+import os
 import sys
 import pprint
+import argparse
+import calendar
 
-import csv
 import json
+import hashlib
 
+from collections import namedtuple
 from decimal import Decimal
-from datetime import date
-from piecash import open_book, ledger
+from datetime import date, timedelta
+import numpy as np
+from piecash import open_book, ledger, Account, Commodity, Price, Split, Transaction
+from sqlalchemy import String, select, type_coerce
+from checkpoints import YearEndPositions, checkpoint_context, checkpoints_path, open_checkpoints
+from metadata import INVESTMENT_PARENTS, load_account_metadata
+from quotes import retrieve_usdbrl_quotes
+from valuation import PriceIndex, market_values
+
+# profiling.py and worker_pool.py are shared with the importers one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from profiling import Profiler, count_rows, default_trace_path, phase
+from worker_pool import map_in_pool
 
 pp = pprint.PrettyPrinter(indent=2)
 
@@ -20,293 +35,577 @@ TAX_EXEMPT_SALE_DOMESTIC_LIMIT = 20000
 # 25/05/2024 - bug: quando há um reverse split (agrupamento), o script diminui o valor total de aquisição. O valor total de aquisição deveria se manter constante, pois nenhuma ação foi vendida nesse caso.
 # Exemplo: IRS - o valor total de aquisição em dólares parece correto, mas o calculado em reais diminui
 
-def extract_metadata(account):
-    try:
-        metadata = json.loads(account.description)
-    except:
-        raise Exception("Metadata JSON could not be read for {}".format(account.name))
 
-    if metadata is None or not 'type' in metadata:
-        raise Exception("The type field not found for {}".format(account.name))
+# how sales of each category are taxed. Sales of exempt_types in a month whose total sales stay below exempt_limit
+# are declared as exempt (only the profitable ones when exempt_only_profits), the rest is taxed month by month
+SALE_RULES = {
+    'acoes+etfs': {
+        'types': ['acao', 'etf'],
+        'exempt_types': ['acao'],
+        'exempt_only_profits': True,
+        'exempt_limit': TAX_EXEMPT_SALE_DOMESTIC_LIMIT,
+        'tax_multiplier': ACOES_ETF_TAX_MULTIPLIER,
+        'dedo_duro_multiplier': DEDO_DURO_MULTIPLIER
+    },
+    'us': {
+        'types': ['us stock', 'us etf', 'reit'],
+        'exempt_types': ['us stock', 'us etf', 'reit'],
+        'exempt_only_profits': False,
+        'exempt_limit': TAX_EXEMPT_SALE_FOREIGN_LIMIT,
+        'tax_multiplier': ACOES_ETF_TAX_MULTIPLIER,
+        'dedo_duro_multiplier': None
+    },
+    'fiis': {
+        'types': ['fii'],
+        'exempt_types': [],
+        'exempt_only_profits': False,
+        'exempt_limit': None,
+        'tax_multiplier': FII_TAX_MULTIPLIER,
+        'dedo_duro_multiplier': DEDO_DURO_MULTIPLIER
+    }
+}
 
-    if metadata['type'] not in ['etf', 'acao', 'bdr', 'fii', 'us stock', 'us etf', 'reit', 'btc', 'crypto']:
-        raise Exception("The type for {} is not valid".format(account.name))
+SALE_CATEGORY_BY_TYPE = {sale_type: category for category, rules in SALE_RULES.items() for sale_type in rules['types']}
 
-    ir_group_dict = {'etf': 7, 'us etf': 7, 'fii': 7, 'acao': 3, 'bdr': 4, 'us stock': 3, 'reit': 3, 'btc': 8, 'crypto': 8}
-    metadata['grupo_bem_direito'] = ir_group_dict[metadata['type']]
 
-    ir_code_dict = {'etf': 9, 'us etf': 9, 'fii': 3, 'acao': 1, 'bdr': 4, 'us stock': 1, 'reit': 1, 'btc': 1, 'crypto': 2}
-    metadata['codigo_bem_direito'] = ir_code_dict[metadata['type']]
+def group_sales(sales):
+    groups = {}
+    for sale in sales:
+        sale_type = sale['type']
+        category = SALE_CATEGORY_BY_TYPE.get(sale_type)
+        if category is None:
+            raise Exception("Unexpected flow", sale)
+
+        key = (category, sale['date'].month)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {
+                'total_sales': Decimal(0),
+                'exemptable_sales': Decimal(0),
+                'exemptable_profits': Decimal(0),
+                'taxable_sales': Decimal(0),
+                'taxable_profits': Decimal(0)
+            }
 
-    return metadata
+        rules = SALE_RULES[category]
+        sold_value = -sale['value']
+        group['total_sales'] += sold_value
+        if sale_type in rules['exempt_types'] and (sale['is_profit'] or not rules['exempt_only_profits']):
+            group['exemptable_sales'] += sold_value
+            group['exemptable_profits'] += sale['profit']
+        else:
+            group['taxable_sales'] += sold_value
+            group['taxable_profits'] += sale['profit']
 
+    return groups
 
-def is_us_sale(sale):
-    return sale['type'] in ['us stock', 'us etf', 'reit']
 
+def empty_month(rules):
+    month = {'aggregated_profits': Decimal(0), 'total_sales': Decimal(0)}
+    if rules['dedo_duro_multiplier'] is not None:
+        month['dedo_duro'] = Decimal(0)
+    month['imposto'] = Decimal(0)
 
-def is_br_acao_sale(sale):
-    return sale['type'] in ['acao', 'etf']
+    return month
 
 
-def add_taxes(sales_info):
-    for i in range(1, 13):
-        acoes_etfs = sales_info['monthly']['acoes+etfs'][i]
-        us = sales_info['monthly']['us'][i]
-        fiis = sales_info['monthly']['fiis'][i]
+def extract_sales_info(sales):
+    # a single pass groups the sales by category and month, then the rules are applied once per group
+    monthly = {category: {i: empty_month(rules) for i in range(1, 13)} for category, rules in SALE_RULES.items()}
+    exempt_sales = {category: Decimal(0) for category in SALE_RULES}
+    exempt_profits = {category: Decimal(0) for category in SALE_RULES}
+
+    for (category, month), group in sorted(group_sales(sales).items()):
+        rules = SALE_RULES[category]
+        current = monthly[category][month]
+
+        has_surpassed_limit = rules['exempt_limit'] is not None and group['total_sales'] >= rules['exempt_limit']
+        taxed_sales = group['taxable_sales']
+        taxed_profits = group['taxable_profits']
+        if has_surpassed_limit:
+            taxed_sales += group['exemptable_sales']
+            taxed_profits += group['exemptable_profits']
+        else:
+            exempt_sales[category] += group['exemptable_sales']
+            exempt_profits[category] += group['exemptable_profits']
+
+        current['total_sales'] = group['total_sales']
+        current['aggregated_profits'] = taxed_profits
+        if rules['dedo_duro_multiplier'] is not None and taxed_sales != 0:
+            current['dedo_duro'] = taxed_sales * rules['dedo_duro_multiplier']
+        if taxed_profits > 0:
+            current['imposto'] = taxed_profits * rules['tax_multiplier']
+
+    acoes_sales_value = exempt_sales['acoes+etfs']
+    acoes_dedo_duro = acoes_sales_value * SALE_RULES['acoes+etfs']['dedo_duro_multiplier']
+
+    return {
+        'aggregated': {
+            'us': {
+                'aggregated_profits': exempt_profits['us'],
+                'sales_value': exempt_sales['us']
+            },
+            'acoes': {
+                'aggregated_profits': exempt_profits['acoes+etfs'] - acoes_dedo_duro,
+                'dedo_duro': acoes_dedo_duro,
+                'acoes_sales_value': acoes_sales_value
+            }
+        },
+        'monthly': {
+            'fiis': monthly['fiis'],
+            'acoes+etfs': monthly['acoes+etfs'],
+            'us': monthly['us']
+        }
+    }
 
-        if acoes_etfs['aggregated_profits'] > 0:
-            acoes_etfs['imposto'] = acoes_etfs['aggregated_profits'] * ACOES_ETF_TAX_MULTIPLIER
 
-        if us['aggregated_profits'] > 0:
-            us['imposto'] = us['aggregated_profits'] * ACOES_ETF_TAX_MULTIPLIER
+SplitRow = namedtuple('SplitRow', ['account_guid', 'transaction_guid', 'post_date', 'value', 'quantity', 'action', 'currency'])
 
-        if fiis['aggregated_profits'] > 0:
-            fiis['imposto'] = fiis['aggregated_profits'] * FII_TAX_MULTIPLIER
 
+def date_reader(book, column):
+    # converting dates is most of the cost of reading splits and prices and a book has far fewer distinct dates than
+    # rows, so the raw column value is converted once per distinct value with the same processor SQLAlchemy would use
+    dialect = book.session.bind.dialect
+    convert = column.type.dialect_impl(dialect).result_processor(dialect, None)
+    converted = {}
+
+    def read(raw_date):
+        read_date = converted.get(raw_date)
+        if read_date is None:
+            read_date = converted[raw_date] = convert(raw_date)
+
+        return read_date
 
-def extract_sales_info(sales):
-    sales_info = {
-            'aggregated': {
-                'us': {
-                    'aggregated_profits': Decimal(0)
-                    },
-                'acoes': {
-                    'aggregated_profits': Decimal(0),
-                    'dedo_duro': Decimal(0)
-                    }
-                },
-            'monthly': {
-                'fiis': {},
-                'acoes+etfs': {},
-                'us': {}
+    return read
+
+
+def post_date_reader(book):
+    return date_reader(book, Transaction.__table__.c.post_date)
+
+
+def raw_post_date():
+    return type_coerce(Transaction.post_date, String)
+
+
+def query_split_rows(book):
+    # plain columns instead of ORM objects, so the splits and their transactions come back in a single joined query
+    return (book.session.query(
+                Split.account_guid,
+                Split.transaction_guid,
+                raw_post_date(),
+                Split._value_num,
+                Split._value_denom,
+                Split._quantity_num,
+                Split._quantity_denom,
+                Split.action,
+                Commodity.mnemonic)
+            .join(Transaction, Split.transaction_guid == Transaction.guid)
+            .join(Commodity, Transaction.currency_guid == Commodity.guid)
+            .order_by(Transaction.post_date, Transaction.enter_date, Split.guid))
+
+
+def to_split_row(row, read_post_date):
+    account_guid, transaction_guid, raw_post_date, value_num, value_denom, quantity_num, quantity_denom, action, currency = row
+    post_date = read_post_date(raw_post_date)
+
+    # same conversion piecash does for Split.value and Split.quantity
+    value = Decimal(value_num) / value_denom
+    quantity = Decimal(quantity_num) / quantity_denom
+
+    return SplitRow(account_guid, transaction_guid, post_date, value, quantity, action, currency)
+
+
+# post dates written by older GnuCash versions are shifted by the timezone, so SQL date filters keep a margin and the
+# exact comparison is done on the converted dates
+POST_DATE_MARGIN = timedelta(days=2)
+
+
+def load_splits_by_account(book, parents, since=None):
+    splits_by_account = {}
+    for parent in parents:
+        for account in parent.children:
+            splits_by_account[account.guid] = []
+
+    query = (query_split_rows(book)
+             .join(Account, Split.account_guid == Account.guid)
+             .filter(Account.parent_guid.in_([parent.guid for parent in parents])))
+    if since is not None:
+        query = query.filter(Transaction.post_date > since - POST_DATE_MARGIN)
+
+    read_post_date = post_date_reader(book)
+    rows = 0
+    for row in query:
+        rows += 1
+        split = to_split_row(row, read_post_date)
+        if since is None or split.post_date > since:
+            splits_by_account[split.account_guid].append(split)
+
+    count_rows(rows)
+    return splits_by_account
+
+
+def fingerprint_splits_by_year(book, parents, before_date):
+    # the splits of each account are bucketed by the same converted post date the replay uses, so a year's fingerprint
+    # covers exactly the splits replayed up to its checkpoint, and hashed in guid order so equal data gives equal digests
+    query = (book.session.query(
+                Split.account_guid,
+                Split.guid,
+                raw_post_date(),
+                type_coerce(Transaction.enter_date, String),
+                Split._value_num,
+                Split._value_denom,
+                Split._quantity_num,
+                Split._quantity_denom,
+                Split.action)
+             .join(Transaction, Split.transaction_guid == Transaction.guid)
+             .join(Account, Split.account_guid == Account.guid)
+             .filter(Account.parent_guid.in_([parent.guid for parent in parents]))
+             .filter(Transaction.post_date < before_date + POST_DATE_MARGIN)
+             .order_by(Split.account_guid, Split.guid))
+
+    read_post_date = post_date_reader(book)
+    contents = {}
+    rows = 0
+    for account_guid, guid, raw_post, raw_enter, value_num, value_denom, quantity_num, quantity_denom, action in query:
+        rows += 1
+        post_date = read_post_date(raw_post)
+        if post_date < before_date:
+            content = '{}{}{}{}/{}:{}/{}:{};'.format(guid, raw_post, raw_enter, value_num, value_denom, quantity_num, quantity_denom, action)
+            contents.setdefault(account_guid, {}).setdefault(post_date.year, []).append(content)
+
+    count_rows(rows)
+
+    # cumulative digest of every account's splits at the end of each year that had any
+    fingerprints = {}
+    for account_guid, contents_by_year in contents.items():
+        hasher = hashlib.sha1()
+        for year in sorted(contents_by_year):
+            hasher.update(''.join(contents_by_year[year]).encode())
+            fingerprints.setdefault(account_guid, {})[year] = hasher.hexdigest()
+
+    return fingerprints
+
+
+def prepare_replay(book, parents, minimum_date, checkpoints=None, context=None):
+    children = []
+    for parent in parents:
+        children += parent.children
+
+    positions = None
+    since = None
+    if checkpoints is not None:
+        fingerprints = fingerprint_splits_by_year(book, parents, minimum_date)
+        positions = YearEndPositions(checkpoints, context, fingerprints, minimum_date)
+        since = positions.resume_date(children)
+
+    splits_by_account = load_splits_by_account(book, parents, since)
+
+    return children, splits_by_account, positions
+
+
+def sorted_splits_by_date(book, account):
+    query = query_split_rows(book).filter(Split.account_guid == account.guid)
+    read_post_date = post_date_reader(book)
+    splits = [to_split_row(row, read_post_date) for row in query]
+
+    count_rows(len(splits))
+    return splits
+
+
+def replay_account(account, metadata, splits, years, quotes_by_date=None, is_us=False, checkpoint=None, on_year_end=None):
+    # years is a range of consecutive report years, each gets the position held on its Dec 31, its sales and whether the
+    # account was held at some point during it
+    minimum_date = date(years[0], 1, 1)
+    date_filter = date(years[-1], 12, 31)
+
+    results = {}
+    sales = []
+    held_during_filtered_period = False
+
+    brl_price_avg = Decimal(0)
+    brl_value_purchases = Decimal(0)
+
+    quantity = Decimal(0)
+    price_avg = Decimal(0)
+    value_purchases = Decimal(0)
+    quantity_purchases = Decimal(0)
+    transaction_date = None
+
+    # years before minimum_date are replayed the same way whatever the year being reported, so their closing positions can be reused
+    checkpoint_date = None
+    next_year_end = None
+    if checkpoint is not None:
+        checkpoint_date, position = checkpoint
+        quantity = position['quantity']
+        price_avg = position['price_avg']
+        value_purchases = position['value_purchases']
+        quantity_purchases = position['quantity_purchases']
+        brl_price_avg = position['brl_price_avg']
+        brl_value_purchases = position['brl_value_purchases']
+        transaction_date = position['last_transaction_date']
+
+        # positions sold out before the checkpoint were already dropped from the held set while replaying it
+        held_during_filtered_period = quantity != 0
+        next_year_end = checkpoint_date.year + 1
+
+    def close_years(until_year):
+        nonlocal next_year_end
+        if on_year_end is None or next_year_end is None:
+            return
+
+        while next_year_end < min(until_year, minimum_date.year):
+            on_year_end(next_year_end, {
+                'quantity': quantity,
+                'price_avg': price_avg,
+                'value_purchases': value_purchases,
+                'quantity_purchases': quantity_purchases,
+                'brl_price_avg': brl_price_avg,
+                'brl_value_purchases': brl_value_purchases,
+                'last_transaction_date': transaction_date
+            })
+            next_year_end += 1
+
+    def close_report_years(until_year):
+        nonlocal sales, held_during_filtered_period
+        for year in years:
+            if year in results or year >= until_year:
+                continue
+
+            if quantity < 0:
+                raise Exception("The stock {} has a negative quantity {}!".format(account.name, quantity))
+
+            bem = None
+            if quantity > 0:
+                bem = {
+                        'name': account.name,
+                        'quantity': quantity,
+                        'value': price_avg * quantity,
+                        'price_avg': price_avg,
+                        'value_purchases': value_purchases,
+                        'quantity_purchases': quantity_purchases,
+                        'last_transaction_date': transaction_date,
+                        'metadata': metadata
                 }
-    }
 
-    for i in range(1, 13):
-        sales_info['monthly']['acoes+etfs'][i] = {'aggregated_profits': Decimal(0), 'total_sales': Decimal(0), 'dedo_duro': Decimal(0), 'imposto': Decimal(0)}
-        sales_info['monthly']['us'][i] = {'aggregated_profits': Decimal(0), 'total_sales': Decimal(0), 'imposto': Decimal(0)}
-        sales_info['monthly']['fiis'][i] = {'aggregated_profits': Decimal(0), 'total_sales': Decimal(0), 'dedo_duro': Decimal(0), 'imposto': Decimal(0)}
+                if is_us:
+                    bem['brl_value'] = brl_price_avg * quantity
+                    bem['brl_price_avg'] = brl_price_avg
+                    bem['brl_value_purchases'] = brl_value_purchases
 
-    # calculating the total monthly sales
-    for sale in sales:
-        month = sale['date'].month
-        if is_br_acao_sale(sale):
-            sales_info['monthly']['acoes+etfs'][month]['total_sales'] += -sale['value']
-        elif is_us_sale(sale):
-            sales_info['monthly']['us'][month]['total_sales'] += -sale['value']
-
-    # calculating the rest
-    acoes_aggregated_profits = Decimal(0)
-    acoes_sales_value = Decimal(0)
-    us_sales_value = Decimal(0)
-    us_aggregated_profits = Decimal(0)
-    for sale in sales:
-        month = sale['date'].month
+            results[year] = (bem, sales, held_during_filtered_period)
 
-        if is_us_sale(sale):
-            current_us = sales_info['monthly']['us'][month]
+            # whatever happened before a year, it starts held only if there is still something in the position
+            sales = []
+            held_during_filtered_period = quantity != 0
 
-            has_surpassed_limit = current_us['total_sales'] >= TAX_EXEMPT_SALE_FOREIGN_LIMIT
-            if has_surpassed_limit:
-                current_us['aggregated_profits'] += sale['profit']
-            else:
-                us_sales_value += -sale['value']
-                us_aggregated_profits += sale['profit']
+    for split in splits:
+        if checkpoint_date is not None and split.post_date <= checkpoint_date:
+            continue
+
+        if next_year_end is None:
+            next_year_end = split.post_date.year
+        close_years(split.post_date.year)
+
+        if split.post_date < minimum_date:
+            held_during_filtered_period = True
+        elif split.post_date <= date_filter:
+            close_report_years(split.post_date.year)
+            held_during_filtered_period = True
         else:
-            current_acoes_etf = sales_info['monthly']['acoes+etfs'][month]
-            has_surpassed_limit = current_acoes_etf['total_sales'] >= TAX_EXEMPT_SALE_DOMESTIC_LIMIT
-
-            if sale['type'] == 'etf' or sale['type'] == 'acao' and (has_surpassed_limit or not sale['is_profit']):
-                current_acoes_etf['aggregated_profits'] += sale['profit']
-                current_acoes_etf['dedo_duro'] += -sale['value'] * DEDO_DURO_MULTIPLIER
-            elif sale['type'] == 'acao' and sale['is_profit']:
-                acoes_sales_value += -sale['value']
-                acoes_aggregated_profits += sale['profit']
-            elif sale['type'] == 'fii':
-                current = sales_info['monthly']['fiis'][month]
-
-                current['aggregated_profits'] += sale['profit']
-                current['dedo_duro'] += -sale['value'] * DEDO_DURO_MULTIPLIER
-                current['total_sales'] += -sale['value']
+            continue
+
+        quantity += Decimal(split.quantity)
+        transaction_date = split.post_date
+
+        is_stock_split = split.value == 0 and split.action == 'Split'
+        if split.value > 0 or is_stock_split:
+            value_purchases += Decimal(split.value)
+            quantity_purchases += Decimal(split.quantity)
+            price_avg = value_purchases/quantity_purchases
+
+            if is_us and quotes_by_date is not None:
+                day_ask_usdbrl = quotes_by_date.exact(split.post_date).ask
+                brl_value_purchases += day_ask_usdbrl * Decimal(split.value)
+                brl_price_avg = brl_value_purchases/quantity_purchases
+        elif split.value < 0 and split.post_date >= minimum_date:
+            is_transfer = split.quantity == 0
+            if is_transfer:
+                has_no_quantity = split.quantity == 0
+                if has_no_quantity:
+                    print(f'transaction of {account.name} on date {transaction_date} is already at quantity 0, skipping')
+
+                    continue
+
+                value_purchases += Decimal(split.value)
+                price_avg = value_purchases/quantity_purchases
+
+                if is_us and quotes_by_date is not None:
+                    day_bid_usdbrl = quotes_by_date.exact(split.post_date).bid
+                    brl_value_purchases += Decimal(split.value) * day_bid_usdbrl
+                    brl_price_avg = brl_value_purchases/quantity_purchases
             else:
-                raise Exception("Unexpected flow", sale)
+                sold_price = split.value/split.quantity
+                positive_quantity = -split.quantity
+                is_profit = sold_price > price_avg
+                profit = sold_price * positive_quantity - price_avg * positive_quantity
+                sale = {
+                    'name': account.name,
+                    'type': metadata['type'],
+                    'date': split.post_date,
+                    'sold_price': sold_price,
+                    'quantity_sold': split.quantity,
+                    'quantity_after_sale': quantity,
+                    'value': split.value,
+                    'price_avg': price_avg,
+                    'is_profit': is_profit,
+                    'profit': profit
+                }
 
-    add_taxes(sales_info)
+                if is_us and quotes_by_date is not None:
+                    day_bid_usdbrl = quotes_by_date.exact(split.post_date).bid
+                    sold_price_brl = day_bid_usdbrl * sold_price
+                    sale['sold_price_brl'] = sold_price_brl
+                    sale['is_profit'] = sold_price_brl > brl_price_avg
+                    sale['profit'] = sold_price_brl * positive_quantity - brl_price_avg * positive_quantity
 
-    acoes_dedo_duro = acoes_sales_value * DEDO_DURO_MULTIPLIER
-    acoes_aggregated_profits -= acoes_dedo_duro
+                    sale['brl_value'] = brl_price_avg * quantity
+                    sale['brl_price_avg'] =  brl_price_avg
+                    sale['brl_value_purchases'] = brl_value_purchases
 
-    sales_info['aggregated']['us']['aggregated_profits'] = us_aggregated_profits
-    sales_info['aggregated']['us']['sales_value'] = us_sales_value
+                sales.append(sale)
+        elif split.post_date >= minimum_date:
+            raise Exception("Split wasn't recognized", account.name, split.post_date)
 
-    sales_info['aggregated']['acoes']['aggregated_profits'] = acoes_aggregated_profits
-    sales_info['aggregated']['acoes']['acoes_sales_value'] = acoes_sales_value
-    sales_info['aggregated']['acoes']['dedo_duro'] = acoes_dedo_duro
+        # avg should go back to zero if everything was sold at some point
+        sold_all = quantity == 0
+        if sold_all:
+            price_avg = Decimal(0)
+            brl_price_avg = Decimal(0)
+            value_purchases = Decimal(0)
+            brl_value_purchases = Decimal(0)
+            quantity_purchases = Decimal(0)
 
-    return sales_info
+            # the period of a split is the report year it falls in, everything before the first one counts as before it
+            sold_before_period_start = split.post_date < minimum_date or split.post_date == date(split.post_date.year, 1, 1)
+            if sold_before_period_start:
+                held_during_filtered_period = False
 
+    if on_year_end is not None:
+        close_years(minimum_date.year)
+    close_report_years(years[-1] + 1)
 
-def sorted_splits_by_date(account):
-    return sorted(account.splits, key=lambda x: x.transaction.post_date)
+    return results
 
 
-def collect_bens_direitos(children, date_filter, quotes_by_date=None, is_us=False, minimum_date=None):
-    sales = []
-    bens = []
-    held_during_filtered_period = set()
+# what a worker process needs from an account, since piecash objects cannot leave the book's session
+ReplayAccount = namedtuple('ReplayAccount', ['guid', 'name'])
+
+replay_worker_quotes = None
+
+
+def init_replay_worker(quotes_by_date):
+    global replay_worker_quotes
+    replay_worker_quotes = quotes_by_date
+
+
+def replay_account_task(task):
+    account, metadata, splits, years, is_us, checkpoint, collect_year_ends = task
+
+    # year-end positions are written by the parent process, which owns the checkpoints connection
+    year_ends = []
+    on_year_end = None
+    if collect_year_ends:
+        on_year_end = lambda year, position: year_ends.append((year, position))
+
+    results = replay_account(account, metadata, splits, years, replay_worker_quotes, is_us, checkpoint, on_year_end)
+    return results, year_ends
+
+
+def replay_accounts_in_pool(children, splits_by_account, years, metadata, quotes_by_date, is_us, positions, workers):
+    tasks = []
     for account in children:
-        brl_price_avg = Decimal(0)
-        brl_value_purchases = Decimal(0)
-
-        quantity = Decimal(0)
-        price_avg = Decimal(0)
-        value_purchases = Decimal(0)
-        quantity_purchases = Decimal(0)
-        transaction_date = None
-        for split in sorted_splits_by_date(account):
-            if split.transaction.post_date <= date_filter:
-                held_during_filtered_period.add(account.name)
+        checkpoint = positions.checkpoint(account) if positions is not None else None
+        account_info = ReplayAccount(account.guid, account.name)
+        tasks.append((account_info, metadata.of(account.guid), splits_by_account[account.guid], years, is_us, checkpoint, positions is not None))
 
-                quantity += Decimal(split.quantity)
-                transaction_date = split.transaction.post_date
-
-                is_stock_split = split.value == 0 and split.action == 'Split'
-                format = "%d%m%Y"
-                date = split.transaction.post_date.strftime(format)
-                if split.value > 0 or is_stock_split:
-                    value_purchases += Decimal(split.value)
-                    quantity_purchases += Decimal(split.quantity)
-                    price_avg = value_purchases/quantity_purchases
-
-                    if is_us and quotes_by_date is not None:
-                        day_ask_usdbrl = quotes_by_date[date]['ask']
-                        brl_value_purchases += day_ask_usdbrl * Decimal(split.value)
-                        brl_price_avg = brl_value_purchases/quantity_purchases
-                elif minimum_date is not None:
-                    if split.value < 0 and split.transaction.post_date >= minimum_date:
-                        is_transfer = split.quantity == 0
-                        if is_transfer:
-                            has_no_quantity = split.quantity == 0
-                            if has_no_quantity:
-                                print(f'transaction of {account.name} on date {transaction_date} is already at quantity 0, skipping')
-
-                                continue
-
-                            value_purchases += Decimal(split.value)
-                            price_avg = value_purchases/quantity_purchases
-
-                            if is_us and quotes_by_date is not None:
-                                day_bid_usdbrl = quotes_by_date[date]['bid']
-                                brl_value_purchases += Decimal(split.value) * day_bid_usdbrl
-                                brl_price_avg = brl_value_purchases/quantity_purchases
-                        else:
-                            sold_price = split.value/split.quantity
-                            positive_quantity = -split.quantity
-                            is_profit = sold_price > price_avg
-                            profit = sold_price * positive_quantity - price_avg * positive_quantity
-                            sale = {
-                                'name': account.name,
-                                'type': extract_metadata(account)['type'],
-                                'date': split.transaction.post_date,
-                                'sold_price': sold_price,
-                                'quantity_sold': split.quantity,
-                                'quantity_after_sale': quantity,
-                                'value': split.value,
-                                'price_avg': price_avg,
-                                'is_profit': is_profit,
-                                'profit': profit
-                            }
-
-                            if is_us and quotes_by_date is not None:
-                                day_bid_usdbrl = quotes_by_date[date]['bid']
-                                sold_price_brl = day_bid_usdbrl * sold_price
-                                sale['sold_price_brl'] = sold_price_brl
-                                sale['is_profit'] = sold_price_brl > brl_price_avg
-                                sale['profit'] = sold_price_brl * positive_quantity - brl_price_avg * positive_quantity
-
-                                sale['brl_value'] = brl_price_avg * quantity
-                                sale['brl_price_avg'] =  brl_price_avg
-                                sale['brl_value_purchases'] = brl_value_purchases
-
-                            sales.append(sale)
-                    elif split.transaction.post_date >= minimum_date:
-                        raise Exception("Split wasn't recognized", account.name, split.transaction.post_date)
-
-                # avg should go back to zero if everything was sold at some point
-                sold_all = quantity == 0
-                if sold_all:
-                    price_avg = Decimal(0)
-                    brl_price_avg = Decimal(0)
-                    value_purchases = Decimal(0)
-                    brl_value_purchases = Decimal(0)
-                    quantity_purchases = Decimal(0)
-
-                    sold_before_period_start = split.transaction.post_date <= minimum_date
-                    if sold_before_period_start:
-                        held_during_filtered_period.remove(account.name)
-
-
-        if quantity > 0:
-            metadata = extract_metadata(account)
-
-            bem = {
-                    'name': account.name,
-                    'quantity': quantity,
-                    'value': price_avg * quantity,
-                    'price_avg': price_avg,
-                    'value_purchases': value_purchases,
-                    'quantity_purchases': quantity_purchases,
-                    'last_transaction_date': transaction_date,
-                    'metadata': metadata
-            }
+    # results come back in the order of children, so merging them is deterministic
+    for account, (results, year_ends) in zip(children, map_in_pool(replay_account_task, tasks, workers, init_replay_worker, (quotes_by_date,))):
+        if positions is not None:
+            save = positions.year_end_handler(account)
+            for year, position in year_ends:
+                save(year, position)
 
-            if is_us:
-                bem['brl_value'] = brl_price_avg * quantity
-                bem['brl_price_avg'] = brl_price_avg
-                bem['brl_value_purchases'] = brl_value_purchases
+        yield account, results
 
-            bens.append(bem)
 
-        elif quantity < 0:
-            raise Exception("The stock {} has a negative quantity {}!".format(account.name, quantity))
+def replay_accounts(children, splits_by_account, years, metadata, quotes_by_date, is_us, positions):
+    for account in children:
+        checkpoint = None
+        on_year_end = None
+        if positions is not None:
+            checkpoint = positions.checkpoint(account)
+            on_year_end = positions.year_end_handler(account)
+
+        results = replay_account(account, metadata.of(account.guid), splits_by_account[account.guid], years, quotes_by_date, is_us, checkpoint, on_year_end)
+        yield account, results
+
+
+def collect_bens_direitos(children, splits_by_account, years, metadata, quotes_by_date=None, is_us=False, positions=None, workers=1):
+    if workers > 1 and len(children) > 1:
+        replayed = replay_accounts_in_pool(children, splits_by_account, years, metadata, quotes_by_date, is_us, positions, workers)
+    else:
+        replayed = replay_accounts(children, splits_by_account, years, metadata, quotes_by_date, is_us, positions)
+
+    collected = {year: ([], [], set()) for year in years}
+    for account, results in replayed:
+        for year in years:
+            bens, sales, held_during_filtered_period = collected[year]
+            bem, account_sales, held = results[year]
+            if bem is not None:
+                bens.append(bem)
+            sales += account_sales
+            if held:
+                held_during_filtered_period.add(account.name)
 
-    return bens, sales, held_during_filtered_period
+    return collected
 
 
-def collect_crypto(book, date_filter, minimum_date):
+def collect_crypto(book, years, checkpoints=None, workers=1, metadata=None):
+    if metadata is None:
+        metadata = load_account_metadata(book)
     cryptos_account = book.accounts(name='Crypto')
-    children = cryptos_account.children
+    children, splits_by_account, positions = prepare_replay(book, [cryptos_account], date(years[0], 1, 1), checkpoints, checkpoint_context())
 
-    crypto, _, _ = collect_bens_direitos(children, date_filter, minimum_date=minimum_date)
-    return crypto
+    collected = collect_bens_direitos(children, splits_by_account, years, metadata, positions=positions, workers=workers)
+    return {year: crypto for year, (crypto, _, _) in collected.items()}
 
 
-def collect_bens_direitos_brasil(book, date_filter, minimum_date):
+def collect_bens_direitos_brasil(book, years, checkpoints=None, workers=1, metadata=None):
+    if metadata is None:
+        metadata = load_account_metadata(book)
     acoes_account = book.accounts(name='Ações')
     fiis_account = book.accounts(name='FIIs')
-    children = acoes_account.children + fiis_account.children
+    children, splits_by_account, positions = prepare_replay(book, [acoes_account, fiis_account], date(years[0], 1, 1), checkpoints, checkpoint_context())
 
-    return collect_bens_direitos(children, date_filter, minimum_date=minimum_date)
+    return collect_bens_direitos(children, splits_by_account, years, metadata, positions=positions, workers=workers)
 
 
-def collect_bens_direitos_stocks(book, quotes_by_date, date_filter, minimum_date):
+def collect_bens_direitos_stocks(book, quotes_by_date, years, checkpoints=None, quotes_csv_path=None, workers=1, metadata=None):
+    if metadata is None:
+        metadata = load_account_metadata(book)
     stocks_account = book.accounts(name='Ações no exterior')
-    children = stocks_account.children
+    context = checkpoint_context(quotes_csv_path) if checkpoints is not None else None
+    children, splits_by_account, positions = prepare_replay(book, [stocks_account], date(years[0], 1, 1), checkpoints, context)
 
-    return collect_bens_direitos(children, date_filter, is_us=True, quotes_by_date=quotes_by_date, minimum_date=minimum_date)
+    return collect_bens_direitos(children, splits_by_account, years, metadata, is_us=True, quotes_by_date=quotes_by_date, positions=positions, workers=workers)
 
 
 def get_closest_available_quote(upper_limit_day, month, year, quotes_by_date):
-    day = upper_limit_day
-    while day > 0:
-        try:
-            date = "{:>02}{:>02}{}".format(day, month, year)
-            return quotes_by_date[date]['bid']
-        except KeyError:
-            day -= 1
-
-    raise Exception("Unexpected state: quote not found", day, month, year)
+    last_day = calendar.monthrange(year, month)[1]
+    try:
+        return quotes_by_date.latest(date(year, month, min(upper_limit_day, last_day)), not_before=date(year, month, 1)).bid
+    except KeyError:
+        raise Exception("Unexpected state: quote not found", upper_limit_day, month, year)
 
 
 def get_us_dividend_usdbrl_quotes(quotes_by_date, year):
@@ -319,7 +618,10 @@ def get_us_dividend_usdbrl_quotes(quotes_by_date, year):
             found_year = year - 1
             previous_month =  12
 
-        quotes_by_month[month] = get_closest_available_quote(15, previous_month, found_year, quotes_by_date)
+        try:
+            quotes_by_month[month] = quotes_by_date.first_half_of_month(found_year, previous_month).bid
+        except KeyError:
+            raise Exception("Unexpected state: quote not found", 15, previous_month, found_year)
 
     return quotes_by_month
 
@@ -328,358 +630,544 @@ def get_year_last_usdbrl_bid_quote(quotes_by_date, year):
     return get_closest_available_quote(31, 12, year, quotes_by_date)
 
 
-def collect_brokerage_account_balance(book, maximum_date, quotes_by_date, year_filter):
+def collect_brokerage_account_balance(book, years, quotes_by_date):
     account = book.accounts(name='Conta no Charles Schwab')
 
     usd_value = Decimal(0)
-    for split in sorted_splits_by_date(account):
-        if split.transaction.post_date > maximum_date:
+    usd_value_by_year = {year: Decimal(0) for year in years}
+    for split in sorted_splits_by_date(book, account):
+        if split.post_date.year > years[-1]:
             break
 
-        currency = split.transaction.currency.mnemonic
+        currency = split.currency
         if currency == 'USD':
-            usd_value += split.value
+            usd_delta = split.value
         elif currency == 'BRL':
-            usd_value += split.quantity
+            usd_delta = split.quantity
         else:
             raise Exception("Unsupported currency in the brokerage account history", currency)
 
-    usdbrl_quote = get_year_last_usdbrl_bid_quote(quotes_by_date, year_filter)
-    brl_value = usdbrl_quote * usd_value
+        if split.post_date.year < years[0]:
+            usd_value += usd_delta
+        else:
+            usd_value_by_year[split.post_date.year] += usd_delta
+
+    balances = {}
+    for year in years:
+        usd_value += usd_value_by_year[year]
+        usdbrl_quote = get_year_last_usdbrl_bid_quote(quotes_by_date, year)
+        balances[year] = (usd_value, usdbrl_quote * usd_value)
 
-    return usd_value, brl_value
+    return balances
 
 
-def collect_proventos(book, minimum_date, maximum_date):
-    dividendos = book.accounts(name='Dividendos').children
-    jcp = book.accounts(name='JCP').children
+def collect_proventos(book, years, metadata=None):
+    if metadata is None:
+        metadata = load_account_metadata(book)
+    dividendos_account = book.accounts(name='Dividendos')
+    jcp_account = book.accounts(name='JCP')
+    splits_by_account = load_splits_by_account(book, [dividendos_account, jcp_account])
 
-    proventos = {}
-    for provento_account in dividendos + jcp:
+    proventos_by_year = {year: {} for year in years}
+    for provento_account in dividendos_account.children + jcp_account.children:
         name = provento_account.name
-        if name not in proventos:
-            acao_account = book.accounts(name='Ações').children(name=name)
-            metadata = extract_metadata(acao_account)
-            proventos[name] = {'fonte_pagadora': metadata['cnpj'], 'long_name': metadata['long_name'],'Dividendos': Decimal(0), 'JCP': Decimal(0)}
-
-        for split in provento_account.splits:
-            if split.transaction.post_date >= minimum_date and split.transaction.post_date <= maximum_date:
-                provento_type = provento_account.parent.name
+        if name not in proventos_by_year[years[0]]:
+            acao_metadata = metadata.named('Ações', name)
+            for proventos in proventos_by_year.values():
+                proventos[name] = {'fonte_pagadora': acao_metadata['cnpj'], 'long_name': acao_metadata['long_name'],'Dividendos': Decimal(0), 'JCP': Decimal(0)}
+
+        provento_type = provento_account.parent.name
+        for split in splits_by_account[provento_account.guid]:
+            proventos = proventos_by_year.get(split.post_date.year)
+            if proventos is not None:
                 proventos[name][provento_type] += -split.value
 
-    return proventos
+    return proventos_by_year
 
 
-def collect_proventos_fiis(book, minimum_date, maximum_date):
-    rendimentos = book.accounts(name='Receita de FIIs').children
+def collect_proventos_fiis(book, years):
+    rendimentos_account = book.accounts(name='Receita de FIIs')
+    splits_by_account = load_splits_by_account(book, [rendimentos_account])
 
-    proventos = {}
-    for provento_account in rendimentos:
+    proventos_by_year = {year: {} for year in years}
+    for provento_account in rendimentos_account.children:
         name = provento_account.name
         metadata = json.loads(provento_account.description)
         fonte_pagadora = metadata['fonte_pagadora']
-        if fonte_pagadora not in proventos:
-            proventos[fonte_pagadora] = {'fiis': [], 'long_name': metadata['long_name'], 'proventos': Decimal(0)}
 
-        value_sum = Decimal(0)
-        for split in provento_account.splits:
-            if split.transaction.post_date >= minimum_date and split.transaction.post_date <= maximum_date:
-                value_sum += -split.value
+        value_sum_by_year = {year: Decimal(0) for year in years}
+        for split in splits_by_account[provento_account.guid]:
+            if split.post_date.year in value_sum_by_year:
+                value_sum_by_year[split.post_date.year] += -split.value
+
+        for year, proventos in proventos_by_year.items():
+            if fonte_pagadora not in proventos:
+                proventos[fonte_pagadora] = {'fiis': [], 'long_name': metadata['long_name'], 'proventos': Decimal(0)}
 
-        if value_sum != 0:
-            proventos[fonte_pagadora]['proventos'] += value_sum
-            proventos[fonte_pagadora]['fiis'].append(name)
+            value_sum = value_sum_by_year[year]
+            if value_sum != 0:
+                proventos[fonte_pagadora]['proventos'] += value_sum
+                proventos[fonte_pagadora]['fiis'].append(name)
 
-    return proventos
+    return proventos_by_year
 
 
-def collect_us_dividends(book, minimum_date, maximum_date, bid_quotes_by_month):
-    monthly_dividends = {}
-    for dividend_account in book.accounts(name='US Dividends').children:
-        for split in dividend_account.splits:
-            if split.transaction.post_date >= minimum_date and split.transaction.post_date <= maximum_date:
-                month = split.transaction.post_date.month
+def collect_us_dividends(book, years, bid_quotes_by_month_by_year):
+    us_dividends_account = book.accounts(name='US Dividends')
+    splits_by_account = load_splits_by_account(book, [us_dividends_account])
+
+    monthly_dividends_by_year = {year: {} for year in years}
+    for dividend_account in us_dividends_account.children:
+        for split in splits_by_account[dividend_account.guid]:
+            monthly_dividends = monthly_dividends_by_year.get(split.post_date.year)
+            if monthly_dividends is not None:
+                month = split.post_date.month
 
                 if month not in monthly_dividends:
                     monthly_dividends[month] = Decimal(0)
 
                 monthly_dividends[month] += -split.value
 
-    all_values = {}
-    paid_tax_brl = Decimal(0)
-    for month in sorted(monthly_dividends.keys()):
-        usd_net_value = monthly_dividends[month]
-        usd_gross_value = usd_net_value/Decimal(1 - US_DIVIDEND_TAX_MULTIPLIER)
-        brl_gross_value = bid_quotes_by_month[month] * usd_gross_value
-
-        all_values[month] = {
-            'usd_net_value': usd_net_value,
-            'usd_gross_value': usd_gross_value,
-            'brl_gross_value': brl_gross_value
-        }
+    us_dividends = {}
+    for year, monthly_dividends in monthly_dividends_by_year.items():
+        bid_quotes_by_month = bid_quotes_by_month_by_year[year]
+
+        all_values = {}
+        paid_tax_brl = Decimal(0)
+        for month in sorted(monthly_dividends.keys()):
+            usd_net_value = monthly_dividends[month]
+            usd_gross_value = usd_net_value/Decimal(1 - US_DIVIDEND_TAX_MULTIPLIER)
+            brl_gross_value = bid_quotes_by_month[month] * usd_gross_value
+
+            all_values[month] = {
+                'usd_net_value': usd_net_value,
+                'usd_gross_value': usd_gross_value,
+                'brl_gross_value': brl_gross_value
+            }
 
-        paid_tax_brl += brl_gross_value * US_DIVIDEND_TAX_MULTIPLIER
+            paid_tax_brl += brl_gross_value * US_DIVIDEND_TAX_MULTIPLIER
 
-    return paid_tax_brl, all_values
+        us_dividends[year] = (paid_tax_brl, all_values)
 
+    return us_dividends
 
-def collect_bonificacoes(book, minimum_date, maximum_date):
+
+def collect_bonificacoes(book, years):
     account = book.accounts(name='Bonificações')
 
-    bonificacoes = []
-    for split in sorted_splits_by_date(account):
-        if split.transaction.post_date >= minimum_date and split.transaction.post_date <= maximum_date:
-            bonificacoes.append(ledger(split.transaction))
+    transaction_guids_by_year = {year: [] for year in years}
+    for split in sorted_splits_by_date(book, account):
+        transaction_guids = transaction_guids_by_year.get(split.post_date.year)
+        if transaction_guids is not None:
+            transaction_guids.append(split.transaction_guid)
+
+    all_guids = [guid for transaction_guids in transaction_guids_by_year.values() for guid in transaction_guids]
+    transactions = book.session.query(Transaction).filter(Transaction.guid.in_(all_guids))
+    transactions_by_guid = {transaction.guid: transaction for transaction in transactions}
+
+    return {year: [ledger(transactions_by_guid[guid]) for guid in transaction_guids] for year, transaction_guids in transaction_guids_by_year.items()}
+
+
+def load_price_index(book):
+    # every price of the book in a single core query, which skips the ORM row processing that dominates at millions of
+    # prices. Dates are converted once per distinct date and the commodity guids shared between their prices
+    prices, commodities = Price.__table__, Commodity.__table__
+    read_date = date_reader(book, prices.c.date)
+    rows = book.session.execute(
+        select([prices.c.commodity_guid, type_coerce(prices.c.date, String), prices.c.value_num, prices.c.value_denom, commodities.c.mnemonic])
+        .select_from(prices.join(commodities, prices.c.currency_guid == commodities.c.guid)))
+
+    guids = {}
+    commodity_guids, ordinals, values, currencies = [], [], [], []
+    for commodity_guid, raw_date, value_num, value_denom, currency in rows:
+        commodity_guids.append(guids.setdefault(commodity_guid, commodity_guid))
+        ordinals.append(read_date(raw_date).toordinal())
+        values.append(value_num / value_denom)
+        currencies.append(currency)
+
+    count_rows(len(ordinals))
+    return PriceIndex(commodity_guids, ordinals, values, currencies)
+
+
+def collect_market_values(book, quotes_by_date, dates):
+    # the investment accounts valued at the last price on or before each date, all dates in one as-of join
+    parents = [book.accounts(name=parent_name) for parent_name in INVESTMENT_PARENTS]
+    accounts = [(parent.name, account) for parent in parents for account in sorted(parent.children, key=lambda account: account.name)]
+    splits_by_account = load_splits_by_account(book, parents)
+    prices = load_price_index(book)
+
+    account_guids = [account.guid for _, account in accounts]
+    commodity_guids = [account.commodity.guid for _, account in accounts]
+    values = market_values(account_guids, commodity_guids, splits_by_account, prices, quotes_by_date, dates)
+
+    return [(parent_name, account.name) for parent_name, account in accounts], values
+
+
+def parse_years(raw_years):
+    # either a single year or an inclusive range like 2019-2025
+    first, _, last = raw_years.partition('-')
+    years = range(int(first), int(last or first) + 1)
+    if not years:
+        raise argparse.ArgumentTypeError('empty range of years: {}'.format(raw_years))
+
+    return years
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(usage='ir.py gnucash_db_path quotes_csv_path (year_filter | --years FIRST-LAST) is_debug (optional, default false) [--workers N] [--market-value YYYY-MM-DD ...]')
+    parser.add_argument('gnucash_db_path')
+    parser.add_argument('quotes_csv_path')
+    parser.add_argument('year_filter', nargs='?', type=parse_years)
+    parser.add_argument('is_debug', nargs='?', default='')
+    parser.add_argument('--years', type=parse_years, help='prints one report per year of the range, replaying the book only once')
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--workers', type=int, default=1, help='replays the investment accounts in this many processes')
+    parser.add_argument('--no-checkpoints', action='store_true', help='replays every year from the first split, without reading or writing the checkpoints stored next to the book')
+    parser.add_argument('--market-value', nargs='+', type=date.fromisoformat, metavar='YYYY-MM-DD', help='values the investment accounts at the prices of the book on each of these dates, with or without a report')
+    parser.add_argument('--profile', nargs='?', const=default_trace_path(__file__), metavar='TRACE', help='prints time, SQL statements, rows and peak memory per collector to stderr and appends a JSONL trace to TRACE (default ir.profile.jsonl)')
+
+    arguments = parser.parse_args()
+    if arguments.year_filter is not None and arguments.years is not None:
+        parser.error('either year_filter or --years is required, but not both')
+    if arguments.year_filter is None and arguments.years is None and arguments.market_value is None:
+        parser.error('either year_filter, --years or --market-value is required')
+
+    return arguments
+
+
+def collect_reports(book, years, quotes_by_date, quotes_csv_path, checkpoints, workers):
+    with phase('load_account_metadata'):
+        metadata = load_account_metadata(book)
+        count_rows(len(metadata))
+
+    with phase('collect_bens_direitos_brasil'):
+        bens_direitos = collect_bens_direitos_brasil(book, years, checkpoints, workers, metadata)
+    with phase('collect_bens_direitos_stocks'):
+        stocks = collect_bens_direitos_stocks(book, quotes_by_date, years, checkpoints, quotes_csv_path, workers, metadata)
+    with phase('collect_brokerage_account_balance'):
+        brokerage_balances = collect_brokerage_account_balance(book, years, quotes_by_date)
+    with phase('collect_crypto'):
+        cryptos = collect_crypto(book, years, checkpoints, workers, metadata)
+        if checkpoints is not None:
+            checkpoints.commit()
+
+    with phase('collect_proventos'):
+        proventos = collect_proventos(book, years, metadata)
+    with phase('collect_us_dividends'):
+        bid_quotes_by_month_by_year = {year: get_us_dividend_usdbrl_quotes(quotes_by_date, year) for year in years}
+        us_dividends = collect_us_dividends(book, years, bid_quotes_by_month_by_year)
+    with phase('collect_proventos_fiis'):
+        proventos_fiis = collect_proventos_fiis(book, years)
+    with phase('collect_bonificacoes'):
+        bonificacoes = collect_bonificacoes(book, years)
+
+    reports = {}
+    for year in years:
+        reports[year] = {
+            'bens_direitos': bens_direitos[year],
+            'stocks': stocks[year],
+            'brokerage_balance': brokerage_balances[year],
+            'cryptos': cryptos[year],
+            'proventos': proventos[year],
+            'bid_quotes_by_month': bid_quotes_by_month_by_year[year],
+            'us_dividends': us_dividends[year],
+            'proventos_fiis': proventos_fiis[year],
+            'bonificacoes': bonificacoes[year]
+        }
 
-    return bonificacoes
+    return reports
 
 
-def retrieve_usdbrl_quotes(quotes_csv_path):
-    quotes_by_date = {}
+def print_report(year_filter, report, is_debug):
+    maximum_date_filter = date(year_filter, 12, 31)
 
-    with open(quotes_csv_path,  newline='') as csv_file:
-        reader = csv.DictReader(csv_file, delimiter = ';')
-        for row in reader:
-            date = row['data']
-            bid = row['compra']
-            ask = row['venda']
+    print('retrieving data before or equal than {}'.format(maximum_date_filter))
 
-            quotes_by_date[date] = {'bid': Decimal(bid.replace(',', '.')), 'ask': Decimal(ask.replace(',', '.'))}
+    bens_direitos, br_sales, need_additional_data = report['bens_direitos']
+    print("************* Bens e direitos *************")
+    for bem_direito in sorted(bens_direitos, key=lambda x: (x['metadata']['grupo_bem_direito'], x['metadata']['codigo_bem_direito'], x['name'])):
+        metadata = bem_direito['metadata']
 
-    return quotes_by_date
+        print(bem_direito['name'])
+        print("Grupo:", metadata['grupo_bem_direito'])
+        print("Código:", metadata['codigo_bem_direito'])
+        print("CNPJ:", metadata['cnpj'])
+        print("Discriminação: {} {} - CORRETORA INTER DTVM".format(round(bem_direito['quantity'], 0), bem_direito['name']))
+        print("Situação R$:", round(bem_direito['value'], 2))
+        print("***")
 
+        if is_debug:
+            pp.pprint(bem_direito)
 
-def main():
-    if len(sys.argv) < 4:
-        print('Wrong number of arguments!')
-        print('Usage: ir.py gnucash_db_path quotes_csv_path year_filter is_debug (optional, default false)')
-        return
+    stocks, stock_sales, _ = report['stocks']
 
-    gnucash_db_path = sys.argv[1]
-    quotes_csv_path = sys.argv[2]
-    year_filter = sys.argv[3]
+    types = {'us etf': 'ETF', 'us stock': 'Ação', 'reit': 'REIT'}
+    for stock in sorted(stocks, key=lambda x: (x['metadata']['grupo_bem_direito'], x['metadata']['codigo_bem_direito'], x['name'])):
+        metadata = stock['metadata']
 
-    quotes_by_date = retrieve_usdbrl_quotes(quotes_csv_path)
+        type_description = types[metadata['type']]
 
-    is_debug = False
-    if len(sys.argv) > 4:
-        is_debug = bool(sys.argv[4])
+        print(stock['name'])
+        print("Grupo:", metadata['grupo_bem_direito'])
+        print("Código:", metadata['codigo_bem_direito'])
+        print("Localização: EUA")
+        print("Discriminação: {} {} {}. Código de negociação {}. Valor total de aquisição US$ {}. Corretora Charles Schwab.".format(round(stock['quantity'], 0), type_description, metadata['long_name'], stock['name'], round(stock['value'], 2)))
+        print("Situação R$:", round(stock['brl_value'], 2))
+        print("***")
 
-    maximum_date_filter = date(int(year_filter), 12, 31)
-    minimum_date_filter = date(int(year_filter), 1, 1)
+        if is_debug:
+            pp.pprint(stock)
+
+    brokerage_usd_value, brokerage_brl_value = report['brokerage_balance']
+    print("Conta na corretora no exterior")
+    print("Grupo: 06")
+    print("Código: 01", )
+    print("Localização: EUA")
+    print("Discriminação: US$ {} em conta na corretora Charles Schwab. Número da conta: [preencher aqui]".format(brokerage_usd_value))
+    print("Situação R$:", round(brokerage_brl_value, 2))
+    print("***")
+
+    cryptos = report['cryptos']
+    for crypto in cryptos:
+        metadata = crypto['metadata']
+
+        print(crypto['name'])
+        print("Grupo:", metadata['grupo_bem_direito'])
+        print("Código:", metadata['codigo_bem_direito'])
+        print("Discriminação: {} {} - {}".format(crypto['quantity'], crypto['name'], metadata['long_name']))
+        print("Situação R$:", round(crypto['value'], 2))
+        print("***")
 
-    with open_book(gnucash_db_path, readonly=True, do_backup=False, open_if_lock=True) as book:
-        print('retrieving data before or equal than {}'.format(maximum_date_filter))
-
-        bens_direitos, br_sales, need_additional_data = collect_bens_direitos_brasil(book, maximum_date_filter, minimum_date_filter)
-        print("************* Bens e direitos *************")
-        for bem_direito in sorted(bens_direitos, key=lambda x: (x['metadata']['grupo_bem_direito'], x['metadata']['codigo_bem_direito'], x['name'])):
-            metadata = bem_direito['metadata']
-
-            print(bem_direito['name'])
-            print("Grupo:", metadata['grupo_bem_direito'])
-            print("Código:", metadata['codigo_bem_direito'])
-            print("CNPJ:", metadata['cnpj'])
-            print("Discriminação: {} {} - CORRETORA INTER DTVM".format(round(bem_direito['quantity'], 0), bem_direito['name']))
-            print("Situação R$:", round(bem_direito['value'], 2))
+        if is_debug:
+            pp.pprint(crypto)
+
+    print("**************************")
+    print()
+    print()
+
+    all_sales = br_sales + stock_sales
+    sales_info = extract_sales_info(all_sales)
+    if is_debug:
+        pp.pprint("sales_info")
+        pp.pprint(sales_info)
+        pp.pprint("all_sales")
+        pp.pprint(all_sales)
+
+    print("************* RV Agregado (exclui ETFs BR e FIIs) *************")
+    print("A ser declarado em Rendimentos Isentos e Não tributáveis")
+
+    acoes_aggregated_profit = sales_info['aggregated']['acoes']['aggregated_profits']
+    us_aggregated_profits = sales_info['aggregated']['us']['aggregated_profits']
+    acoes_dedo_duro = sales_info['aggregated']['acoes']['dedo_duro']
+    print("20 - Ganhos líquidos em operações no mercado à vista de ações: ", round(acoes_aggregated_profit, 2))
+    print("5 - Ganho de capital na alienação de bem, direito ou conjunto de bens ou direitos da mesma natureza, alienados em um mesmo mês, de valor total de alienação até R$ 20.000,00, para ações alienadas no mercado de balcão, e R$ 35.000,00, nos demais casos (Lucro com venda no exterior) (Declarar apenas se for valor positivo): ", round(us_aggregated_profits, 2))
+    print("Imposto Pago/Retido (Imposto Pago/Retido na linha 03) (dedo-duro): ", round(acoes_dedo_duro, 2))
+
+    print("**************************")
+
+    print("************* RV mês a mês *************")
+    print("Operações comuns/Day-trade - Mercado à vista")
+    print("Venda de ações com prejuízo, vendas em mês com mais de 20k ou vendas de ETFs")
+    if is_debug:
+        pp.pprint(sales_info['monthly']['acoes+etfs'])
+
+    print("** ATENÇÃO: Antes de pagar qualquer imposto, não se esqueça de conferir se há prejuízo acumulado!")
+    for key in sales_info['monthly']['acoes+etfs'].keys():
+        current = sales_info['monthly']['acoes+etfs'][key]
+        resultado = current['aggregated_profits']
+        ir_fonte = current['dedo_duro']
+        imposto = current['imposto']
+
+        if resultado != 0:
+            print("Mês:", key)
+            print("    Resultado", round(resultado, 2))
+            print("    IR Fonte", round(ir_fonte, 2))
+            print("    Valor do imposto", round(imposto, 2))
+
+    print("***")
+    print("Operações FIIs")
+    print("** ATENÇÃO: Antes de pagar qualquer imposto, não se esqueça de conferir se há prejuízo acumulado!")
+    if is_debug:
+        pp.pprint(sales_info['monthly']['fiis'])
+
+    for key in sales_info['monthly']['fiis'].keys():
+        current = sales_info['monthly']['fiis'][key]
+        resultado = current['aggregated_profits']
+        ir_fonte = current['dedo_duro']
+        imposto = current['imposto']
+
+        if resultado != 0:
+            print("Mês:", key)
+            print("    Resultado", round(resultado, 2))
+            print("    IR Fonte", round(ir_fonte, 2))
+            print("    Valor do imposto", round(imposto, 2))
+
+    print("***")
+    print("Vendas no exterior que geraram impostos")
+    for key in sales_info['monthly']['us'].keys():
+        current = sales_info['monthly']['us'][key]
+        resultado = current['aggregated_profits']
+        imposto = current['imposto']
+
+        if resultado != 0:
+            print("Mês:", key)
+            print("    Resultado", round(resultado, 2))
+            print("    Valor do imposto", round(imposto, 2))
+
+    print("**************************")
+
+    print("************* Rendimentos *************")
+    proventos = report['proventos']
+    print("JCP: Rendimentos Sujeitos à Tributação Exclusiva/Definitiva, código 10")
+    for key in proventos:
+        provento = proventos[key]
+        if provento['JCP'] != 0:
+            need_additional_data.add(key)
+
+            print(key)
+            print("Fonte pagadora:", provento['fonte_pagadora'])
+            print("Nome da fonte pagadora:", provento['long_name'])
+            print("JCP:", provento['JCP'])
             print("***")
 
-            if is_debug:
-                pp.pprint(bem_direito)
+    print("******")
+    print("Dividendos: Rendimentos Isentos e Não tributáveis, código 9")
+    for key in proventos:
 
-        stocks, stock_sales, _ = collect_bens_direitos_stocks(book, quotes_by_date, maximum_date_filter, minimum_date_filter)
+        provento = proventos[key]
+        if provento['Dividendos'] != 0:
+            need_additional_data.add(key)
 
-        types = {'us etf': 'ETF', 'us stock': 'Ação', 'reit': 'REIT'}
-        for stock in sorted(stocks, key=lambda x: (x['metadata']['grupo_bem_direito'], x['metadata']['codigo_bem_direito'], x['name'])):
-            metadata = stock['metadata']
+            print(key)
+            print("Fonte pagadora:", provento['fonte_pagadora'])
+            print("Nome da fonte pagadora:", provento['long_name'])
+            print("Dividendos:", provento['Dividendos'])
+            print("***")
 
-            type_description = types[metadata['type']]
+    if is_debug:
+        pp.pprint(proventos)
+    print("******")
 
-            print(stock['name'])
-            print("Grupo:", metadata['grupo_bem_direito'])
-            print("Código:", metadata['codigo_bem_direito'])
-            print("Localização: EUA")
-            print("Discriminação: {} {} {}. Código de negociação {}. Valor total de aquisição US$ {}. Corretora Charles Schwab.".format(round(stock['quantity'], 0), type_description, metadata['long_name'], stock['name'], round(stock['value'], 2)))
-            print("Situação R$:", round(stock['brl_value'], 2))
-            print("***")
+    print("Dividendos no exterior")
+    bid_quotes_by_month = report['bid_quotes_by_month']
+    paid_tax, us_dividends = report['us_dividends']
 
-            if is_debug:
-                pp.pprint(stock)
+    print("Imposto Pago/Retido - Declarar na linha 02 (Imposto pago no exterior pelo titular e pelos dependentes):", round(paid_tax, 2))
+    print("***")
 
-        brokerage_usd_value, brokerage_brl_value = collect_brokerage_account_balance(book, maximum_date_filter, quotes_by_date, year_filter)
-        print("Conta na corretora no exterior")
-        print("Grupo: 06")
-        print("Código: 01", )
-        print("Localização: EUA")
-        print("Discriminação: US$ {} em conta na corretora Charles Schwab. Número da conta: [preencher aqui]".format(brokerage_usd_value))
-        print("Situação R$:", round(brokerage_brl_value, 2))
+    for key in us_dividends:
+        dividend = us_dividends[key]
+        print("Mês", key)
+        print("Valor em R$:", round(dividend['brl_gross_value'], 2))
         print("***")
 
-        cryptos = collect_crypto(book, maximum_date_filter, minimum_date_filter)
-        for crypto in cryptos:
-            metadata = crypto['metadata']
-
-            print(crypto['name'])
-            print("Grupo:", metadata['grupo_bem_direito'])
-            print("Código:", metadata['codigo_bem_direito'])
-            print("Discriminação: {} {} - {}".format(crypto['quantity'], crypto['name'], metadata['long_name']))
-            print("Situação R$:", round(crypto['value'], 2))
+    if is_debug:
+        pp.pprint(bid_quotes_by_month)
+        pp.pprint(paid_tax)
+        pp.pprint(us_dividends)
+    print("******")
+    print("Rendimentos de FIIs")
+    proventos_fiis = report['proventos_fiis']
+    for key in proventos_fiis:
+
+        provento = proventos_fiis[key]
+        if provento['proventos'] != 0:
+            need_additional_data.update(provento['fiis'])
+
+            print(key)
+            print(provento['fiis'])
+            print("Nome da fonte pagadora:", provento['long_name'])
+            print("Rendimento:", provento['proventos'])
             print("***")
 
-            if is_debug:
-                pp.pprint(crypto)
-
+    print("******")
+    print("Bonificações")
+    bonificacoes = report['bonificacoes']
+    for bonificacao in bonificacoes:
+        print(bonificacao)
+    print("**************************")
+
+    print("******* Papéis que estiveram na carteira ou que receberam proventos durante {} ******".format(year_filter))
+    print("(Para saber quais informes devem ser coletados)")
+    for papel in need_additional_data:
+        print(papel)
+    print("**************************")
+
+
+def format_market_quantity(quantity):
+    return '{:.8f}'.format(quantity).rstrip('0').rstrip('.')
+
+
+def print_market_values(dates, accounts, values):
+    for column, market_date in enumerate(dates):
+        print("************* Valor de mercado em {} *************".format(market_date))
+        print("Cotação USDBRL (compra): {}".format(values.usdbrl[column]))
+
+        without_price = []
+        for row, (parent_name, name) in enumerate(accounts):
+            quantity = values.quantity[row, column]
+            if quantity == 0:
+                continue
+            # no price up to the date, or a price in US$ before the first quote
+            if np.isnan(values.value[row, column]):
+                without_price.append('{}/{}'.format(parent_name, name))
+                continue
+
+            print("{}/{}: {} x {} {} ({}) = R$ {:.2f}".format(parent_name, name, format_market_quantity(quantity), values.price[row, column],
+                                                             values.currency[row, column], date.fromordinal(int(values.price_ordinal[row, column])),
+                                                             values.value[row, column]))
+
+        print("Total R$ {:.2f}".format(np.nansum(values.value[:, column])))
+        if without_price:
+            print("Sem cotação até {}: {}".format(market_date, ', '.join(without_price)))
         print("**************************")
-        print()
-        print()
-
-        all_sales = br_sales + stock_sales
-        sales_info = extract_sales_info(all_sales)
-        if is_debug:
-            pp.pprint("sales_info")
-            pp.pprint(sales_info)
-            pp.pprint("all_sales")
-            pp.pprint(all_sales)
-
-        print("************* RV Agregado (exclui ETFs BR e FIIs) *************")
-        print("A ser declarado em Rendimentos Isentos e Não tributáveis")
-
-        acoes_aggregated_profit = sales_info['aggregated']['acoes']['aggregated_profits']
-        us_aggregated_profits = sales_info['aggregated']['us']['aggregated_profits']
-        acoes_dedo_duro = sales_info['aggregated']['acoes']['dedo_duro']
-        print("20 - Ganhos líquidos em operações no mercado à vista de ações: ", round(acoes_aggregated_profit, 2))
-        print("5 - Ganho de capital na alienação de bem, direito ou conjunto de bens ou direitos da mesma natureza, alienados em um mesmo mês, de valor total de alienação até R$ 20.000,00, para ações alienadas no mercado de balcão, e R$ 35.000,00, nos demais casos (Lucro com venda no exterior) (Declarar apenas se for valor positivo): ", round(us_aggregated_profits, 2))
-        print("Imposto Pago/Retido (Imposto Pago/Retido na linha 03) (dedo-duro): ", round(acoes_dedo_duro, 2))
-
-        print("**************************")
-
-        print("************* RV mês a mês *************")
-        print("Operações comuns/Day-trade - Mercado à vista")
-        print("Venda de ações com prejuízo, vendas em mês com mais de 20k ou vendas de ETFs")
-        if is_debug:
-            pp.pprint(sales_info['monthly']['acoes+etfs'])
-
-        print("** ATENÇÃO: Antes de pagar qualquer imposto, não se esqueça de conferir se há prejuízo acumulado!")
-        for key in sales_info['monthly']['acoes+etfs'].keys():
-            current = sales_info['monthly']['acoes+etfs'][key]
-            resultado = current['aggregated_profits']
-            ir_fonte = current['dedo_duro']
-            imposto = current['imposto']
-
-            if resultado != 0:
-                print("Mês:", key)
-                print("    Resultado", round(resultado, 2))
-                print("    IR Fonte", round(ir_fonte, 2))
-                print("    Valor do imposto", round(imposto, 2))
 
-        print("***")
-        print("Operações FIIs")
-        print("** ATENÇÃO: Antes de pagar qualquer imposto, não se esqueça de conferir se há prejuízo acumulado!")
-        if is_debug:
-            pp.pprint(sales_info['monthly']['fiis'])
 
-        for key in sales_info['monthly']['fiis'].keys():
-            current = sales_info['monthly']['fiis'][key]
-            resultado = current['aggregated_profits']
-            ir_fonte = current['dedo_duro']
-            imposto = current['imposto']
+def run(arguments):
+    gnucash_db_path = arguments.gnucash_db_path
+    quotes_csv_path = arguments.quotes_csv_path
+    years = arguments.years or arguments.year_filter or []
+    workers = arguments.workers
 
-            if resultado != 0:
-                print("Mês:", key)
-                print("    Resultado", round(resultado, 2))
-                print("    IR Fonte", round(ir_fonte, 2))
-                print("    Valor do imposto", round(imposto, 2))
+    with phase('retrieve_usdbrl_quotes'):
+        quotes_by_date = retrieve_usdbrl_quotes(quotes_csv_path)
 
-        print("***")
-        print("Vendas no exterior que geraram impostos")
-        for key in sales_info['monthly']['us'].keys():
-            current = sales_info['monthly']['us'][key]
-            resultado = current['aggregated_profits']
-            imposto = current['imposto']
+    is_debug = bool(arguments.is_debug) or arguments.debug
 
-            if resultado != 0:
-                print("Mês:", key)
-                print("    Resultado", round(resultado, 2))
-                print("    Valor do imposto", round(imposto, 2))
+    # the sidecar is only needed to replay years, and not at all when the book's directory must stay untouched
+    checkpoints = open_checkpoints(checkpoints_path(gnucash_db_path)) if years and not arguments.no_checkpoints else None
 
-        print("**************************")
+    with open_book(gnucash_db_path, readonly=True, do_backup=False, open_if_lock=True) as book:
+        reports = collect_reports(book, years, quotes_by_date, quotes_csv_path, checkpoints, workers) if years else {}
+        if arguments.market_value:
+            with phase('collect_market_values'):
+                market_accounts, market = collect_market_values(book, quotes_by_date, arguments.market_value)
 
-        print("************* Rendimentos *************")
-        proventos = collect_proventos(book, minimum_date_filter, maximum_date_filter)
-        print("JCP: Rendimentos Sujeitos à Tributação Exclusiva/Definitiva, código 10")
-        for key in proventos:
-            provento = proventos[key]
-            if provento['JCP'] != 0:
-                need_additional_data.add(key)
-
-                print(key)
-                print("Fonte pagadora:", provento['fonte_pagadora'])
-                print("Nome da fonte pagadora:", provento['long_name'])
-                print("JCP:", provento['JCP'])
-                print("***")
-
-        print("******")
-        print("Dividendos: Rendimentos Isentos e Não tributáveis, código 9")
-        for key in proventos:
-
-            provento = proventos[key]
-            if provento['Dividendos'] != 0:
-                need_additional_data.add(key)
-
-                print(key)
-                print("Fonte pagadora:", provento['fonte_pagadora'])
-                print("Nome da fonte pagadora:", provento['long_name'])
-                print("Dividendos:", provento['Dividendos'])
-                print("***")
+    with phase('print_report'):
+        for index, year in enumerate(years):
+            if index > 0:
+                print()
+                print()
 
-        if is_debug:
-            pp.pprint(proventos)
-        print("******")
+            print_report(year, reports[year], is_debug)
 
-        print("Dividendos no exterior")
-        bid_quotes_by_month = get_us_dividend_usdbrl_quotes(quotes_by_date, int(year_filter))
-        paid_tax, us_dividends = collect_us_dividends(book, minimum_date_filter, maximum_date_filter, bid_quotes_by_month)
+    if arguments.market_value:
+        with phase('print_market_values'):
+            if years:
+                print()
+                print()
+            print_market_values(arguments.market_value, market_accounts, market)
 
-        print("Imposto Pago/Retido - Declarar na linha 02 (Imposto pago no exterior pelo titular e pelos dependentes):", round(paid_tax, 2))
-        print("***")
 
-        for key in us_dividends:
-            dividend = us_dividends[key]
-            print("Mês", key)
-            print("Valor em R$:", round(dividend['brl_gross_value'], 2))
-            print("***")
-
-        if is_debug:
-            pp.pprint(bid_quotes_by_month)
-            pp.pprint(paid_tax)
-            pp.pprint(us_dividends)
-        print("******")
-        print("Rendimentos de FIIs")
-        proventos_fiis = collect_proventos_fiis(book, minimum_date_filter, maximum_date_filter)
-        for key in proventos_fiis:
-
-            provento = proventos_fiis[key]
-            if provento['proventos'] != 0:
-                need_additional_data.update(provento['fiis'])
-
-                print(key)
-                print(provento['fiis'])
-                print("Nome da fonte pagadora:", provento['long_name'])
-                print("Rendimento:", provento['proventos'])
-                print("***")
-
-        print("******")
-        print("Bonificações")
-        bonificacoes = collect_bonificacoes(book, minimum_date_filter, maximum_date_filter)
-        for bonificacao in bonificacoes:
-            print(bonificacao)
-        print("**************************")
+def main():
+    arguments = parse_arguments()
 
-        print("******* Papéis que estiveram na carteira ou que receberam proventos durante {} ******".format(year_filter))
-        print("(Para saber quais informes devem ser coletados)")
-        for papel in need_additional_data:
-            print(papel)
-        print("**************************")
+    if arguments.profile is None:
+        run(arguments)
+    else:
+        with Profiler(arguments.profile):
+            run(arguments)
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import json
+
+from piecash import Account
+
+# accounts under these parents hold investments and carry their metadata as JSON in the description
+INVESTMENT_PARENTS = ['Ações', 'FIIs', 'Ações no exterior', 'Crypto']
+
+IR_GROUP_BY_TYPE = {'etf': 7, 'us etf': 7, 'fii': 7, 'acao': 3, 'bdr': 4, 'us stock': 3, 'reit': 3, 'btc': 8, 'crypto': 8}
+IR_CODE_BY_TYPE = {'etf': 9, 'us etf': 9, 'fii': 3, 'acao': 1, 'bdr': 4, 'us stock': 1, 'reit': 1, 'btc': 1, 'crypto': 2}
+
+
+def parse_metadata(name, description):
+    try:
+        metadata = json.loads(description)
+    except (TypeError, ValueError):
+        raise ValueError("Metadata JSON could not be read for {}".format(name))
+
+    if not isinstance(metadata, dict) or not 'type' in metadata:
+        raise ValueError("The type field not found for {}".format(name))
+
+    if metadata['type'] not in IR_GROUP_BY_TYPE:
+        raise ValueError("The type for {} is not valid".format(name))
+
+    metadata['grupo_bem_direito'] = IR_GROUP_BY_TYPE[metadata['type']]
+    metadata['codigo_bem_direito'] = IR_CODE_BY_TYPE[metadata['type']]
+
+    return metadata
+
+
+class AccountMetadata:
+    """Parsed metadata of every investment account, by guid and by parent and account name."""
+
+    def __init__(self, by_guid, by_name):
+        self.by_guid = by_guid
+        self.by_name = by_name
+
+    def __len__(self):
+        return len(self.by_guid)
+
+    def of(self, account_guid):
+        return self.by_guid[account_guid]
+
+    def named(self, parent_name, name):
+        return self.by_name[(parent_name, name)]
+
+
+def load_account_metadata(book, parent_names=INVESTMENT_PARENTS):
+    parent_name_by_guid = {book.accounts(name=parent_name).guid: parent_name for parent_name in parent_names}
+    accounts = (book.session.query(Account.guid, Account.name, Account.description, Account.parent_guid)
+                .filter(Account.parent_guid.in_(list(parent_name_by_guid))))
+
+    by_guid = {}
+    by_name = {}
+    errors = []
+    for guid, name, description, parent_guid in accounts:
+        try:
+            metadata = parse_metadata(name, description)
+        except ValueError as e:
+            errors.append(str(e))
+            continue
+
+        by_guid[guid] = metadata
+        by_name[(parent_name_by_guid[parent_guid], name)] = metadata
+
+    # every broken account is reported at once, so they can all be fixed before running again
+    if errors:
+        raise Exception("Invalid metadata in {} accounts:\n{}".format(len(errors), '\n'.join(sorted(errors))))
+
+    return AccountMetadata(by_guid, by_name)
@@ -0,0 +1,185 @@
+import os
+import csv
+import mmap
+import struct
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from decimal import Decimal
+from datetime import date
+
+Quote = namedtuple('Quote', ['date', 'bid', 'ask'])
+
+# PTAX quotes have 4 decimal places, so the cache keeps them as integers scaled by 10^4
+QUOTES_SCALE = 4
+QUOTES_CACHE_MAGIC = b'USDBRLQ1'
+# magic, size and mtime of the source csv, number of quotes
+QUOTES_CACHE_HEADER = struct.Struct('=8sqqq')
+
+
+class QuoteIndex:
+    """USDBRL quotes sorted by date, stored as parallel arrays of date ordinals, bids and asks.
+
+    Lookups bisect the ordinals, so finding the closest quote before a weekend or a holiday costs the same as an exact
+    match.
+    """
+
+    def __init__(self, ordinals, bids, asks):
+        self.ordinals = ordinals
+        self.bids = bids
+        self.asks = asks
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def __reduce__(self):
+        # memory-mapped columns cannot be pickled, so worker processes get plain copies
+        return (QuoteIndex, (array('l', self.ordinals), list(self.bids), list(self.asks)))
+
+    def quote_at(self, position):
+        return Quote(date.fromordinal(self.ordinals[position]), self.bids[position], self.asks[position])
+
+    def exact(self, day):
+        ordinal = day.toordinal()
+        position = bisect_left(self.ordinals, ordinal)
+        if position == len(self.ordinals) or self.ordinals[position] != ordinal:
+            raise KeyError(day)
+
+        return self.quote_at(position)
+
+    def latest(self, day, not_before=None):
+        # the last quote on or before day, optionally no older than not_before
+        position = bisect_right(self.ordinals, day.toordinal()) - 1
+        if position < 0 or (not_before is not None and self.ordinals[position] < not_before.toordinal()):
+            raise KeyError(day)
+
+        return self.quote_at(position)
+
+    def first_half_of_month(self, year, month):
+        return self.latest(date(year, month, 15), not_before=date(year, month, 1))
+
+
+class FixedPointColumn:
+    """Read-only sequence of Decimals over a column of integers scaled by 10^QUOTES_SCALE"""
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, position):
+        return Decimal(self.values[position]).scaleb(-QUOTES_SCALE)
+
+
+def parse_quote_date(raw_date):
+    # dates come as ddmmyyyy
+    return date(int(raw_date[4:]), int(raw_date[2:4]), int(raw_date[:2]))
+
+
+def parse_usdbrl_quotes(quotes_csv_path):
+    quotes_by_ordinal = {}
+
+    with open(quotes_csv_path,  newline='') as csv_file:
+        reader = csv.DictReader(csv_file, delimiter = ';')
+        for row in reader:
+            # PTAX history files may carry other currencies as well
+            if row['moeda'] != 'USD':
+                continue
+
+            ordinal = parse_quote_date(row['data']).toordinal()
+            bid = row['compra']
+            ask = row['venda']
+
+            quotes_by_ordinal[ordinal] = (Decimal(bid.replace(',', '.')), Decimal(ask.replace(',', '.')))
+
+    ordinals = array('l', sorted(quotes_by_ordinal))
+    bids = [quotes_by_ordinal[ordinal][0] for ordinal in ordinals]
+    asks = [quotes_by_ordinal[ordinal][1] for ordinal in ordinals]
+
+    return QuoteIndex(ordinals, bids, asks)
+
+
+def quotes_cache_path(quotes_csv_path):
+    return quotes_csv_path + '.cache'
+
+
+def padded_size(size):
+    return size + (-size % 8)
+
+
+def read_quotes_cache(cache_path, source_stat):
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            if os.fstat(cache_file.fileno()).st_size < QUOTES_CACHE_HEADER.size:
+                return None
+
+            mapped = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+
+    magic, source_size, source_mtime, count = QUOTES_CACHE_HEADER.unpack_from(mapped)
+    ordinals_size = padded_size(count * 4)
+    expected_size = QUOTES_CACHE_HEADER.size + ordinals_size + 2 * count * 8
+    if magic != QUOTES_CACHE_MAGIC or source_size != source_stat.st_size or source_mtime != source_stat.st_mtime_ns or len(mapped) != expected_size:
+        mapped.close()
+        return None
+
+    view = memoryview(mapped)
+    offset = QUOTES_CACHE_HEADER.size
+    ordinals = view[offset:offset + count * 4].cast('i')
+    offset += ordinals_size
+    bids = view[offset:offset + count * 8].cast('q')
+    offset += count * 8
+    asks = view[offset:offset + count * 8].cast('q')
+
+    return QuoteIndex(ordinals, FixedPointColumn(bids), FixedPointColumn(asks))
+
+
+def to_fixed_point(values):
+    scaled = array('q')
+    for value in values:
+        scaled_value = value.scaleb(QUOTES_SCALE)
+        if scaled_value != scaled_value.to_integral_value():
+            return None
+
+        scaled.append(int(scaled_value))
+
+    return scaled
+
+
+def write_quotes_cache(cache_path, source_stat, quotes):
+    bids = to_fixed_point(quotes.bids)
+    asks = to_fixed_point(quotes.asks)
+    if bids is None or asks is None:
+        # more decimal places than the cache can hold, the csv will just be parsed every time
+        return
+
+    count = len(quotes)
+    ordinals = array('i', quotes.ordinals).tobytes()
+    header = QUOTES_CACHE_HEADER.pack(QUOTES_CACHE_MAGIC, source_stat.st_size, source_stat.st_mtime_ns, count)
+
+    temporary_path = cache_path + '.tmp'
+    try:
+        with open(temporary_path, 'wb') as cache_file:
+            cache_file.write(header)
+            cache_file.write(ordinals.ljust(padded_size(len(ordinals)), b'\0'))
+            cache_file.write(bids.tobytes())
+            cache_file.write(asks.tobytes())
+        os.replace(temporary_path, cache_path)
+    except OSError as e:
+        print('Could not write the quotes cache {}: {}'.format(cache_path, e))
+
+
+def retrieve_usdbrl_quotes(quotes_csv_path):
+    # the parsed csv is kept in a memory-mapped cache next to it, valid while the csv keeps its size and mtime
+    source_stat = os.stat(quotes_csv_path)
+    cache_path = quotes_cache_path(quotes_csv_path)
+
+    quotes = read_quotes_cache(cache_path, source_stat)
+    if quotes is None:
+        quotes = parse_usdbrl_quotes(quotes_csv_path)
+        write_quotes_cache(cache_path, source_stat, quotes)
+
+    return quotes
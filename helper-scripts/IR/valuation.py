@@ -0,0 +1,118 @@
+"""Market value of the investment accounts at any dates, from the prices in the book.
+
+The prices are loaded once into arrays sorted by commodity and day, and the quantity each account held into arrays
+sorted by account and day. The price and quantity on or before every date of every account are then found with a single
+searchsorted over all of them, instead of a query per account and date. Prices in US$ are converted with the PTAX bid
+of the valuation date.
+"""
+from collections import namedtuple
+from itertools import accumulate
+
+import numpy as np
+
+from quotes import QUOTES_SCALE, FixedPointColumn
+
+# date ordinals stay below 2^20 until the year 2870, so a series and a day fit in a single sort key
+DAY_SPAN = 1 << 20
+
+MarketValues = namedtuple('MarketValues', ['quantity', 'price', 'currency', 'price_ordinal', 'usdbrl', 'value'])
+
+
+class AsOfIndex:
+    """Columns of values of many series, sorted by series and day, looked up as of many days at once.
+
+    Rows of the same series and day keep the order they were given in, so the last of them is the one found.
+    """
+
+    def __init__(self, series, ordinals, *columns):
+        series = np.asarray(series, dtype=np.int64)
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        order = np.argsort(series * DAY_SPAN + ordinals, kind='stable')
+
+        self.series = series[order]
+        self.ordinals = ordinals[order]
+        self.keys = self.series * DAY_SPAN + self.ordinals
+        self.columns = [np.asarray(column)[order] for column in columns]
+
+    def find(self, series, ordinals):
+        # position of the last row of each series on or before each day, -1 where the series has none yet. series and
+        # ordinals are broadcast against each other, so accounts x dates grids come from a column and a row
+        series, ordinals = np.broadcast_arrays(np.asarray(series, dtype=np.int64), np.asarray(ordinals, dtype=np.int64))
+        positions = np.searchsorted(self.keys, series * DAY_SPAN + ordinals, side='right') - 1
+
+        found = positions >= 0
+        found[found] = self.series[positions[found]] == series[found]
+        return np.where(found, positions, -1)
+
+    def take(self, column, positions, missing=np.nan):
+        if not len(self.keys):
+            return np.full(positions.shape, missing)
+
+        return np.where(positions >= 0, self.columns[column][positions], missing)
+
+
+class PriceIndex:
+    """Every price of the book, as of any day, by commodity guid."""
+
+    def __init__(self, commodity_guids, ordinals, values, currencies):
+        self.series_by_guid = {guid: series for series, guid in enumerate(dict.fromkeys(commodity_guids))}
+        self.currencies = sorted(set(currencies))
+
+        currency_codes = {currency: code for code, currency in enumerate(self.currencies)}
+        self.index = AsOfIndex([self.series_by_guid[guid] for guid in commodity_guids], ordinals, values,
+                               np.array([currency_codes[currency] for currency in currencies], dtype=np.int64), ordinals)
+
+    def __len__(self):
+        return len(self.index.keys)
+
+    def series(self, commodity_guids):
+        # commodities without prices get a series no price belongs to
+        return np.array([self.series_by_guid.get(guid, -1) for guid in commodity_guids], dtype=np.int64)
+
+    def as_of(self, commodity_guids, ordinals):
+        # the value, currency and date ordinal of the last price on or before each day, a commodities x days grid
+        positions = self.index.find(self.series(commodity_guids)[:, None], np.asarray(ordinals)[None, :])
+        currencies = np.array(self.currencies + [None], dtype=object)[self.index.take(1, positions, missing=-1).astype(np.int64)]
+
+        return self.index.take(0, positions), currencies, self.index.take(2, positions, missing=-1).astype(np.int64)
+
+
+def quantity_index(account_guids, splits_by_account):
+    # the quantity each account held after every day it had splits, the splits of each account in date order
+    series, ordinals, held = [], [], []
+    for account_series, account_guid in enumerate(account_guids):
+        splits = splits_by_account.get(account_guid, [])
+        series.extend([account_series] * len(splits))
+        ordinals.extend(split.post_date.toordinal() for split in splits)
+        # summed as the book's decimals, so a position sold out is exactly zero and not a float residue of it
+        held.extend(float(quantity) for quantity in accumulate(split.quantity for split in splits))
+
+    return AsOfIndex(series, ordinals, held)
+
+
+def usdbrl_bids(quotes_by_date, ordinals):
+    # the PTAX bid of the last quote on or before each day, NaN before the first one
+    quote_ordinals = np.asarray(quotes_by_date.ordinals, dtype=np.int64)
+    if isinstance(quotes_by_date.bids, FixedPointColumn):
+        bids = np.asarray(quotes_by_date.bids.values, dtype=np.int64) / 10 ** QUOTES_SCALE
+    else:
+        bids = np.array([float(bid) for bid in quotes_by_date.bids])
+
+    positions = np.searchsorted(quote_ordinals, np.asarray(ordinals, dtype=np.int64), side='right') - 1
+    return np.where(positions >= 0, bids[positions], np.nan)
+
+
+def market_values(account_guids, commodity_guids, splits_by_account, prices, quotes_by_date, dates):
+    # accounts x dates grids of the quantity held, the last price on or before each date and the value in R$. Accounts
+    # without a position are worth zero even without a price, held ones without a price or quote are NaN
+    ordinals = np.array([day.toordinal() for day in dates], dtype=np.int64)
+
+    quantities = quantity_index(account_guids, splits_by_account)
+    quantity = quantities.take(0, quantities.find(np.arange(len(account_guids))[:, None], ordinals[None, :]), missing=0.0)
+    price, currency, price_ordinal = prices.as_of(commodity_guids, ordinals)
+
+    usdbrl = usdbrl_bids(quotes_by_date, ordinals)
+    rate = np.select([currency == 'BRL', currency == 'USD'], [1.0, usdbrl[None, :]], default=np.nan)
+    value = np.where(quantity == 0, 0.0, quantity * price * rate)
+
+    return MarketValues(quantity, price, currency, price_ordinal, usdbrl, value)
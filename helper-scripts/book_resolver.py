@@ -0,0 +1,78 @@
+from piecash import Account, Commodity
+
+
+class BookResolver:
+    """Commodities and accounts of a book indexed by mnemonic, name and commodity, loaded once per session.
+
+    `book.accounts(...)` and `book.commodities(...)` load every row of the table and filter them in python, besides
+    flushing the session first, so resolving them once per imported row makes imports quadratic. Missing commodities and
+    accounts are created in memory and indexed right away, they reach the database in one batch when the book is saved.
+    Lookups return the first match, like piecash does. What was created is kept in created_commodities and
+    created_accounts and the names that were not found in missing_accounts, for the dry runs to report.
+    """
+
+    def __init__(self, book):
+        self.book = book
+        self.commodities_by_mnemonic = {}
+        self.accounts_by_name = {}
+        self.accounts_by_name_and_type = {}
+        self.accounts_by_commodity = {}
+        self.created_commodities = []
+        self.created_accounts = []
+        self.missing_accounts = set()
+
+        for commodity in book.commodities:
+            self.commodities_by_mnemonic.setdefault(commodity.mnemonic, commodity)
+
+        for account in book.accounts:
+            self.index_account(account)
+
+    def index_account(self, account):
+        self.accounts_by_name.setdefault(account.name, account)
+        self.accounts_by_name_and_type.setdefault((account.name, account.type), account)
+        # commodities are keyed by identity, the guid of a new one is only set when it is flushed
+        self.accounts_by_commodity.setdefault(account.commodity, account)
+
+    def stock_commodity(self, mnemonic, namespace):
+        commodity = self.commodities_by_mnemonic.get(mnemonic)
+        if commodity is None:
+            commodity = Commodity(mnemonic=mnemonic,
+                fullname=mnemonic,
+                fraction=1,
+                namespace=namespace,
+                quote_flag=1,
+                quote_source="yahoo_json",
+                book=self.book,
+            )
+            self.commodities_by_mnemonic[mnemonic] = commodity
+            self.created_commodities.append(commodity)
+
+        return commodity
+
+    def account(self, name, type=None, create_under=None):
+        # with create_under, a missing account is created under that one with the same commodity
+        account = self.accounts_by_name.get(name) if type is None else self.accounts_by_name_and_type.get((name, type))
+        if account is not None:
+            return account
+
+        if create_under is None:
+            self.missing_accounts.add(name)
+            raise KeyError("Could not find account", name, type)
+
+        parent_account = self.account(create_under)
+        return self.create_account(name, type, parent_account, parent_account.commodity)
+
+    def account_for_commodity(self, commodity):
+        return self.accounts_by_commodity.get(commodity)
+
+    def create_account(self, name, type, parent, commodity):
+        account = Account(name=name,
+            type=type,
+            parent=parent,
+            commodity=commodity,
+            placeholder=False,
+        )
+        self.index_account(account)
+        self.created_accounts.append(account)
+
+        return account
@@ -0,0 +1,310 @@
+"""Import engine shared by the importers of the US brokers.
+
+Each importer only parses its export into records and describes the broker in a dict:
+
+    script               path of the importer script, for its usage line and default trace
+    brokerage_account    account the broker holds the cash in
+    process_csv          process_csv(csv_file, unrecognized_rows) yields the records of an export as it is read and
+                         appends the rows it does not know to unrecognized_rows
+    expense_accounts     expense account of each expense kind the broker has, None asks for it on every record
+    income_accounts      income account of each income kind the broker has
+
+Records are dicts with a 'kind' (stock, dividend, transfer or one of the expense and income kinds of the broker), the
+'date' as %m/%d/%Y, a 'description', the 'value' in dollars, the 'fingerprint' of the row and, for stocks and dividends,
+the 'symbol'. Stock records also have the 'quantity', the value of a stock record is what was paid for it. Transfer
+records also have the 'direction', incoming when the money was sent to the broker.
+"""
+import os
+import sys
+import csv
+import argparse
+import pprint
+
+from bisect import bisect_right
+from decimal import Decimal, ROUND_DOWN
+from datetime import date, datetime, timedelta
+from piecash import open_book
+from book_resolver import BookResolver
+from transaction_writer import DEFAULT_CHUNK_SIZE, DryRunWriter, TransactionWriter
+from profiling import Profiler, count_rows, default_trace_path, phase
+
+# the usdbrl.csv PTAX quotes are read the same way ir.py reads them
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'IR'))
+from quotes import retrieve_usdbrl_quotes
+
+pp = pprint.PrettyPrinter(indent=2)
+
+# IOF on foreign exchange for investments abroad by individuals, in percent, since each date. --iof-rates replaces it
+# when the transfers are taxed differently
+IOF_RATES = [(date(2008, 1, 1), Decimal('0.38')), (date(2025, 5, 23), Decimal('1.1'))]
+
+# a transfer takes the PTAX of its date or of the last business day before it, never one older than this
+MAX_QUOTE_AGE = timedelta(days=7)
+
+# the totals printed at the end of an import
+TOTALS = [('stock', 'Bought - sold stocks'), ('dividend', 'Dividends after taxes'), ('transfer', 'Transferred amount')]
+
+
+def stock_symbol(record):
+    symbol = record['symbol'].upper()
+    if ' ' in symbol:
+        symbol = symbol.replace(' ', '-')
+
+    return symbol
+
+
+def import_stock(writer, resolver, brokerage_account, stock):
+    symbol = stock_symbol(stock)
+
+    stock_commodity = resolver.stock_commodity(symbol, 'US')
+    stock_account = resolver.account_for_commodity(stock_commodity)
+    if stock_account is None:
+        stock_account = resolver.create_account(symbol, "STOCK", resolver.account('Ações no exterior'), stock_commodity)
+
+    value = Decimal(stock['value'])
+    quantity = Decimal(stock['quantity'])
+    if value < 0:
+        quantity = -quantity
+        print("******* You have sold the stock {}. Check if you should pay taxes this month!".format(symbol))
+
+    date = datetime.strptime(stock['date'], "%m/%d/%Y")
+    writer.add(brokerage_account.commodity, date.date(), stock['description'], [
+        {'value': value, 'quantity': quantity, 'account': stock_account},
+        {'value': -value, 'account': brokerage_account}
+    ], fingerprint=stock['fingerprint'])
+
+
+def read_iof_rates(iof_rates_path):
+    # lines of date (yyyy-mm-dd) and rate in percent, e.g. 2025-05-23,1.1
+    with open(iof_rates_path, newline='') as csv_file:
+        return sorted((date.fromisoformat(start.strip()), Decimal(rate.strip())) for start, rate in csv.reader(csv_file) if start.strip())
+
+
+class TransferPricing:
+    """USDBRL rate and IOF of the wire transfers, from the PTAX quotes and the IOF rate table.
+
+    Incoming transfers buy dollars at the PTAX ask and outgoing ones sell them at the bid. The quotes are only read when
+    there is a transfer to price. Transfers that cannot be priced that way are asked for when interactive, like the
+    importers always did, and stop the import otherwise.
+    """
+
+    def __init__(self, quotes_csv_path=None, iof_rates=IOF_RATES, interactive=False):
+        self.quotes_csv_path = quotes_csv_path
+        self.quotes = None
+        self.iof_starts = [start for start, _ in iof_rates]
+        self.iof_percentages = [rate for _, rate in iof_rates]
+        self.interactive = interactive
+
+    def iof_rate(self, day):
+        position = bisect_right(self.iof_starts, day) - 1
+        if position < 0:
+            raise KeyError(day)
+
+        return self.iof_percentages[position] / 100
+
+    def quote(self, day):
+        if self.quotes_csv_path is None:
+            raise KeyError(day)
+
+        if self.quotes is None:
+            self.quotes = retrieve_usdbrl_quotes(self.quotes_csv_path)
+
+        return self.quotes.latest(day, not_before=day - MAX_QUOTE_AGE)
+
+    def price(self, day, value, direction):
+        # returns the BRL value of the transfer and its IOF
+        try:
+            quote = self.quote(day)
+            usdbrl = quote.ask if direction == 'incoming' else quote.bid
+            iof_rate = self.iof_rate(day)
+        except KeyError:
+            if not self.interactive:
+                raise Exception("No USDBRL quote or IOF rate for the transfer made on {} of ${}, pass a more recent --usdbrl file or --interactive".format(day, value))
+
+            print("Enter the USDBRL conversion rate for the transfer made on {} of ${}".format(day, value))
+            usdbrl = Decimal(input())
+            brl = value * usdbrl
+            brl = brl.quantize(Decimal('.01'), rounding=ROUND_DOWN) # round correctly to monetary value after multiplication
+
+            print("Enter the IOF value for the transfer made on {} of ${}".format(day, value))
+            return brl, Decimal(input())
+
+        brl = (value * usdbrl).quantize(Decimal('.01'), rounding=ROUND_DOWN)
+        iof = (abs(brl) * iof_rate).quantize(Decimal('.01'), rounding=ROUND_DOWN)
+        print("Transfer made on {} of ${}: USDBRL {} from the PTAX of {}, IOF of {}%".format(day, value, usdbrl, quote.date, (iof_rate * 100).normalize()))
+
+        return brl, iof
+
+
+def import_transfer(writer, resolver, brokerage_account, transfer_pricing, transfer):
+    bank_account = resolver.account('Conta no Inter')
+    value = Decimal(transfer['value'])
+    date = datetime.strptime(transfer['date'], "%m/%d/%Y")
+    brl, iof = transfer_pricing.price(date.date(), value, transfer['direction'])
+
+    iof_account = resolver.account('IOF de remessas internacionais')
+    writer.add(bank_account.commodity, date.date(), transfer['description'], [
+        {'value': brl, 'quantity': value, 'account': brokerage_account},
+        {'value': iof, 'account': iof_account},
+        {'value': -(brl + iof), 'account': bank_account}
+    ], fingerprint=transfer['fingerprint'])
+
+
+def import_dividend(writer, resolver, brokerage_account, dividend):
+    dividend_account = resolver.account(stock_symbol(dividend), 'INCOME', create_under='US Dividends')
+
+    value = Decimal(dividend['value'])
+    date = datetime.strptime(dividend['date'], "%m/%d/%Y")
+    writer.add(brokerage_account.commodity, date.date(), dividend['description'], [
+        {'value': -value, 'account': dividend_account},
+        {'value': value, 'account': brokerage_account}
+    ], fingerprint=dividend['fingerprint'])
+
+
+def import_expense(writer, resolver, brokerage_account, expense, expense_account_name=None):
+    value = Decimal(expense['value'])
+    date = datetime.strptime(expense['date'], "%m/%d/%Y")
+    description = expense['description']
+
+    if expense_account_name is None and writer.dry_run:
+        expense_account = writer.asked_account("the expense account for the purchase {} made on {} of ${}".format(description, date, value),
+                                               'Asked on import', 'EXPENSE', brokerage_account.commodity)
+    else:
+        if expense_account_name is None:
+            print("Enter the expense account for the purchase {} made on {} of ${}".format(description, date, value))
+            expense_account_name = input()
+
+        expense_account = resolver.account(expense_account_name, 'EXPENSE')
+
+    writer.add(brokerage_account.commodity, date.date(), description, [
+        {'value': -value, 'account': expense_account},
+        {'value': value, 'account': brokerage_account}
+    ], fingerprint=expense['fingerprint'])
+
+
+def import_income(writer, resolver, brokerage_account, income, income_account_name):
+    value = Decimal(income['value'])
+    date = datetime.strptime(income['date'], "%m/%d/%Y")
+
+    income_account = resolver.account(income_account_name, 'INCOME')
+    writer.add(brokerage_account.commodity, date.date(), income['description'], [
+        {'value': -value, 'account': income_account},
+        {'value': value, 'account': brokerage_account}
+    ], fingerprint=income['fingerprint'])
+
+
+def import_record(writer, resolver, brokerage_account, transfer_pricing, broker, record):
+    kind = record['kind']
+    if kind == 'stock':
+        import_stock(writer, resolver, brokerage_account, record)
+    elif kind == 'transfer':
+        import_transfer(writer, resolver, brokerage_account, transfer_pricing, record)
+    elif kind == 'dividend':
+        import_dividend(writer, resolver, brokerage_account, record)
+    elif kind in broker.get('expense_accounts', {}):
+        import_expense(writer, resolver, brokerage_account, record, broker['expense_accounts'][kind])
+    else:
+        import_income(writer, resolver, brokerage_account, record, broker['income_accounts'][kind])
+
+
+def write_to_gnucash(gnucash_db_path, broker, records, transfer_pricing, chunk_size=DEFAULT_CHUNK_SIZE, echo_ledger=True, dry_run=False):
+    # a dry run reads the book, even while GnuCash has it open, and checks every record without writing any of them
+    with open_book(gnucash_db_path, readonly=dry_run, open_if_lock=dry_run, do_backup=not dry_run) as book:
+        resolver = BookResolver(book)
+        writer = DryRunWriter(book, echo_ledger) if dry_run else TransactionWriter(book, chunk_size, echo_ledger)
+        brokerage_account = resolver.account(broker['brokerage_account'])
+
+        # records are written as they are read, only their count and the totals are kept
+        imported = {}
+        totals = {kind: Decimal(0) for kind, _ in TOTALS}
+        skipped = 0
+        problems = []
+
+        for record in records:
+            # rows of overlapping exports that were already imported are left out
+            if writer.is_imported(record['fingerprint']):
+                skipped += 1
+                continue
+
+            try:
+                import_record(writer, resolver, brokerage_account, transfer_pricing, broker, record)
+            except Exception as error:
+                if not dry_run:
+                    raise
+
+                problems.append(("{} {}".format(record['date'], record['description']), error))
+                continue
+
+            kind = record['kind']
+            imported[kind] = imported.get(kind, 0) + 1
+            if kind in totals:
+                totals[kind] += record['value']
+
+        writer.close()
+
+        if skipped:
+            print("Skipped {} rows already imported".format(skipped))
+
+        print("{} {} transactions".format('Would import' if dry_run else 'Imported', ', '.join('{} {}'.format(count, kind) for kind, count in imported.items()) or 'no'))
+        for kind, label in TOTALS:
+            print("{}: ${}".format(label, totals[kind]))
+
+        if dry_run:
+            cash_accounts = [brokerage_account] + [account for account in writer.changes if account.name == 'Conta no Inter']
+            writer.report(resolver, cash_accounts, problems)
+
+
+def parse_arguments(broker):
+    script = os.path.basename(broker['script'])
+    parser = argparse.ArgumentParser(usage='{} file_path gnucash_db_path only_check_csv (optional) [--usdbrl QUOTES_CSV] [--iof-rates CSV] [--interactive] [--dry-run] [--chunk-size N] [--no-ledger] [--profile [TRACE]]'.format(script))
+    parser.add_argument('file_path')
+    parser.add_argument('gnucash_db_path')
+    parser.add_argument('only_check_csv', nargs='?')
+    parser.add_argument('--usdbrl', dest='quotes_csv_path', metavar='QUOTES_CSV', help='PTAX quotes, in the usdbrl.csv format ir.py reads, that price the wire transfers')
+    parser.add_argument('--iof-rates', dest='iof_rates_path', metavar='CSV', help='IOF rates in percent since each date, as yyyy-mm-dd,rate lines (default: {})'.format(', '.join('{}%% since {}'.format(rate, start) for start, rate in IOF_RATES)))
+    parser.add_argument('--interactive', action='store_true', help='asks the rate and IOF of the transfers that the quotes do not cover instead of stopping')
+    parser.add_argument('--dry-run', action='store_true', help='checks the export against the book, which is only read, and reports what importing it would do')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='saves the book every N transactions (default: {})'.format(DEFAULT_CHUNK_SIZE))
+    parser.add_argument('--no-ledger', dest='echo_ledger', action='store_false', help='does not print every imported transaction')
+    parser.add_argument('--profile', nargs='?', const=default_trace_path(broker['script']), metavar='TRACE', help='prints time, SQL statements, rows and peak memory per phase to stderr and appends a JSONL trace to TRACE')
+
+    return parser.parse_args()
+
+
+def run(arguments, broker):
+    only_check_csv = arguments.only_check_csv is not None
+    unrecognized_rows = []
+    with open(arguments.file_path,  newline='') as csv_file:
+        # the rows are parsed while they are written, so a single phase covers both
+        records = broker['process_csv'](csv_file, unrecognized_rows)
+
+        if only_check_csv:
+            with phase('process_csv'):
+                for record in records:
+                    count_rows(1)
+                    pp.pprint(record)
+        else:
+            iof_rates = read_iof_rates(arguments.iof_rates_path) if arguments.iof_rates_path else IOF_RATES
+            transfer_pricing = TransferPricing(arguments.quotes_csv_path, iof_rates, arguments.interactive and not arguments.dry_run)
+
+            with phase('dry_run' if arguments.dry_run else 'write_to_gnucash'):
+                write_to_gnucash(arguments.gnucash_db_path, broker, records, transfer_pricing, arguments.chunk_size, arguments.echo_ledger and not arguments.dry_run, arguments.dry_run)
+
+    print_unrecognized_rows(unrecognized_rows)
+
+
+def print_unrecognized_rows(unrecognized_rows):
+    if unrecognized_rows:
+        print("{} rows could not be recognized and were not imported:".format(len(unrecognized_rows)))
+        for row in unrecognized_rows:
+            pp.pprint(row)
+
+
+def main(broker):
+    arguments = parse_arguments(broker)
+
+    if arguments.profile is None:
+        run(arguments, broker)
+    else:
+        with Profiler(arguments.profile):
+            run(arguments, broker)
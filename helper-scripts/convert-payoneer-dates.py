@@ -1,21 +1,153 @@
-import sys
+import argparse
+import os
 
 import csv
 from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+import broker_import
+from transaction_writer import RowFingerprints
+from profiling import Profiler, count_rows, default_trace_path, phase
+from worker_pool import map_in_pool
 
-f_path = sys.argv[1]
+# Payoneer exports have the date, description and amount in their first columns, with dates like '17 Jan, 2025'.
+# Each export is either converted to a .formatted copy with the dates as dd-mm-yyyy or imported straight into the book
 
-with open(f_path,  newline='') as csv_file:
-    with open(f_path + '.formatted', 'w', newline='') as csv_write:
-        reader = csv.reader(csv_file, delimiter = ',', quotechar='"')
-        next(reader)
+PAYONEER_DATE_FORMAT = '%d %b, %Y'
+FORMATTED_DATE_FORMAT = '%d-%m-%Y'
 
-        field_names = ['date', 'description', 'amount']
-        writer = csv.DictWriter(csv_write, fieldnames=field_names)
-        writer.writeheader()
 
-        for row in reader:
-            formatted =  datetime.strptime(row[0], '%d %b, %Y')
-            formatted_time = formatted.strftime('%d-%m-%Y')
+@lru_cache(maxsize=None)
+def reformat_date(raw_date, date_format):
+    # exports repeat the same few hundred dates, so each of them is parsed once per process
+    return datetime.strptime(raw_date, PAYONEER_DATE_FORMAT).strftime(date_format)
 
-            writer.writerow({'date': formatted_time, 'description': row[1], 'amount': row[2]})
+
+def export_rows(csv_file):
+    reader = csv.reader(csv_file, delimiter = ',', quotechar='"')
+    next(reader)
+
+    return reader
+
+
+def convert_file(f_path):
+    # returns the number of rows converted, they are written as they are read
+    rows = 0
+    with open(f_path,  newline='') as csv_file:
+        with open(f_path + '.formatted', 'w', newline='') as csv_write:
+            field_names = ['date', 'description', 'amount']
+            writer = csv.DictWriter(csv_write, fieldnames=field_names)
+            writer.writeheader()
+
+            for row in export_rows(csv_file):
+                writer.writerow({'date': reformat_date(row[0], FORMATTED_DATE_FORMAT), 'description': row[1], 'amount': row[2]})
+                rows += 1
+
+    return rows
+
+
+def convert_files(file_paths, workers):
+    return map_in_pool(convert_file, file_paths, workers)
+
+
+def find_export_files(paths):
+    # paths are export files or directories with them, the .formatted copies of earlier runs are left out
+    file_paths = []
+    for path in paths:
+        if not os.path.isdir(path):
+            file_paths.append(path)
+            continue
+
+        for root, directories, files in os.walk(path):
+            for f in files:
+                if f.lower().endswith('.csv'):
+                    file_paths.append(os.path.join(root, f))
+
+    return sorted(file_paths)
+
+
+def process_csv(csv_file, unrecognized_rows):
+    # yields a record per row as the export is read, payments received are incomes and everything else is charged
+    fingerprints = RowFingerprints('payoneer')
+    for row in export_rows(csv_file):
+        if len(row) < 3 or not row[0].strip() or not row[2].strip():
+            unrecognized_rows.append(row)
+            continue
+
+        raw_date, description, raw_amount = row[0], row[1], row[2]
+        amount = Decimal(raw_amount.replace(',', ''))
+        yield {
+            'kind': 'payment' if amount > 0 else 'charge',
+            'date': reformat_date(raw_date, '%m/%d/%Y'),
+            'fingerprint': fingerprints.of(raw_date, description, raw_amount),
+            'description': description,
+            'value': amount
+        }
+
+
+def file_records(file_paths, unrecognized_rows):
+    # each export has its own fingerprints, so a row in two overlapping exports is only imported once
+    for file_path in file_paths:
+        print("Iterating through file {}".format(os.path.basename(file_path)))
+        with open(file_path,  newline='') as csv_file:
+            yield from process_csv(csv_file, unrecognized_rows)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(usage='convert-payoneer-dates.py path [path ...] [--workers N] [--gnucash-db-path BOOK [--account NAME] [--income-account NAME] [--expense-account NAME] [--dry-run] [--no-ledger]] [--profile [TRACE]]')
+    parser.add_argument('paths', nargs='+', metavar='path', help='Payoneer csv exports or directories with them')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='converts the exports in this many processes (default: one per cpu)')
+    parser.add_argument('--gnucash-db-path', help='imports the exports into this book instead of writing .formatted copies')
+    parser.add_argument('--account', default='Conta no Payoneer', help='account Payoneer holds the money in (default: %(default)s)')
+    parser.add_argument('--income-account', default='Salary', help='income account of the payments received (default: %(default)s)')
+    parser.add_argument('--expense-account', help='expense account of the charges, asked for each of them when not given')
+    parser.add_argument('--dry-run', action='store_true', help='checks the exports against the book, which is only read, and reports what importing them would do')
+    parser.add_argument('--no-ledger', dest='echo_ledger', action='store_false', help='does not print every imported transaction')
+    parser.add_argument('--profile', nargs='?', const=default_trace_path(__file__), metavar='TRACE', help='prints time, SQL statements, rows and peak memory per phase to stderr and appends a JSONL trace to TRACE')
+
+    return parser.parse_args()
+
+
+def run(arguments):
+    file_paths = find_export_files(arguments.paths)
+    if not file_paths:
+        print("No csv found under {}".format(', '.join(arguments.paths)))
+        return
+
+    if arguments.gnucash_db_path is None:
+        with phase('convert'):
+            rows = convert_files(file_paths, arguments.workers)
+            count_rows(sum(rows))
+
+        for file_path, file_rows in zip(file_paths, rows):
+            print("Converted {} rows to {}.formatted".format(file_rows, file_path))
+        return
+
+    payoneer = {
+        'script': __file__,
+        'brokerage_account': arguments.account,
+        'process_csv': process_csv,
+        'expense_accounts': {'charge': arguments.expense_account},
+        'income_accounts': {'payment': arguments.income_account},
+    }
+
+    unrecognized_rows = []
+    with phase('dry_run' if arguments.dry_run else 'write_to_gnucash'):
+        broker_import.write_to_gnucash(arguments.gnucash_db_path, payoneer, file_records(file_paths, unrecognized_rows), broker_import.TransferPricing(),
+                                       echo_ledger=arguments.echo_ledger and not arguments.dry_run, dry_run=arguments.dry_run)
+
+    broker_import.print_unrecognized_rows(unrecognized_rows)
+
+
+def main():
+    arguments = parse_arguments()
+
+    if arguments.profile is None:
+        run(arguments)
+    else:
+        with Profiler(arguments.profile):
+            run(arguments)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,111 +1,129 @@
-import sys
+import argparse
 import os
 
 import csv
 import re
 from decimal import *
 from datetime import datetime
-from piecash import open_book, ledger, Account, Commodity, Transaction, Split
-
-folder_path = sys.argv[1]
-gnucash_db_path = sys.argv[2]
+from piecash import open_book
+from book_resolver import BookResolver
+from transaction_writer import DryRunWriter, RowFingerprints, TransactionWriter
+from profiling import Profiler, count_rows, default_trace_path, phase
+from worker_pool import map_in_pool
 
 # este script necessita das notas de corretagem salvas em csv com o delimitador ';'
 
-def write_to_gnucash(brokerage_statements):
-    with open_book(gnucash_db_path, readonly=False, do_backup=True) as book:
-        bank_account = book.accounts(name='Conta no Inter')
-        sold_value = Decimal(0)
-        bought_value = Decimal(0)
+def statement_fingerprint(fingerprints, statement):
+    stocks = ['{}:{}:{}'.format(stock['stock'], stock['amount'], stock['price']) for stock in statement['stocks']]
+    return fingerprints.of(statement['negotiation_date'], statement['date'], *stocks)
+
+
+def write_to_gnucash(gnucash_db_path, brokerage_statements, dry_run=False):
+    # a dry run reads the book, even while GnuCash has it open, and checks every statement without writing any of them
+    with open_book(gnucash_db_path, readonly=dry_run, open_if_lock=dry_run, do_backup=not dry_run) as book:
+        resolver = BookResolver(book)
+        writer = DryRunWriter(book) if dry_run else TransactionWriter(book)
+        fingerprints = RowFingerprints('inter')
+        bank_account = resolver.account('Conta no Inter')
+        # the 20000 exemption is per month of negotiation
+        values_by_month = {}
+        skipped = 0
+        problems = []
 
         for statement in brokerage_statements:
-            print("Importing {}".format(statement['description']))
+            # statements that were already imported are left out
+            fingerprint = statement_fingerprint(fingerprints, statement)
+            if writer.is_imported(fingerprint):
+                skipped += 1
+                continue
+
+            try:
+                import_statement(writer, resolver, bank_account, values_by_month, statement, fingerprint)
+            except Exception as error:
+                if not dry_run:
+                    raise
+
+                problems.append((statement['description'], error))
 
-            bank_account_value = 0
-            splits_data = []
+        writer.close()
 
-            for stock in statement['stocks']:
-                stock_name = stock['stock'].upper()
-                stock_name = re.sub(r'F$', '', stock_name) # handling fractional
-                stock_name_with_suffix = stock_name + '.SA'
+        if skipped:
+            print("Skipped {} statements already imported".format(skipped))
 
-                try:
-                    stock_commodity = book.commodities(mnemonic=stock_name_with_suffix)
-                except KeyError:
-                    stock_commodity = Commodity(mnemonic=stock_name_with_suffix,
-                        fullname=stock_name_with_suffix,
-                        fraction=1,
-                        namespace='BVMF',
-                        quote_flag=1,
-                        quote_source="yahoo_json",
-                    )
-                    book.flush()
+        for year, month in sorted(values_by_month):
+            month_values = values_by_month[(year, month)]
+            print('{:02d}/{}'.format(month, year))
+            print('sold value: {:.2f}'.format(month_values['sold']))
+            print('bought value: {:.2f}'.format(month_values['bought']))
 
-                try:
-                    stock_account = book.accounts(commodity=stock_commodity)
-                except KeyError:
-                    print("Is {} a stock (1) or a FII (2)?".format(stock_name))
-                    number = int(input())
-                    if number == 1:
-                        parent_account = book.accounts(name='Ações')
-                    elif number == 2:
-                        parent_account = book.accounts(name='FIIs')
-                    else:
-                        raise Exception("Invalid input. Should be 1 or 2")
+            if month_values['sold'] >= 20000:
+                print('*************** You sold more than 20000! Check if you need to pay taxes this month')
 
-                    stock_account = Account(name=stock_name,
-                        type="STOCK",
-                        parent=parent_account,
-                        commodity=stock_commodity,
-                        placeholder=False,
-                    )
-                    book.flush()
+        if dry_run:
+            writer.report(resolver, [bank_account], problems)
 
-                price = Decimal(stock['price'])
-                amount = Decimal(stock['amount'])
-                value =  price * amount
 
-                if value > 0:
-                    bought_value += value
-                else:
-                    sold_value += -value
+def import_statement(writer, resolver, bank_account, values_by_month, statement, fingerprint):
+    if not writer.dry_run:
+        print("Importing {}".format(statement['description']))
 
-                    if 'FIIs' in stock_account.fullname:
-                        print('*************** You have sold the FII {}! Check if you need to pay taxes this month'.format(stock_account.fullname))
+    negotiation_date = datetime.strptime(statement['negotiation_date'], "%d%m%Y")
+    month_values = values_by_month.setdefault((negotiation_date.year, negotiation_date.month), {'sold': Decimal(0), 'bought': Decimal(0)})
 
+    bank_account_value = 0
+    splits_data = []
 
-                splits_data.append({'value': value, 'quantity': stock['amount'], 'account':stock_account})
-                bank_account_value -= value
+    for stock in statement['stocks']:
+        stock_name = stock['stock'].upper()
+        stock_name = re.sub(r'F$', '', stock_name) # handling fractional
+        stock_name_with_suffix = stock_name + '.SA'
 
-            for tax in statement['taxes']:
-                tax_account = book.accounts(name=tax['tax'])
+        stock_commodity = resolver.stock_commodity(stock_name_with_suffix, 'BVMF')
+        stock_account = resolver.account_for_commodity(stock_commodity)
+        if stock_account is None and writer.dry_run:
+            stock_account = writer.asked_account("if {} is a stock or a FII".format(stock_name), stock_name, "STOCK", stock_commodity)
+            resolver.index_account(stock_account)
+        elif stock_account is None:
+            print("Is {} a stock (1) or a FII (2)?".format(stock_name))
+            number = int(input())
+            if number == 1:
+                parent_account = resolver.account('Ações')
+            elif number == 2:
+                parent_account = resolver.account('FIIs')
+            else:
+                raise Exception("Invalid input. Should be 1 or 2")
 
-                value = Decimal(tax['value'])
-                splits_data.append({'value': value, 'account': tax_account})
+            stock_account = resolver.create_account(stock_name, "STOCK", parent_account, stock_commodity)
 
-                bank_account_value -= value
+        price = Decimal(stock['price'])
+        amount = Decimal(stock['amount'])
+        value =  price * amount
 
-            # adds the bank account split only at the end so the value is grouped
-            splits_data.append({'value': bank_account_value, 'account': bank_account})
+        if value > 0:
+            month_values['bought'] += value
+        else:
+            month_values['sold'] += -value
 
-            splits = list(map(lambda split_data: Split(**split_data), splits_data))
+            if 'FIIs' in stock_account.fullname:
+                print('*************** You have sold the FII {}! Check if you need to pay taxes this month'.format(stock_account.fullname))
 
-            date = datetime.strptime(statement['date'], "%d/%m/%Y")
-            t1 = Transaction(currency=bank_account.commodity,
-                description=statement['description'],
-                post_date=date.date(),
-                splits=splits
-            )
-            print(ledger(t1))
 
-        book.save()
+        splits_data.append({'value': value, 'quantity': stock['amount'], 'account':stock_account})
+        bank_account_value -= value
 
+    for tax in statement['taxes']:
+        tax_account = resolver.account(tax['tax'])
 
-        print('sold value: {:.2f}'.format(sold_value))
-        print('bought value: {:.2f}'.format(bought_value))
+        value = Decimal(tax['value'])
+        splits_data.append({'value': value, 'account': tax_account})
 
-        if sold_value >= 20000:
-            print('*************** You sold more than 20000! Check if you need to pay taxes this month')
+        bank_account_value -= value
+
+    # adds the bank account split only at the end so the value is grouped
+    splits_data.append({'value': bank_account_value, 'account': bank_account})
+
+    date = datetime.strptime(statement['date'], "%d/%m/%Y")
+    writer.add(bank_account.commodity, date.date(), statement['description'], splits_data, fingerprint=fingerprint)
 
 
 def extract_date_from_liq(liq_string):
@@ -121,60 +139,104 @@ def extract_negotiation_date(file_path):
     return file_name.split('_')[2]
 
 
-def process_csv(csv_file):
-    # skip first two lines
-    next(csv_file)
-    next(csv_file)
+# columns of the statement header the parser reads
+STATEMENT_COLUMNS = ['PRAÇA', 'C/V', 'ESPECIFICAÇÃO DO TÍTULO', 'QUANTIDADE', 'PREÇO DE LIQUIDAÇÃO(R$)', 'COMPRA/VENDA (R$)', 'D/C']
 
-    # read stocks, amounts and prices
-    brokerage_statement = {}
-    stocks = []
-    taxes = []
 
-    reader = csv.DictReader(csv_file, delimiter = ';', quotechar='"')
+def statement_error(csv_file, line_number, message):
+    return Exception("{}:{}: {}".format(csv_file.name, line_number, message))
+
+
+def statement_decimal(csv_file, line_number, column, value):
+    # empty or malformed numbers are reported with the cell they came from instead of a bare InvalidOperation
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise statement_error(csv_file, line_number, "{} is not a number: '{}'".format(column, value)) from None
+
+
+def process_csv(csv_file):
+    # a single pass that classifies every row by its labels: the title lines until the header, then the trades, each
+    # one followed by its SUBTOTAL row, and after RESUMO DOS NEGÓCIOS the fees, the IRRF and the Líquido para row
+    columns = None
+    in_summary = False
     current_stock = None
     has_sold = None
-    for row in reader:
-        if row['PRAÇA'].startswith('1-Bovespa'):
-            current_stock = row['ESPECIFICAÇÃO DO TÍTULO'].split(' ')[0]
-            has_sold = row['C/V'] == 'V'
-
-        if row['ESPECIFICAÇÃO DO TÍTULO'].startswith('SUBTOTAL'):
-            amount = row['QUANTIDADE'].replace('.', '')
-            if has_sold:
-                amount = '-' + amount
-
-            price = row['PREÇO DE LIQUIDAÇÃO(R$)'].replace(',', '.')
-            stocks.append({
-                'stock': current_stock,
-                'amount': amount,
-                'price': price,
-            })
-            current_stock = None
-
-        if row['PRAÇA'].startswith('RESUMO'):
-            break;
-    row = next(reader)
-    taxa_liquidacao = row['D/C'].replace('D','')
-    taxa_liquidacao = Decimal(taxa_liquidacao)
-    next(reader)
-    next(reader)
-    row = next(reader)
-    taxa_b = row['D/C'].replace('D','').replace('-', '')
-    taxa_b = Decimal(taxa_b)
-    next(reader)
-    row = next(reader)
-    ir = row['PREÇO DE LIQUIDAÇÃO(R$)'].replace('D','')
-    ir = Decimal(ir)
-    row = next(reader)
-    liquido = row['D/C'].replace('D','').replace('C', '').replace('-', '')
-    liquido = Decimal(liquido)
-
-    tax_value = "{:.2f}".format(Decimal(taxa_liquidacao) + Decimal(taxa_b))
-    taxes.append({
+    stocks = []
+    taxa_liquidacao = None
+    taxa_b = None
+    ir = None
+    data_liquido = None
+
+    line_number = 0
+    for line_number, row in enumerate(csv.reader(csv_file, delimiter = ';', quotechar='"'), 1):
+        if columns is None:
+            if 'PRAÇA' in row:
+                missing = [column for column in STATEMENT_COLUMNS if column not in row]
+                if missing:
+                    raise statement_error(csv_file, line_number, "header without the columns {}".format(', '.join(missing)))
+
+                columns = {column: row.index(column) for column in STATEMENT_COLUMNS}
+                praca, c_v, especificacao, quantidade, preco, compra_venda, d_c = (columns[column] for column in STATEMENT_COLUMNS)
+                width = len(row)
+            continue
+
+        if len(row) < width:
+            row = row + [''] * (width - len(row))
+
+        label = row[praca]
+        if not in_summary:
+            if label.startswith('1-Bovespa'):
+                current_stock = row[especificacao].split(' ')[0]
+                has_sold = row[c_v] == 'V'
+            elif row[especificacao].startswith('SUBTOTAL'):
+                if current_stock is None:
+                    raise statement_error(csv_file, line_number, "SUBTOTAL without a trade before it")
+
+                amount = row[quantidade].replace('.', '')
+                if has_sold:
+                    amount = '-' + amount
+                price = row[preco].replace(',', '.')
+
+                # kept as the strings read, the statement fingerprints are made of them
+                statement_decimal(csv_file, line_number, 'QUANTIDADE', amount)
+                statement_decimal(csv_file, line_number, 'PREÇO DE LIQUIDAÇÃO(R$)', price)
+                stocks.append({
+                    'stock': current_stock,
+                    'amount': amount,
+                    'price': price,
+                })
+                current_stock = None
+            elif label.startswith('RESUMO'):
+                in_summary = True
+            continue
+
+        label = label.lower()
+        if label.startswith('taxa de liquidação'):
+            taxa_liquidacao = statement_decimal(csv_file, line_number, 'D/C', row[d_c].replace('D',''))
+        elif label.startswith('emolumentos'):
+            taxa_b = statement_decimal(csv_file, line_number, 'D/C', row[d_c].replace('D','').replace('-', ''))
+        elif label.startswith('irrf'):
+            ir = statement_decimal(csv_file, line_number, 'PREÇO DE LIQUIDAÇÃO(R$)', row[preco].replace('D',''))
+        elif row[compra_venda].startswith('Líquido para'):
+            data_liquido = extract_date_from_liq(row[compra_venda])
+            break
+
+    if columns is None:
+        raise statement_error(csv_file, line_number, "no header with the PRAÇA column")
+
+    if not in_summary:
+        raise statement_error(csv_file, line_number, "no RESUMO DOS NEGÓCIOS section")
+
+    for value, section in [(taxa_liquidacao, 'Taxa de liquidação'), (taxa_b, 'Emolumentos'), (data_liquido, 'Líquido para')]:
+        if value is None:
+            raise statement_error(csv_file, line_number, "no {} row".format(section))
+
+    tax_value = "{:.2f}".format(taxa_liquidacao + taxa_b)
+    taxes = [{
         'tax': 'B3',
         'value': tax_value,
-    })
+    }]
 
     ''' o valor do IR nao esta sendo debitado da conta...
     if ir:
@@ -185,23 +247,78 @@ def process_csv(csv_file):
     '''
 
     negotiation_date = extract_negotiation_date(csv_file.name)
-    data_liquido = extract_date_from_liq(row['COMPRA/VENDA (R$)'])
-    brokerage_statement['stocks'] = stocks
-    brokerage_statement['taxes'] = taxes
-    brokerage_statement['date'] = data_liquido
-    brokerage_statement['description'] = 'Pregão do dia {}'.format(negotiation_date)
-    return brokerage_statement
-
-
-for root, directories, files in os.walk(folder_path):
-    brokerage_statements = []
-    for f in files:
-        if '_NotaCor_'in f and '.csv' in f:
-            print("Iterating through file {}".format(f))
-            file_path = '{}/{}'.format(root, f)
-
-            with open(file_path,  newline='') as csv_file:
-                statement = process_csv(csv_file)
-                brokerage_statements.append(statement)
-    write_to_gnucash(brokerage_statements)
+    return {
+        'stocks': stocks,
+        'taxes': taxes,
+        'date': data_liquido,
+        'negotiation_date': negotiation_date,
+        'description': 'Pregão do dia {}'.format(negotiation_date),
+    }
+
+
+def find_statement_files(folder_path):
+    file_paths = []
+    for root, directories, files in os.walk(folder_path):
+        for f in files:
+            if '_NotaCor_'in f and '.csv' in f:
+                file_paths.append('{}/{}'.format(root, f))
+
+    return sorted(file_paths)
+
+
+def parse_statement(file_path):
+    with open(file_path,  newline='') as csv_file:
+        return process_csv(csv_file)
+
+
+def parse_statements(file_paths, workers):
+    return map_in_pool(parse_statement, file_paths, workers)
+
+
+def settlement_order(statement):
+    return datetime.strptime(statement['date'], "%d/%m/%Y"), datetime.strptime(statement['negotiation_date'], "%d%m%Y")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(usage='importar-nota-de-corretagem-inter.py folder_path gnucash_db_path [--workers N] [--dry-run] [--profile [TRACE]]')
+    parser.add_argument('folder_path')
+    parser.add_argument('gnucash_db_path')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='parses the statements in this many processes (default: one per cpu)')
+    parser.add_argument('--dry-run', action='store_true', help='checks the statements against the book, which is only read, and reports what importing them would do')
+    parser.add_argument('--profile', nargs='?', const=default_trace_path(__file__), metavar='TRACE', help='prints time, SQL statements, rows and peak memory per phase to stderr and appends a JSONL trace to TRACE')
+
+    return parser.parse_args()
+
+
+def run(arguments):
+    # every statement under folder_path is written in a single book session, so the book is backed up once
+    with phase('process_csv'):
+        file_paths = find_statement_files(arguments.folder_path)
+        for file_path in file_paths:
+            print("Iterating through file {}".format(os.path.basename(file_path)))
+
+        brokerage_statements = parse_statements(file_paths, arguments.workers)
+        brokerage_statements.sort(key=settlement_order)
+        count_rows(len(file_paths))
+
+    if not brokerage_statements:
+        print("No _NotaCor_ csv found under {}".format(arguments.folder_path))
+        return
+
+    with phase('dry_run' if arguments.dry_run else 'write_to_gnucash'):
+        write_to_gnucash(arguments.gnucash_db_path, brokerage_statements, arguments.dry_run)
+
+
+def main():
+    arguments = parse_arguments()
+
+    if arguments.profile is None:
+        run(arguments)
+    else:
+        with Profiler(arguments.profile):
+            run(arguments)
+
+
+if __name__ == '__main__':
+    main()
 
@@ -0,0 +1,150 @@
+"""Opt-in profiling shared by ir.py and the importers.
+
+Scripts wrap their phases in `with phase(name):` and report what they went through with count_rows(). Both do nothing
+unless a Profiler is active, in which case every phase records its wall time, the SQL statements SQLAlchemy issued during
+it and their total time, the rows processed and the peak RSS so far. Phases can be nested, the time and statements of an
+inner phase are included in the outer ones. Phases and statements are appended to a JSONL trace as they happen and the
+phases are summarised on stderr when the profiler exits.
+"""
+import os
+import sys
+import json
+import time
+
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is just left out there
+    resource = None
+
+# longer statements are truncated in the trace, the whole text of piecash queries adds little to diagnose them
+TRACE_STATEMENT_LENGTH = 300
+
+active_profiler = None
+
+
+def default_trace_path(script_path):
+    return os.path.splitext(os.path.basename(script_path))[0] + '.profile.jsonl'
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def phase(name):
+    if active_profiler is None:
+        return nullcontext()
+
+    return active_profiler.phase(name)
+
+
+def count_rows(rows):
+    if active_profiler is not None and active_profiler.stack:
+        active_profiler.stack[-1]['rows'] += rows
+
+
+class Profiler:
+
+    def __init__(self, trace_path):
+        self.trace_path = trace_path
+        self.run = datetime.now().isoformat(timespec='seconds')
+        self.phases = []
+        self.stack = []
+        self.trace_file = None
+        self.started = None
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+
+    def __enter__(self):
+        global active_profiler
+        self.trace_file = open(self.trace_path, 'a')
+        self.started = time.perf_counter()
+
+        # listening on the Engine class catches the engine piecash creates when the book is opened
+        event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        active_profiler = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global active_profiler
+        active_profiler = None
+        event.remove(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.remove(Engine, 'after_cursor_execute', self.after_cursor_execute)
+
+        total = {
+            'type': 'run',
+            'seconds': time.perf_counter() - self.started,
+            'sql_statements': self.sql_statements,
+            'sql_seconds': self.sql_seconds,
+            'peak_rss_mb': peak_rss_mb(),
+            'failed': exc_type is not None
+        }
+        self.write(total)
+        self.trace_file.close()
+
+        self.print_summary(total)
+        return False
+
+    def write(self, record):
+        record['run'] = self.run
+        self.trace_file.write(json.dumps(record) + '\n')
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profiling_started', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['profiling_started'].pop()
+        self.sql_statements += 1
+        self.sql_seconds += seconds
+        for record in self.stack:
+            record['sql_statements'] += 1
+            record['sql_seconds'] += seconds
+
+        self.write({
+            'type': 'sql',
+            'phase': self.stack[-1]['name'] if self.stack else None,
+            'seconds': seconds,
+            'executemany': executemany,
+            'statement': ' '.join(statement.split())[:TRACE_STATEMENT_LENGTH]
+        })
+
+    @contextmanager
+    def phase(self, name):
+        record = {'type': 'phase', 'name': name, 'depth': len(self.stack), 'seconds': 0.0, 'sql_statements': 0, 'sql_seconds': 0.0, 'rows': 0, 'peak_rss_mb': None}
+        # listed in the order they started, so inner phases come right after the one containing them
+        self.phases.append(record)
+        self.stack.append(record)
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - started
+            record['peak_rss_mb'] = peak_rss_mb()
+            self.stack.pop()
+            self.write(record)
+
+    def print_summary(self, total):
+        line = '{:<40} {:>10} {:>8} {:>10} {:>10} {:>12}'
+        print(line.format('phase', 'wall (s)', 'sql', 'sql (s)', 'rows', 'peak RSS MB'), file=sys.stderr)
+        for record in self.phases + [dict(total, name='total', depth=0, rows='')]:
+            peak_rss = record['peak_rss_mb']
+            print(line.format(
+                '  ' * record['depth'] + record['name'],
+                '{:.3f}'.format(record['seconds']),
+                record['sql_statements'],
+                '{:.3f}'.format(record['sql_seconds']),
+                record['rows'],
+                '{:.1f}'.format(peak_rss) if peak_rss is not None else '-'), file=sys.stderr)
+
+        print('trace appended to {}'.format(self.trace_path), file=sys.stderr)
@@ -0,0 +1,236 @@
+import time
+import uuid
+import hashlib
+
+from decimal import Decimal
+from datetime import datetime
+from piecash import Account, Transaction, Split, Price, GncImbalanceError, GncValidationError
+from piecash.kvp import Slot, KVP_Type
+from piecash.ledger import format_currency
+from sqlalchemy import select
+from profiling import count_rows, phase
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# string slot of the imported transactions with the fingerprint of the export row they came from
+FINGERPRINT_SLOT = 'import-fingerprint'
+
+
+class TransactionWriter:
+    """Inserts transactions and their splits in chunks, each chunk in its own commit.
+
+    Building the transactions through the ORM makes piecash look up, for every split on a commodity, the price of that
+    day by loading all the prices of the book, which makes importing a large export quadratic, and holding them all
+    until a single book.save() at the end loses everything when the last row fails. Transactions are added here as
+    plain splits data, like {'account': account, 'value': value, 'quantity': quantity}, and written with bulk inserts
+    as piecash would have written them: the same numerators and denominators, the date-posted slot, the Buy/Sell action
+    and a price for the commodity splits when that day has none yet.
+    """
+
+    dry_run = False
+
+    def __init__(self, book, chunk_size=DEFAULT_CHUNK_SIZE, echo_ledger=True):
+        self.book = book
+        self.chunk_size = chunk_size
+        self.echo_ledger = echo_ledger
+        self.pending = []
+        self.written = 0
+        self.started = time.perf_counter()
+
+        # the rows are inserted behind the ORM, so the accounts and commodities it holds stay valid after every commit
+        book.session.expire_on_commit = False
+
+        prices = book.session.query(Price.commodity_guid, Price.currency_guid, Price.date)
+        self.price_dates = set(prices)
+
+        slots = Slot.__table__
+        fingerprints = book.session.execute(select([slots.c.string_val]).where(slots.c.name == FINGERPRINT_SLOT))
+        self.fingerprints = set(fingerprint for fingerprint, in fingerprints)
+
+    def is_imported(self, fingerprint):
+        return fingerprint in self.fingerprints
+
+    def add(self, currency, post_date, description, splits_data, fingerprint=None):
+        for split_data in splits_data:
+            split_data.setdefault('quantity', split_data['value'])
+            if split_data['account'].placeholder:
+                raise GncValidationError("Account '{}' used in the transaction is a placeholder".format(split_data['account']))
+
+        value_imbalance = sum(Decimal(split_data['value']) for split_data in splits_data)
+        if value_imbalance:
+            raise GncImbalanceError("The transaction {} is not balanced on its value (delta={})".format(description, value_imbalance))
+
+        if self.echo_ledger:
+            print(format_ledger(currency, post_date, description, splits_data))
+
+        if fingerprint is not None:
+            self.fingerprints.add(fingerprint)
+
+        count_rows(1)
+        self.pending.append((currency, post_date, description, splits_data, fingerprint))
+        if len(self.pending) >= self.chunk_size:
+            self.save()
+
+    def save(self):
+        with phase('book.save'):
+            # accounts and commodities created while resolving the splits only get their guids when flushed
+            self.book.flush()
+
+            enter_date = datetime.now().replace(microsecond=0)
+            transactions = []
+            splits = []
+            date_slots = []
+            fingerprint_slots = []
+            prices = []
+            for currency, post_date, description, splits_data, fingerprint in self.pending:
+                transaction_guid = uuid.uuid4().hex
+                transactions.append({'guid': transaction_guid, 'currency_guid': currency.guid, 'num': '', 'post_date': post_date, 'enter_date': enter_date, 'description': description})
+                date_slots.append({'obj_guid': transaction_guid, 'name': 'date-posted', 'slot_type': KVP_Type.KVP_TYPE_GDATE, 'gdate_val': post_date})
+                if fingerprint is not None:
+                    fingerprint_slots.append({'obj_guid': transaction_guid, 'name': FINGERPRINT_SLOT, 'slot_type': KVP_Type.KVP_TYPE_STRING, 'string_val': fingerprint})
+
+                for split_data in splits_data:
+                    account = split_data['account']
+                    value = Decimal(split_data['value'])
+                    quantity = Decimal(split_data['quantity'])
+                    action = ''
+
+                    if account.commodity != currency and quantity:
+                        action = 'Sell' if quantity.is_signed() else 'Buy'
+
+                        price_date = (account.commodity.guid, currency.guid, post_date)
+                        if price_date not in self.price_dates:
+                            self.price_dates.add(price_date)
+                            value_num, value_denom = numeric((value / quantity).quantize(Decimal('0.000001')))
+                            prices.append({'guid': uuid.uuid4().hex, 'commodity_guid': account.commodity.guid, 'currency_guid': currency.guid, 'date': post_date,
+                                           'source': 'user:split-register', 'type': 'transaction', 'value_num': value_num, 'value_denom': value_denom})
+
+                    value_num, value_denom = numeric(value)
+                    quantity_num, quantity_denom = numeric(quantity)
+                    splits.append({'guid': uuid.uuid4().hex, 'tx_guid': transaction_guid, 'account_guid': account.guid, 'memo': '', 'action': action, 'reconcile_state': 'n',
+                                   'value_num': value_num, 'value_denom': value_denom, 'quantity_num': quantity_num, 'quantity_denom': quantity_denom})
+
+            for table, rows in [(Transaction.__table__, transactions), (Split.__table__, splits), (Slot.__table__, date_slots), (Slot.__table__, fingerprint_slots), (Price.__table__, prices)]:
+                if rows:
+                    self.book.session.execute(table.insert(), rows)
+
+            self.book.save()
+
+        self.written += len(self.pending)
+        self.pending = []
+
+    def close(self):
+        self.save()
+
+        seconds = time.perf_counter() - self.started
+        print("Wrote {} transactions in {:.1f}s ({:.0f} rows/s)".format(self.written, seconds, self.written / seconds if seconds else 0))
+
+
+class DryRunWriter(TransactionWriter):
+    """Checks the transactions like TransactionWriter and tallies what they move in each account, without writing them.
+
+    It is meant for books opened read-only: the accounts and commodities created to resolve the transactions only live
+    in the session and are discarded with it. What an import would ask is answered with stand-in accounts and kept in
+    questions, so a dry run never waits for input.
+    """
+
+    dry_run = True
+
+    def __init__(self, book, echo_ledger=False):
+        super().__init__(book, echo_ledger=echo_ledger)
+        self.changes = {}
+        self.questions = []
+
+    def asked_account(self, question, name, type, commodity):
+        self.questions.append(question)
+        return Account(name=name, type=type, parent=self.book.root_account, commodity=commodity, placeholder=False)
+
+    def save(self):
+        for _, _, _, splits_data, _ in self.pending:
+            for split_data in splits_data:
+                account = split_data['account']
+                self.changes[account] = self.changes.get(account, 0) + Decimal(split_data['quantity'])
+
+        self.written += len(self.pending)
+        self.pending = []
+
+    def close(self):
+        self.save()
+
+        seconds = time.perf_counter() - self.started
+        print("Checked {} transactions in {:.2f}s, nothing was written to the book".format(self.written, seconds))
+
+    def balance(self, account):
+        # summed in SQL, loading the splits of a cash account through the ORM takes longer than the whole dry run
+        if account.guid is None:
+            return Decimal(0)
+
+        splits = Split.__table__
+        quantities = self.book.session.execute(select([splits.c.quantity_num, splits.c.quantity_denom]).where(splits.c.account_guid == account.guid))
+        return sum((Decimal(num) / denom for num, denom in quantities), Decimal(0))
+
+    def report(self, resolver, cash_accounts, problems):
+        # problems are (description, error) of the rows that would fail to import
+        if resolver.created_commodities:
+            print("New commodities: {}".format(', '.join(commodity.mnemonic for commodity in resolver.created_commodities)))
+
+        if resolver.created_accounts:
+            print("New accounts: {}".format(', '.join(account.fullname for account in resolver.created_accounts)))
+
+        if resolver.missing_accounts:
+            print("Missing accounts: {}".format(', '.join(sorted(resolver.missing_accounts))))
+
+        for question in self.questions:
+            print("Will ask {}".format(question))
+
+        if problems:
+            print("{} rows would fail to import:".format(len(problems)))
+            for description, error in problems:
+                print("\t{}: {!r}".format(description, error))
+
+        for account in cash_accounts:
+            balance = self.balance(account)
+            commodity = account.commodity
+            print("{}: {} -> {}".format(account.fullname, format_currency(balance, commodity.precision, commodity.mnemonic),
+                                        format_currency(balance + self.changes.get(account, 0), commodity.precision, commodity.mnemonic)))
+
+
+class RowFingerprints:
+    """Fingerprints of the rows of a broker export, made from the fields that identify a row.
+
+    Identical rows, like two equal purchases on the same day, are numbered in the order they appear, so each of them is
+    only skipped when the previous import already had as many of them.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.occurrences = {}
+
+    def of(self, *fields):
+        key = '|'.join([self.broker] + [field.strip() for field in fields])
+        occurrence = self.occurrences.get(key, 0) + 1
+        self.occurrences[key] = occurrence
+
+        return hashlib.sha1('{}|{}'.format(key, occurrence).encode()).hexdigest()
+
+
+def numeric(value):
+    # like piecash, the denominator comes from the decimal places of the value and not from the commodity fraction
+    denom = 10 ** max(-value.as_tuple().exponent, 0)
+    return int(value * denom), denom
+
+
+def format_ledger(currency, post_date, description, splits_data):
+    # same layout piecash's ledger() gives a Transaction
+    lines = ["{:%Y-%m-%d} {}\n".format(post_date, description)]
+    for split_data in sorted(splits_data, key=lambda split_data: Decimal(split_data['value'])):
+        account = split_data['account']
+        if account.commodity != currency:
+            amount = "{} @@ {}".format(format_currency(Decimal(split_data['quantity']), account.commodity.precision, account.commodity.mnemonic, decimal_quantization=False),
+                                       format_currency(abs(Decimal(split_data['value'])), currency.precision, currency.mnemonic))
+        else:
+            amount = format_currency(Decimal(split_data['value']), currency.precision, currency.mnemonic)
+
+        lines.append("\t{:40}  {}\n".format(account.fullname, amount))
+
+    return "".join(lines)
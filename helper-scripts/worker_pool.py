@@ -0,0 +1,15 @@
+"""Process pool shared by ir.py and the importers."""
+from concurrent.futures import ProcessPoolExecutor
+
+
+def map_in_pool(function, items, workers, initializer=None, initargs=()):
+    # function(item) for every item in order, across workers processes when there is more than one item to share.
+    # Workers import the module of function again, so scripts keep their main() behind __name__ == '__main__'
+    if workers <= 1 or len(items) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [function(item) for item in items]
+
+    chunksize = max(1, len(items) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        return list(executor.map(function, items, chunksize=chunksize))
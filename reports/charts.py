@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+# rendered to files only, so no display is needed. Set before plotting imports pyplot, also in the worker processes
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from holdings import holdings_until
+from plotting import DOWNSAMPLE_METHODS, plot_dividends, plot_portfolio, plot_realised, plot_ticker
+from portfolio import INVESTMENT_ACCOUNT_TYPES, QUANTITY_EPSILON, SQL_DAY, lookup_table, numeric_rows, open_book, replay_costs
+
+# income accounts with the dividends of each investment as children, under these parents
+DIVIDEND_PARENTS = ('Dividendos', 'JCP', 'Receita de FIIs', 'US Dividends')
+
+CHART_KINDS = ('portfolio', 'tickers', 'dividends', 'realised')
+
+# arrays of ChartData, the rest of it goes to its metadata
+CHART_ARRAYS = ('portfolio_value', 'portfolio_invested', 'type_values', 'price', 'average_cost', 'dividends', 'realised')
+
+
+def read_chart_splits(gnucash_db_path):
+    # the investment splits in the order they happened, each account on its own, and the splits of the dividend accounts
+    account_types = ', '.join('?' * len(INVESTMENT_ACCOUNT_TYPES))
+    connection = open_book(gnucash_db_path)
+    try:
+        investments = numeric_rows(connection, '''
+            SELECT a.rowid, {}, s.quantity_num * 1.0 / s.quantity_denom, s.value_num * 1.0 / s.value_denom, c.rowid
+            FROM splits s JOIN transactions t ON t.guid = s.tx_guid JOIN accounts a ON a.guid = s.account_guid JOIN commodities c ON c.guid = t.currency_guid
+            WHERE a.account_type IN ({}) ORDER BY a.rowid, t.post_date, t.enter_date, s.rowid'''.format(SQL_DAY.format('t.post_date'), account_types), INVESTMENT_ACCOUNT_TYPES)
+
+        parents = ', '.join('?' * len(DIVIDEND_PARENTS))
+        dividends = numeric_rows(connection, '''
+            SELECT CASE p.name {} END, {}, -s.value_num * 1.0 / s.value_denom, c.rowid
+            FROM splits s JOIN transactions t ON t.guid = s.tx_guid JOIN accounts a ON a.guid = s.account_guid JOIN accounts p ON p.guid = a.parent_guid
+            JOIN commodities c ON c.guid = t.currency_guid
+            WHERE a.account_type = 'INCOME' AND p.name IN ({})'''.format(' '.join('WHEN ? THEN {}'.format(i) for i in range(len(DIVIDEND_PARENTS))),
+                                                                          SQL_DAY.format('t.post_date'), parents), DIVIDEND_PARENTS + DIVIDEND_PARENTS, columns=4)
+    finally:
+        connection.close()
+
+    return investments, dividends
+
+
+class ChartData:
+    """What every chart of the batch is drawn from, computed once and stored as .npy files the workers memory-map.
+
+    It answers the calls plot_portfolio() makes on a DailyPortfolio, so the portfolio chart draws from it too.
+    """
+
+    def __init__(self, metadata, arrays):
+        self.metadata = metadata
+        self.names = metadata['names']
+        self.types = metadata['types']
+        self.dates = np.arange(metadata['first_day'], metadata['first_day'] + metadata['days']).astype('datetime64[D]')
+        for name in CHART_ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def compute(cls, gnucash_db_path, until=None, rebuild=False):
+        portfolio = holdings_until(gnucash_db_path, until, rebuild)
+        investments, dividends = read_chart_splits(gnucash_db_path)
+        days, last_day = len(portfolio.quantity), portfolio.last_day
+
+        # the splits and dividends after the last day are left out, the ones before the first day count on it
+        investments = investments[investments[:, 1] <= last_day]
+        dividends = dividends[dividends[:, 1] <= last_day]
+        investment_rows = np.maximum(investments[:, 1].astype(int) - portfolio.first_day, 0)
+        dividend_rows = np.maximum(dividends[:, 1].astype(int) - portfolio.first_day, 0)
+
+        # the average cost of the days something is held, from the cost basis of the portfolio
+        held = portfolio.quantity > QUANTITY_EPSILON
+        average_cost = np.full(portfolio.quantity.shape, np.nan)
+        np.divide(portfolio.cost, portfolio.quantity, out=average_cost, where=held)
+
+        # the profit each sale realised, replayed the same way in the book currency of the day of each split
+        columns = lookup_table(portfolio.account_rowids, np.arange(len(portfolio.names)), int(portfolio.account_rowids.max(initial=0)) + 1)[investments[:, 0].astype(int)]
+        values = portfolio.in_base_currency(investment_rows, investments[:, 4].astype(int), investments[:, 3])
+        _, realised_by_split = replay_costs(columns, investments[:, 2], values, np.zeros((len(portfolio.names), 3)))
+
+        types, type_columns = np.unique(portfolio.types, return_inverse=True)
+        years = portfolio.dates.astype('datetime64[Y]').astype(int) + 1970
+        first_year = int(years[0]) if days else 0
+        year_count = int(years[-1]) - first_year + 1 if days else 0
+        realised = np.zeros((year_count, len(types)))
+        np.add.at(realised, (years[investment_rows] - first_year, type_columns[columns]), realised_by_split)
+
+        months = portfolio.dates.astype('datetime64[M]').astype(int)
+        first_month = int(months[0]) if days else 0
+        month_count = int(months[-1]) - first_month + 1 if days else 0
+        dividend_values = np.zeros((month_count, len(DIVIDEND_PARENTS)))
+        np.add.at(dividend_values, (months[dividend_rows] - first_month, dividends[:, 0].astype(int)),
+                  portfolio.in_base_currency(dividend_rows, dividends[:, 3].astype(int), dividends[:, 2]))
+
+        type_names, value_by_type = portfolio.value_by_type()
+        metadata = {'names': portfolio.names, 'types': type_names, 'first_day': portfolio.first_day, 'days': days,
+                    'first_year': first_year, 'first_month': first_month, 'dividend_types': list(DIVIDEND_PARENTS),
+                    'tickers': [int(column) for column in np.flatnonzero(held.any(axis=0))]}
+        arrays = {'portfolio_value': portfolio.total_value(), 'portfolio_invested': portfolio.total_invested(), 'type_values': value_by_type,
+                  'price': portfolio.price, 'average_cost': average_cost, 'dividends': dividend_values, 'realised': realised}
+
+        return cls(metadata, arrays)
+
+    def save(self, directory):
+        for name in CHART_ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'metadata.json'), 'w') as metadata_file:
+            json.dump(self.metadata, metadata_file)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'metadata.json')) as metadata_file:
+            metadata = json.load(metadata_file)
+
+        return cls(metadata, {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in CHART_ARRAYS})
+
+    def total_value(self):
+        return self.portfolio_value
+
+    def total_invested(self):
+        return self.portfolio_invested
+
+    def value_by_type(self):
+        return self.types, self.type_values
+
+    def months(self):
+        return np.arange(self.metadata['first_month'], self.metadata['first_month'] + len(self.dividends)).astype('datetime64[M]')
+
+    def years(self):
+        return np.arange(self.metadata['first_year'], self.metadata['first_year'] + len(self.realised))
+
+
+def chart_jobs(data, kinds):
+    # a job per chart, the ticker charts are one per account that ever held something
+    jobs = []
+    for kind in kinds:
+        if kind == 'tickers':
+            jobs.extend(('ticker', column) for column in data.metadata['tickers'])
+        else:
+            jobs.append((kind, None))
+
+    return jobs
+
+
+def chart_file_name(data, kind, column, file_format):
+    if kind == 'ticker':
+        return 'ticker-{}.{}'.format(''.join(c if c.isalnum() or c in '-_.' else '_' for c in data.names[column]), file_format)
+
+    return '{}.{}'.format(kind, file_format)
+
+
+def draw_chart(data, kind, column, downsample='minmax'):
+    if kind == 'portfolio':
+        return plot_portfolio(data, downsample)
+    elif kind == 'ticker':
+        return plot_ticker(data.dates, data.names[column], data.price[:, column], data.average_cost[:, column], downsample)
+    elif kind == 'dividends':
+        return plot_dividends(data.months(), data.metadata['dividend_types'], data.dividends)
+    elif kind == 'realised':
+        return plot_realised(data.years(), data.types, data.realised)
+
+    raise ValueError('unknown chart {}'.format(kind))
+
+
+# the chart data of each worker process, loaded once by load_worker_data
+worker_data = None
+
+
+def load_worker_data(directory, dpi):
+    # figures are drawn at the dpi they are saved with, so the lines are downsampled to the pixels of the file
+    global worker_data
+    worker_data = ChartData.load(directory)
+    plt.rcParams['figure.dpi'] = dpi
+
+
+def render_chart(job):
+    kind, column, output_directory, file_format, downsample = job
+    figure = draw_chart(worker_data, kind, column, downsample)
+    path = os.path.join(output_directory, chart_file_name(worker_data, kind, column, file_format))
+    figure.savefig(path, dpi='figure')
+    plt.close(figure)
+
+    return path
+
+
+def render_charts(data, kinds, output_directory, file_format='png', dpi=100, workers=1, downsample='minmax'):
+    # returns the paths of the charts, rendered across workers processes that memory-map the chart data
+    os.makedirs(output_directory, exist_ok=True)
+    with tempfile.TemporaryDirectory() as data_directory:
+        data.save(data_directory)
+        jobs = [(kind, column, output_directory, file_format, downsample) for kind, column in chart_jobs(data, kinds)]
+
+        if workers <= 1 or len(jobs) <= 1:
+            load_worker_data(data_directory, dpi)
+            return [render_chart(job) for job in jobs]
+
+        chunksize = max(1, len(jobs) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=load_worker_data, initargs=(data_directory, dpi)) as executor:
+            return list(executor.map(render_chart, jobs, chunksize=chunksize))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(usage='charts.py gnucash_db_path output_directory [--charts KIND ...] [--format png|svg] [--dpi DPI] [--downsample METHOD] [--workers N] [--until YYYY-MM-DD] [--rebuild]')
+    parser.add_argument('gnucash_db_path')
+    parser.add_argument('output_directory')
+    parser.add_argument('--charts', nargs='+', choices=CHART_KINDS, default=list(CHART_KINDS), metavar='KIND',
+                        help='charts to render, out of {} (default: all of them)'.format(', '.join(CHART_KINDS)))
+    parser.add_argument('--format', choices=('png', 'svg'), default='png')
+    parser.add_argument('--dpi', type=int, default=100)
+    parser.add_argument('--downsample', choices=DOWNSAMPLE_METHODS, default='minmax',
+                        help='draws about a point per pixel of every line with {} or every point with none (default: %(default)s)'.format(' or '.join(DOWNSAMPLE_METHODS[:-1])))
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='renders the charts in this many processes (default: one per cpu)')
+    parser.add_argument('--until', help='last day of the charts (default: today)')
+    parser.add_argument('--rebuild', action='store_true', help='computes the holdings stored next to the book again instead of refreshing them')
+
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    start = time.perf_counter()
+    data = ChartData.compute(arguments.gnucash_db_path, arguments.until, arguments.rebuild)
+    computed = time.perf_counter()
+
+    paths = render_charts(data, arguments.charts, arguments.output_directory, arguments.format, arguments.dpi,
+                          arguments.workers, arguments.downsample)
+    print("Rendered {} charts to {} in {:.2f}s, {:.2f}s of it computing their data".format(len(paths), arguments.output_directory,
+                                                                                         time.perf_counter() - start, computed - start))
+
+
+if __name__ == '__main__':
+    main()
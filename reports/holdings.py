@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from portfolio import INVESTMENT_ACCOUNT_TYPES, DailyPortfolio, day_number, day_string, lookup_table, open_book, read_book
+
+# bump it whenever DailyPortfolio computes its matrices differently, so holdings stored by older versions are rebuilt
+HOLDINGS_VERSION = 3
+
+MATRICES = ('quantity', 'invested', 'price', 'value', 'rates', 'cost')
+
+# the matrices are stored with room for this many more days, so most refreshes only write the rows they changed
+GROWTH_DAYS = 366
+
+# the digests of the book hash each row into an integer below this prime, with a multiplier per column
+HASH_MODULUS = 2147483647
+HASH_MULTIPLIERS = (40503, 7919, 6007, 104729, 1000003, 15485863, 3571, 611953)
+
+# yyyymmdd of a date column, a number unique to the day that is cheaper for sqlite than julianday()
+SQL_DATE_NUMBER = "(CAST({0} AS INTEGER) * 10000 + CAST(substr({0}, 6) AS INTEGER) * 100 + CAST(substr({0}, 9) AS INTEGER))"
+
+
+def holdings_path(gnucash_db_path):
+    return gnucash_db_path + '.holdings'
+
+
+def row_hash(columns):
+    # a polynomial of the integer columns of a row modulo HASH_MODULUS, small enough for sqlite to square as an integer
+    terms = ' + '.join('{} % {} * {}'.format(column, HASH_MODULUS, multiplier) for column, multiplier in zip(columns, HASH_MULTIPLIERS))
+    return '({}) % {}'.format(terms, HASH_MODULUS)
+
+
+def digest_query(rows, marked):
+    # the count and the sum of the squared hashes of the rows up to the mark before a refresh and of every row. Summing
+    # squares makes the digest change when a value moves from a row to another, which a plain sum of them misses.
+    # LIMIT -1 keeps sqlite from computing the hash of each row once per use of it
+    return '''
+        SELECT count(CASE WHEN {marked} THEN 1 END), coalesce(sum(CASE WHEN {marked} THEN h * h % {modulus} END), 0),
+               count(*), coalesce(sum(h * h % {modulus}), 0)
+        FROM ({rows} LIMIT -1)'''.format(marked=marked, rows=rows, modulus=HASH_MODULUS)
+
+
+def book_digests(connection, before, after):
+    # digests of the investment splits of the transactions entered up to the entered mark and of the prices up to the
+    # priced day, for the marks before and after a refresh, hashing every row. A digest that changes means something up
+    # to there was edited, deleted or entered late. Prices are hashed without their commodity, joining it would cost
+    # more than the rest of the digests
+    def marks_parameters(marks):
+        if marks is None:
+            return '', ''
+        return marks['entered'] or '', day_string(marks['priced'] + 1) if marks['priced'] is not None else ''
+
+    (entered_before, priced_before), (entered_after, priced_after) = marks_parameters(before), marks_parameters(after)
+    split_hash = row_hash(['s.rowid', 'a.rowid', 'c.rowid', SQL_DATE_NUMBER.format('t.post_date'),
+                           's.value_num', 's.value_denom', 's.quantity_num', 's.quantity_denom'])
+    splits = connection.execute(digest_query('''
+        SELECT t.enter_date AS entered, {} AS h
+        FROM splits s JOIN transactions t ON t.guid = s.tx_guid JOIN accounts a ON a.guid = s.account_guid JOIN commodities c ON c.guid = t.currency_guid
+        WHERE a.account_type IN ({}) AND t.enter_date <= :entered_after'''.format(split_hash, ', '.join(':type{}'.format(i) for i in range(len(INVESTMENT_ACCOUNT_TYPES)))),
+        'entered <= :entered_before'),
+        dict({'type{}'.format(i): account_type for i, account_type in enumerate(INVESTMENT_ACCOUNT_TYPES)},
+             entered_before=entered_before, entered_after=entered_after)).fetchone()
+
+    price_hash = row_hash(['p.rowid', SQL_DATE_NUMBER.format('p.date'), 'p.value_num', 'p.value_denom'])
+    prices = connection.execute(digest_query('''
+        SELECT p.date AS date, {} AS h FROM prices p WHERE p.date < :priced_after'''.format(price_hash), 'date < :priced_before'),
+        {'priced_before': priced_before, 'priced_after': priced_after}).fetchone()
+
+    return {'splits': list(splits[:2]), 'prices': list(prices[:2])}, {'splits': list(splits[2:]), 'prices': list(prices[2:])}
+
+
+def load_holdings(gnucash_db_path, mode='r'):
+    # returns the stored portfolio and its state, or None when there are no holdings of this version. The matrices are
+    # memory-mapped with mode, 'c' lets them be changed in memory only
+    path = holdings_path(gnucash_db_path)
+    try:
+        with open(os.path.join(path, 'state.json')) as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        return None
+
+    if state.get('version') != HOLDINGS_VERSION:
+        return None
+
+    days = state['days']
+    matrices = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mode)[:days] for name in MATRICES}
+    accounts = [tuple(account) for account in state['accounts']]
+    portfolio = DailyPortfolio(state['base_currency'], accounts, state['first_day'], matrices['quantity'], matrices['invested'],
+                               matrices['price'], np.array(state['currencies']), matrices['rates'], matrices['value'], matrices['cost'],
+                               np.array(state['positions'], dtype=float).reshape(-1, 3), np.array(state['last_split_days'], dtype=int))
+
+    return portfolio, state
+
+
+def save_holdings(gnucash_db_path, portfolio, state, changed=0):
+    # the rows from changed on are written over the stored matrices when they have room for them, otherwise the
+    # matrices are written again. The state goes last, holdings without it are rebuilt
+    path = holdings_path(gnucash_db_path)
+    os.makedirs(path, exist_ok=True)
+    state_path = os.path.join(path, 'state.json')
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    days = len(portfolio.quantity)
+    for name in MATRICES:
+        matrix = getattr(portfolio, name)
+        matrix_path = os.path.join(path, name + '.npy')
+        try:
+            stored = np.load(matrix_path, mmap_mode='r+')
+        except (OSError, ValueError):
+            stored = None
+
+        if stored is not None and stored.shape[0] >= days and stored.shape[1:] == matrix.shape[1:]:
+            stored[changed:days] = matrix[changed:]
+            stored.flush()
+        else:
+            # a new file, the loaded portfolio may still be mapping the old one
+            del stored
+            np.save(matrix_path + '.new.npy', np.concatenate([matrix, np.repeat(matrix[-1:], GROWTH_DAYS, axis=0)]))
+            os.replace(matrix_path + '.new.npy', matrix_path)
+
+    state = dict(state, version=HOLDINGS_VERSION, days=days, first_day=portfolio.first_day, base_currency=portfolio.base_currency,
+                 currencies=portfolio.currencies.tolist(), accounts=[list(account) for account in portfolio.accounts],
+                 positions=portfolio.positions.tolist(), last_split_days=portfolio.last_split_days.tolist())
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def refresh_holdings(gnucash_db_path, rebuild=False):
+    # brings the holdings up to today, or to the last split if it is later, adding only the splits of the transactions
+    # entered since the last refresh and the prices after the last one priced. Edits to what was already added, new
+    # accounts, splits before the first day or older than the last split of their account, which the cost basis was
+    # already replayed past, and currency rates that are the first of their currency or for days that already have
+    # splits rebuild them. Returns the portfolio and how it was refreshed
+    connection = open_book(gnucash_db_path)
+    try:
+        # a single read transaction, so the marks and their digests are the ones of the rows read
+        connection.execute('BEGIN')
+        loaded = None if rebuild else load_holdings(gnucash_db_path, mode='c')
+        stored_marks = loaded[1]['marks'] if loaded is not None else {'entered': None, 'priced': None}
+        base_currency, accounts, splits, prices = read_book(connection, stored_marks['entered'], stored_marks['priced'])
+
+        entered, = connection.execute('SELECT max(enter_date) FROM transactions').fetchone()
+        priced = int(max(prices[:, 1].max(initial=-1), stored_marks['priced'] if stored_marks['priced'] is not None else -1))
+        marks = {'entered': entered, 'priced': priced if priced >= 0 else None}
+        before, after = book_digests(connection, stored_marks if loaded is not None else None, marks)
+        marks.update(after)
+    finally:
+        connection.close()
+
+    if loaded is not None and any(stored_marks[table] != before[table] for table in ('splits', 'prices')):
+        return refresh_holdings(gnucash_db_path, rebuild=True)
+
+    last_day = max(day_number(), int(splits[:, 1].max(initial=0)))
+    if loaded is not None:
+        portfolio, state = loaded
+        rates = (prices[:, 4] == 1) & (prices[:, 3] == base_currency)
+        if (base_currency != portfolio.base_currency or accounts != portfolio.accounts or splits[:, 1].min(initial=np.inf) < portfolio.first_day
+                or prices[rates, 1].min(initial=np.inf) <= state['last_split_day'] or not np.isin(prices[rates, 0], portfolio.currencies).all()):
+            return refresh_holdings(gnucash_db_path, rebuild=True)
+
+        columns = lookup_table(portfolio.account_rowids, np.arange(len(accounts)), int(portfolio.account_rowids.max(initial=0)) + 1)[splits[:, 0].astype(int)]
+        if (splits[:, 1] < portfolio.last_split_days[columns]).any():
+            return refresh_holdings(gnucash_db_path, rebuild=True)
+
+        stored_days = len(portfolio.quantity)
+        portfolio.extend_to(last_day)
+        changed = min(portfolio.add(splits, prices), stored_days)
+        how = 'added {} splits and {} prices'.format(len(splits), len(prices))
+    else:
+        first_day = int(splits[:, 1].min()) if len(splits) else last_day
+        portfolio = DailyPortfolio.empty(base_currency, accounts, first_day)
+        portfolio.extend_to(last_day)
+        portfolio.add(splits, prices)
+        changed, state = 0, {'last_split_day': -1}
+        how = 'rebuilt'
+
+    last_split_day = int(max(state['last_split_day'], splits[:, 1].max(initial=-1)))
+    save_holdings(gnucash_db_path, portfolio, dict(state, marks=marks, last_split_day=last_split_day), changed)
+
+    return portfolio, how
+
+
+def holdings_until(gnucash_db_path, until=None, rebuild=False):
+    # the portfolio from the first split to until, today by default
+    portfolio, _ = refresh_holdings(gnucash_db_path, rebuild)
+    last_day = day_number(until)
+    if last_day < portfolio.last_day:
+        return portfolio.truncated(last_day)
+
+    portfolio.extend_to(last_day)
+    return portfolio
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(usage='holdings.py gnucash_db_path [--rebuild]')
+    parser.add_argument('gnucash_db_path')
+    parser.add_argument('--rebuild', action='store_true', help='computes the holdings again from every split and price of the book')
+
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    start = time.perf_counter()
+    portfolio, how = refresh_holdings(arguments.gnucash_db_path, arguments.rebuild)
+
+    print("Holdings of {} accounts from {} to {} {} in {:.2f}s, stored in {}".format(len(portfolio.names), portfolio.dates[0], portfolio.dates[-1],
+                                                                                  how, time.perf_counter() - start, holdings_path(arguments.gnucash_db_path)))
+
+
+if __name__ == '__main__':
+    main()
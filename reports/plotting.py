@@ -1,17 +1,186 @@
+import argparse
+
 import matplotlib.pyplot as plt
 import numpy as np
 
-x = np.linspace(0, 2, 100)
+from holdings import holdings_until
+
+# minmax keeps the lowest and highest point of every two pixels, lttb the points that change the shape of the line the
+# most, none draws every point
+DOWNSAMPLE_METHODS = ('minmax', 'lttb', 'none')
+
+
+def series_edges(values):
+    # the first and last points and the ones around every gap, so lines start, end and break where the full series does
+    gaps = np.isnan(values).reshape(len(values), -1).any(axis=1)
+    changes = np.flatnonzero(gaps[1:] != gaps[:-1])
+    return np.concatenate([[0, len(values) - 1], changes, changes + 1])
+
+
+def min_max_indices(values, buckets):
+    # the lowest and highest point of each column in each of about buckets runs of consecutive points
+    values = values.reshape(len(values), -1)
+    size = -(-len(values) // buckets)
+    buckets = -(-len(values) // size)
+    blocks = np.full((buckets * size, values.shape[1]), np.nan)
+    blocks[:len(values)] = values
+    blocks = blocks.reshape(buckets, size, values.shape[1])
+
+    starts = (np.arange(buckets) * size)[:, None]
+    missing = np.isnan(blocks)
+    lowest = np.where(missing, np.inf, blocks).argmin(axis=1) + starts
+    highest = np.where(missing, -np.inf, blocks).argmax(axis=1) + starts
+    return np.minimum(np.concatenate([lowest.ravel(), highest.ravel()]), len(values) - 1)
+
+
+def lttb_indices(values, points):
+    # Largest-Triangle-Three-Buckets over the points that are not NaN: keeps the first and the last and, from each bucket
+    # in between, the point making the largest triangle with the point kept before it and the average of the next bucket
+    finite = np.flatnonzero(~np.isnan(values))
+    if len(finite) <= max(points, 2):
+        return finite
+    if points < 3:
+        # no bucket between the first and the last
+        return finite[[0, -1]]
+
+    x, y = finite.tolist(), values[finite].tolist()
+    x_sums, y_sums = [0] + np.cumsum(finite).tolist(), [0.0] + np.cumsum(values[finite]).tolist()
+    count, every = len(x), (len(x) - 2) / (points - 2)
+
+    kept, previous = [0], 0
+    for bucket in range(points - 2):
+        start, end = int(bucket * every) + 1, int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, count)
+        next_count = next_end - end
+        next_x, next_y = (x_sums[next_end] - x_sums[end]) / next_count, (y_sums[next_end] - y_sums[end]) / next_count
+
+        previous_x, previous_y = x[previous], y[previous]
+        best, best_area = start, -1.0
+        for i in range(start, end):
+            area = abs((previous_x - next_x) * (y[i] - previous_y) - (previous_x - x[i]) * (next_y - previous_y))
+            if area > best_area:
+                best, best_area = i, area
+
+        kept.append(best)
+        previous = best
+
+    kept.append(count - 1)
+    return finite[kept]
+
+
+def downsample_indices(values, points, method='minmax'):
+    # indices of the rows to draw of values, a series or a matrix with one series per column, about points of them per
+    # series. Matrices keep the rows any of their series needs, so their series can still be stacked
+    if method == 'none' or len(values) <= points:
+        return np.arange(len(values))
+
+    if method == 'minmax':
+        indices = min_max_indices(values, max(points // 2, 1))
+    elif method == 'lttb':
+        columns = values.reshape(len(values), -1)
+        indices = np.concatenate([lttb_indices(columns[:, column], points) for column in range(columns.shape[1])])
+    else:
+        raise ValueError('unknown downsampling method {}'.format(method))
+
+    return np.unique(np.concatenate([indices, series_edges(values)]))
+
+
+def downsampled(axes, dates, values, method):
+    # the dates and values to draw on axes, about a point per pixel of its width
+    indices = downsample_indices(values, max(int(axes.get_window_extent().width), 2), method)
+    return dates[indices], values[indices]
+
+
+def plot_portfolio(portfolio, downsample='minmax'):
+    figure, (value_axes, allocation_axes) = plt.subplots(2, 1, sharex=True, figsize=(12, 8))
+
+    dates, values = downsampled(value_axes, portfolio.dates, np.column_stack([portfolio.total_value(), portfolio.total_invested()]), downsample)
+    value_axes.plot(dates, values[:, 0], label='total value')
+    value_axes.plot(dates, values[:, 1], label='invested capital')
+    value_axes.set_ylabel('value')
+    value_axes.set_title('Portfolio')
+    value_axes.legend()
+
+    types, value_by_type = portfolio.value_by_type()
+    total = value_by_type.sum(axis=1, keepdims=True)
+    allocation = np.divide(value_by_type, total, out=np.zeros_like(value_by_type), where=total != 0) * 100
+
+    dates, allocation = downsampled(allocation_axes, portfolio.dates, allocation, downsample)
+    allocation_axes.stackplot(dates, allocation.T, labels=types)
+    allocation_axes.set_ylabel('allocation (%)')
+    allocation_axes.set_ylim(0, 100)
+    allocation_axes.legend(loc='upper left')
+
+    return figure
+
+
+def plot_ticker(dates, name, price, average_cost, downsample='minmax'):
+    # days without a position have NaN average cost, which leaves a gap in its line
+    figure, axes = plt.subplots(figsize=(10, 5))
+
+    dates, values = downsampled(axes, dates, np.column_stack([price, average_cost]), downsample)
+    axes.plot(dates, values[:, 0], label='price')
+    axes.plot(dates, values[:, 1], label='average cost')
+    axes.set_ylabel('price')
+    axes.set_title(name)
+    axes.legend()
+
+    return figure
+
+
+def plot_stacked_bars(periods, types, values, title, ylabel, width):
+    # values is a periods x types matrix, negative values stack downwards
+    figure, axes = plt.subplots(figsize=(12, 5))
+
+    positive_bottom, negative_bottom = np.zeros(len(periods)), np.zeros(len(periods))
+    for column, type_name in enumerate(types):
+        column_values = values[:, column]
+        bottom = np.where(column_values < 0, negative_bottom, positive_bottom)
+        axes.bar(periods, column_values, width=width, bottom=bottom, label=type_name)
+        positive_bottom += np.maximum(column_values, 0)
+        negative_bottom += np.minimum(column_values, 0)
+
+    axes.axhline(0, color='black', linewidth=0.5)
+    axes.set_ylabel(ylabel)
+    axes.set_title(title)
+    axes.legend(loc='upper left')
+
+    return figure
+
+
+def plot_dividends(months, types, dividends):
+    return plot_stacked_bars(months.astype('datetime64[D]'), types, dividends, 'Dividends per month', 'dividends', width=25)
+
+
+def plot_realised(years, types, realised):
+    return plot_stacked_bars(years, types, realised, 'Realised profit and loss per year', 'profit', width=0.8)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(usage='plotting.py gnucash_db_path [--until YYYY-MM-DD] [--output FILE] [--downsample METHOD] [--rebuild]')
+    parser.add_argument('gnucash_db_path')
+    parser.add_argument('--until', help='last day of the report (default: today)')
+    parser.add_argument('--output', help='saves the chart to this file instead of showing it')
+    parser.add_argument('--downsample', choices=DOWNSAMPLE_METHODS, default='minmax',
+                        help='draws about a point per pixel of every line with {} or every point with none (default: %(default)s)'.format(' or '.join(DOWNSAMPLE_METHODS[:-1])))
+    parser.add_argument('--rebuild', action='store_true', help='computes the holdings stored next to the book again instead of refreshing them')
+
+    return parser.parse_args()
+
 
-plt.plot(x, x, label='linear')
-plt.plot(x, x**2, label='quadratic')
-plt.plot(x, x**3, label='cubic')
+def main():
+    arguments = parse_arguments()
+    portfolio = holdings_until(arguments.gnucash_db_path, arguments.until, arguments.rebuild)
 
-plt.xlabel('x label')
-plt.ylabel('y label')
+    if portfolio.unpriced:
+        print("No prices for {}, they are valued at the capital invested in them".format(', '.join(portfolio.unpriced)))
 
-plt.title("Simple Plot")
+    figure = plot_portfolio(portfolio, arguments.downsample)
+    if arguments.output is None:
+        plt.show()
+    else:
+        figure.savefig(arguments.output)
 
-plt.legend()
 
-plt.show()
+if __name__ == '__main__':
+    main()
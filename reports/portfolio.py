@@ -0,0 +1,334 @@
+import json
+import sqlite3
+
+import numpy as np
+
+# the GnuCash account types that hold investments
+INVESTMENT_ACCOUNT_TYPES = ('STOCK', 'MUTUAL')
+
+# investment accounts carry their metadata as JSON in the description, the ones without it are typed by their parent
+TYPE_BY_PARENT = {'Ações': 'acao', 'FIIs': 'fii', 'Ações no exterior': 'us stock', 'Crypto': 'crypto'}
+
+# dates come out of sqlite as days since 1970-01-01, the epoch of numpy's datetime64
+SQL_DAY = "CAST(julianday(substr({}, 1, 10)) - 2440587.5 AS INTEGER)"
+
+# quantities closer to zero than this are sold out, summing GnuCash's fractions as floats leaves residues like 5.55e-17
+QUANTITY_EPSILON = 1e-9
+
+
+def account_type(parent_name, description):
+    try:
+        metadata = json.loads(description or '')
+    except ValueError:
+        metadata = None
+
+    if isinstance(metadata, dict) and 'type' in metadata:
+        return metadata['type']
+
+    return TYPE_BY_PARENT.get(parent_name, 'other')
+
+
+def daily_totals(days, columns, values, shape):
+    # sums the deltas of each day and column and accumulates them over the days
+    totals = np.bincount(days * shape[1] + columns, weights=values, minlength=shape[0] * shape[1])
+    return np.cumsum(totals.reshape(shape), axis=0)
+
+
+def forward_filled(days, columns, values, shape, seed=None):
+    # last value of each column on or before each day, carried on from the seed row when there is one. On a day with
+    # several values the last row wins. Days before the first value of a column take that first value, columns without
+    # any value stay NaN
+    filled = np.full((shape[0] + 1, shape[1]), np.nan)
+    if seed is not None:
+        filled[0] = seed
+    filled[days + 1, columns] = values
+
+    known = np.where(np.isnan(filled), 0, np.arange(shape[0] + 1)[:, None])
+    np.maximum.accumulate(known, axis=0, out=known)
+    filled = filled[known, np.arange(shape[1])][1:]
+
+    first = np.argmax(~np.isnan(filled), axis=0)
+    return np.where(np.isnan(filled), filled[first, np.arange(shape[1])], filled)
+
+
+def fill_forward_from(matrix, first_row, rows, columns, values):
+    # writes the values into the matrix and carries them forward, rewriting the rows from first_row on. The rows before
+    # it only change in the columns that had no value yet, which take their first new one. Returns the first row changed.
+    # The values must be newer than the ones already there, on the first row they are carried on from its own values
+    seed = matrix[max(first_row - 1, 0)].copy()
+    matrix[first_row:] = forward_filled(rows - first_row, columns, values, (len(matrix) - first_row, matrix.shape[1]), seed)
+
+    new = np.isnan(seed) & ~np.isnan(matrix[first_row])
+    matrix[:first_row, new] = matrix[first_row, new]
+    return 0 if new.any() else first_row
+
+
+def replay_costs(columns, quantities, values, positions):
+    # the cost basis after each split and the profit it realised, with the rule ir.py replays accounts with: purchases
+    # and stock splits, the splits without value, add to the purchases the average cost is taken over, sales realise the
+    # difference to it without changing it, capital returned without a quantity is skipped as ir.py does and selling
+    # everything starts over. The splits of each column come in order, positions has the quantity, value and quantity
+    # purchased of every column before them and is left with the ones after them
+    costs, realised = np.zeros(len(columns)), np.zeros(len(columns))
+    replayed = positions.tolist()
+    for i, (column, quantity_delta, value) in enumerate(zip(columns.tolist(), quantities.tolist(), values.tolist())):
+        quantity, value_purchases, quantity_purchases = replayed[column]
+        if value >= 0:
+            quantity += quantity_delta
+            value_purchases += value
+            quantity_purchases += quantity_delta
+        elif quantity_delta != 0:
+            quantity += quantity_delta
+            average_cost = value_purchases / quantity_purchases if quantity_purchases else 0.0
+            realised[i] = -value + average_cost * quantity_delta
+
+        if abs(quantity) < QUANTITY_EPSILON:
+            quantity, value_purchases, quantity_purchases = 0.0, 0.0, 0.0
+
+        replayed[column] = (quantity, value_purchases, quantity_purchases)
+        costs[i] = quantity * value_purchases / quantity_purchases if quantity_purchases else 0.0
+
+    positions[:] = replayed
+    return costs, realised
+
+
+def lookup_table(keys, values, size, missing=-1):
+    # array indexed by the integer keys below size, for mapping whole columns of keys at once
+    table = np.full(size, missing, dtype=int)
+    table[keys] = values
+    return table
+
+
+class DailyPortfolio:
+    """Daily matrices, dates x investment accounts, of the quantity held, its cost basis, the capital invested and the
+    market value.
+
+    The cost basis is the quantity held at its average cost, replayed the way ir.py does with replay_costs(). The
+    invested capital is the running sum of what the splits paid and received, so a sale takes out what it was sold for
+    instead of what it cost. Values are in the currency of the book: prices and split values in other currencies are
+    converted with the prices of those currencies, kept in rates, and accounts without any price are valued at the
+    capital invested in them.
+
+    The days start at first_day and grow with extend_to(). Splits and prices are added with add(), which only rewrites
+    the days from the earliest one they touch, so the matrices can be kept up to date with what was entered since.
+    positions keeps where the replay of each account stopped and last_split_days the day of its last split.
+    """
+
+    def __init__(self, base_currency, accounts, first_day, quantity, invested, price, currencies, rates, value=None,
+                 cost=None, positions=None, last_split_days=None):
+        self.base_currency = base_currency
+        self.accounts = accounts
+        self.first_day = first_day
+        self.quantity = quantity
+        self.invested = invested
+        self.price = price
+        self.currencies = currencies
+        self.rates = rates
+        self.value = np.where(np.isnan(price), invested, quantity * price) if value is None else value
+        self.cost = np.zeros(quantity.shape) if cost is None else cost
+        self.positions = np.zeros((len(accounts), 3)) if positions is None else positions
+        self.last_split_days = np.full(len(accounts), first_day - 1) if last_split_days is None else last_split_days
+
+        self.names = [name for _, name, _, _, _ in accounts]
+        self.types = [account_type(parent_name, description) for _, _, parent_name, description, _ in accounts]
+        self.account_rowids = np.array([rowid for rowid, _, _, _, _ in accounts], dtype=int)
+        self.account_commodities = np.array([commodity for _, _, _, _, commodity in accounts], dtype=int)
+
+    @classmethod
+    def empty(cls, base_currency, accounts, first_day):
+        shape = (0, len(accounts))
+        return cls(base_currency, accounts, first_day, np.zeros(shape), np.zeros(shape), np.full(shape, np.nan),
+                   np.array([base_currency]), np.ones((0, 1)))
+
+    @property
+    def dates(self):
+        return np.arange(self.first_day, self.first_day + len(self.quantity)).astype('datetime64[D]')
+
+    @property
+    def last_day(self):
+        return self.first_day + len(self.quantity) - 1
+
+    @property
+    def unpriced(self):
+        return [name for name, priced in zip(self.names, ~np.isnan(self.price).all(axis=0)) if not priced]
+
+    def extend_to(self, last_day):
+        # the new days repeat the last one, nothing was bought, sold or priced on them
+        days = last_day - self.last_day
+        if days <= 0:
+            return
+
+        def extended(matrix, initial):
+            last = matrix[-1:] if len(matrix) else np.full((1, matrix.shape[1]), initial)
+            return np.concatenate([matrix, np.repeat(last, days, axis=0)])
+
+        self.quantity, self.invested, self.value = extended(self.quantity, 0), extended(self.invested, 0), extended(self.value, 0)
+        self.cost = extended(self.cost, 0)
+        self.price, self.rates = extended(self.price, np.nan), extended(self.rates, np.nan)
+        self.rates[:, np.searchsorted(self.currencies, self.base_currency)] = 1
+
+    def truncated(self, last_day):
+        # the days up to last_day, the matrices are views of these ones
+        days = max(last_day - self.first_day + 1, 0)
+        return DailyPortfolio(self.base_currency, self.accounts, self.first_day, self.quantity[:days], self.invested[:days], self.price[:days],
+                              self.currencies, self.rates[:days], self.value[:days], self.cost[:days], self.positions, self.last_split_days)
+
+    def add(self, splits, prices):
+        # splits and prices as read_book() returns them, the splits within the days of the matrices and none of them
+        # older than the last split already added to its account. Returns the first row that changed
+        split_accounts, split_days, split_quantities, split_values, split_currencies = splits.T
+        price_commodities, price_days, price_values, price_currencies, price_is_currency = prices.T
+        split_accounts, split_days, split_currencies = split_accounts.astype(int), split_days.astype(int) - self.first_day, split_currencies.astype(int)
+        price_commodities, price_days, price_currencies = price_commodities.astype(int), price_days.astype(int) - self.first_day, price_currencies.astype(int)
+        changed = len(self.quantity)
+
+        # the prices of a day are applied in the order they were entered, the last one wins. Prices from before the first
+        # day are all moved to it, so those come first and in date order
+        early = price_days < 0
+        if early.any():
+            order = np.concatenate([np.flatnonzero(early)[np.argsort(price_days[early], kind='stable')], np.flatnonzero(~early)])
+            price_commodities, price_days, price_values, price_currencies, price_is_currency = (column[order] for column in (price_commodities, price_days, price_values, price_currencies, price_is_currency))
+
+        price_days = np.maximum(price_days, 0)
+        in_range = price_days < len(self.quantity)
+
+        # rates of the currencies to the book currency, one column per currency, the book currency itself at 1
+        is_rate = in_range & (price_is_currency == 1) & (price_currencies == self.base_currency)
+        currencies = np.union1d(self.currencies, price_commodities[is_rate])
+        if len(currencies) > len(self.currencies):
+            rates = np.full((len(self.rates), len(currencies)), np.nan)
+            rates[:, np.searchsorted(currencies, self.currencies)] = self.rates
+            self.currencies, self.rates = currencies, rates
+
+        base_column = int(np.searchsorted(self.currencies, self.base_currency))
+        if is_rate.any():
+            rate_columns = np.searchsorted(self.currencies, price_commodities[is_rate])
+            changed = min(changed, fill_forward_from(self.rates, int(price_days[is_rate].min()), price_days[is_rate], rate_columns, price_values[is_rate]))
+            self.rates[:, base_column] = 1
+
+        if len(split_days):
+            first_row = int(split_days.min())
+            shape = (len(self.quantity) - first_row, len(self.accounts))
+            columns = lookup_table(self.account_rowids, np.arange(len(self.accounts)), int(self.account_rowids.max(initial=0)) + 1)[split_accounts]
+            split_values = self.in_base_currency(split_days, split_currencies, split_values)
+            self.quantity[first_row:] += daily_totals(split_days - first_row, columns, split_quantities, shape)
+            self.invested[first_row:] += daily_totals(split_days - first_row, columns, split_values, shape)
+            changed = min(changed, first_row)
+
+            # the cost basis of an account only changes on the days of its splits, so it is rewritten from its first
+            # new split on and the accounts without new splits keep theirs
+            costs, _ = replay_costs(columns, split_quantities, split_values, self.positions)
+            first_rows = np.full(len(self.accounts), len(self.quantity))
+            np.minimum.at(first_rows, columns, split_days)
+            rewritten = np.arange(first_row, len(self.quantity))[:, None] >= first_rows
+            self.cost[first_row:] = np.where(rewritten, forward_filled(split_days - first_row, columns, costs, shape), self.cost[first_row:])
+            np.maximum.at(self.last_split_days, columns, split_days + self.first_day)
+
+        # each price goes to every account holding its commodity, converted to the book currency on its day
+        accounts_per_commodity = np.bincount(self.account_commodities, minlength=int(price_commodities.max(initial=0)) + 1)
+        held = in_range & (accounts_per_commodity[price_commodities] > 0)
+        held_commodities, days = price_commodities[held], price_days[held]
+        values = self.in_base_currency(days, price_currencies[held], price_values[held])
+
+        if accounts_per_commodity.max(initial=0) <= 1:
+            price_columns = lookup_table(self.account_commodities, np.arange(len(self.accounts)), len(accounts_per_commodity))[held_commodities]
+        else:
+            # commodities held in several accounts repeat their prices once per account
+            by_commodity = np.argsort(self.account_commodities, kind='stable')
+            first_account = np.cumsum(accounts_per_commodity) - accounts_per_commodity
+            repeat = accounts_per_commodity[held_commodities]
+            offsets = np.arange(repeat.sum()) - np.repeat(np.cumsum(repeat) - repeat, repeat)
+            price_columns = by_commodity[np.repeat(first_account[held_commodities], repeat) + offsets]
+            days, values = np.repeat(days, repeat), np.repeat(values, repeat)
+
+        if len(days):
+            changed = min(changed, fill_forward_from(self.price, int(days.min()), days, price_columns, values))
+
+        self.value[changed:] = np.where(np.isnan(self.price[changed:]), self.invested[changed:], self.quantity[changed:] * self.price[changed:])
+        return changed
+
+    def in_base_currency(self, rows, currency_rowids, values):
+        # the values converted with the rates of their rows, currencies without any rate are left as they are
+        base_column = int(np.searchsorted(self.currencies, self.base_currency))
+        currency_size = int(max(currency_rowids.max(initial=0), self.currencies.max())) + 1
+        currency_column = lookup_table(self.currencies, np.arange(len(self.currencies)), currency_size, missing=base_column)
+        return values * self.rates[rows, currency_column[currency_rowids]]
+
+    def total_value(self):
+        return self.value.sum(axis=1)
+
+    def total_invested(self):
+        return self.invested.sum(axis=1)
+
+    def total_cost(self):
+        return self.cost.sum(axis=1)
+
+    def value_by_type(self):
+        # returns the types and a dates x types matrix
+        type_names, type_columns = np.unique(self.types, return_inverse=True)
+        one_hot = np.zeros((len(self.types), len(type_names)))
+        one_hot[np.arange(len(self.types)), type_columns] = 1
+
+        return list(type_names), self.value @ one_hot
+
+
+def day_number(day=None):
+    # days since 1970-01-01 of a yyyy-mm-dd date, today by default
+    return int(np.datetime64(day if day is not None else 'today', 'D').astype(int))
+
+
+def day_string(day):
+    return str(np.datetime64(day, 'D'))
+
+
+def numeric_rows(connection, query, parameters=(), columns=5):
+    return np.array(connection.execute(query, parameters).fetchall(), dtype=float).reshape(-1, columns)
+
+
+def open_book(book_path):
+    return sqlite3.connect('file:{}?mode=ro'.format(book_path), uri=True)
+
+
+def read_book(connection, entered_after=None, priced_after=None):
+    # the book is read with plain SQL and only numbers come out of it: accounts and commodities are referred to by their
+    # sqlite rowid and dates are day numbers, which keeps reading millions of prices cheap. entered_after leaves out the
+    # splits of transactions entered up to that enter_date and priced_after the prices up to that day
+    account_types = ', '.join('?' * len(INVESTMENT_ACCOUNT_TYPES))
+    base_currency, = connection.execute('''
+        SELECT c.rowid FROM books b JOIN accounts a ON a.guid = b.root_account_guid JOIN commodities c ON c.guid = a.commodity_guid''').fetchone()
+
+    accounts = connection.execute('''
+        SELECT a.rowid, a.name, p.name, a.description, c.rowid
+        FROM accounts a LEFT JOIN accounts p ON p.guid = a.parent_guid JOIN commodities c ON c.guid = a.commodity_guid
+        WHERE a.account_type IN ({}) ORDER BY p.name, a.name'''.format(account_types), INVESTMENT_ACCOUNT_TYPES).fetchall()
+
+    split_filter, split_parameters = ('', ()) if entered_after is None else ('AND t.enter_date > ?', (entered_after,))
+    splits = numeric_rows(connection, '''
+        SELECT a.rowid, {}, s.quantity_num * 1.0 / s.quantity_denom, s.value_num * 1.0 / s.value_denom, c.rowid
+        FROM splits s JOIN transactions t ON t.guid = s.tx_guid JOIN accounts a ON a.guid = s.account_guid JOIN commodities c ON c.guid = t.currency_guid
+        WHERE a.account_type IN ({}) {} ORDER BY t.post_date, t.enter_date, s.rowid'''.format(SQL_DAY.format('t.post_date'), account_types, split_filter),
+        INVESTMENT_ACCOUNT_TYPES + split_parameters)
+
+    price_filter, price_parameters = ('', ()) if priced_after is None else ('WHERE p.date >= ?', (day_string(priced_after + 1),))
+    prices = numeric_rows(connection, '''
+        SELECT c.rowid, {}, p.value_num * 1.0 / p.value_denom, k.rowid, c.namespace = 'CURRENCY'
+        FROM prices p JOIN commodities c ON c.guid = p.commodity_guid JOIN commodities k ON k.guid = p.currency_guid {}'''.format(SQL_DAY.format('p.date'), price_filter), price_parameters)
+
+    return base_currency, accounts, splits, prices
+
+
+def build_daily_portfolio(book_path, until=None):
+    # until defaults to today, the days go from the first investment split to it
+    connection = open_book(book_path)
+    try:
+        base_currency, accounts, splits, prices = read_book(connection)
+    finally:
+        connection.close()
+
+    last_day = day_number(until)
+    first_day = int(splits[:, 1].min()) if len(splits) else last_day
+    portfolio = DailyPortfolio.empty(base_currency, accounts, first_day)
+    portfolio.extend_to(last_day)
+    portfolio.add(splits[splits[:, 1] <= last_day], prices)
+
+    return portfolio